@@ -4,6 +4,11 @@ from fastapi import APIRouter, HTTPException, status
 
 from stustapay.bon.bon import BonJson
 from stustapay.core.http.auth_user import CurrentAuthToken
+from stustapay.core.http.caching import (
+    IMMUTABLE_CACHE_CONTROL,
+    IfNoneMatch,
+    json_response_with_etag,
+)
 from stustapay.core.http.context import ContextOrderService
 from stustapay.core.http.normalize_data import NormalizedList, normalize_list
 from stustapay.core.schema.order import CompletedSaleProducts, EditSaleProducts, Order
@@ -41,9 +46,16 @@ async def get_order(token: CurrentAuthToken, order_id: int, order_service: Conte
     return order
 
 
-@router.get("/{order_id}/bon", response_model=BonJson)
-async def get_order_bon(order_id: int, order_service: ContextOrderService):
-    return await order_service.get_bon_by_id(order_id=order_id)
+@router.get(
+    "/{order_id}/bon",
+    response_model=BonJson,
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the bon did not change, bons never change"}},
+)
+async def get_order_bon(order_id: int, order_service: ContextOrderService, if_none_match: IfNoneMatch = None):
+    bon = await order_service.get_serialized_bon_by_id(order_id=order_id)
+    return json_response_with_etag(
+        body=bon.body, etag=bon.etag, if_none_match=if_none_match, cache_control=IMMUTABLE_CACHE_CONTROL
+    )
 
 
 @router.delete("/{order_id}")
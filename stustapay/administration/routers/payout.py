@@ -1,6 +1,6 @@
 from datetime import date
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
 from pydantic import BaseModel
 
 from stustapay.core.http.auth_user import CurrentAuthToken
@@ -12,6 +12,7 @@ from stustapay.core.schema.payout import (
     PayoutRunWithStats,
     PendingPayoutDetail,
 )
+from stustapay.core.service.customer.payout import sepa_xml_files_as_zip
 
 router = APIRouter(
     prefix="/payouts",
@@ -79,6 +80,37 @@ async def payout_run_sepa_xml(
     )
 
 
+class CreateSepaXMLZipPayload(CreateSepaXMLPayload):
+    max_transactions_per_file: int | None = None
+
+
+@router.post(
+    "/{payout_run_id}/sepa_xml_zip",
+    responses={
+        "200": {
+            "description": "Successful Response",
+            "content": {"application/zip": {}},
+        }
+    },
+)
+async def payout_run_sepa_xml_zip(
+    token: CurrentAuthToken,
+    payout_run_id: int,
+    customer_service: ContextCustomerService,
+    payload: CreateSepaXMLZipPayload,
+    node_id: int,
+):
+    sepa_xml_files = await customer_service.payout.get_payout_run_sepa_xml_files(
+        token=token,
+        node_id=node_id,
+        payout_run_id=payout_run_id,
+        execution_date=payload.execution_date,
+        max_transactions_per_file=payload.max_transactions_per_file,
+    )
+    headers = {"Content-Disposition": f'attachment; filename="sepa__run_{payout_run_id}__{payload.execution_date}.zip"'}
+    return Response(sepa_xml_files_as_zip(payout_run_id, sepa_xml_files), headers=headers, media_type="application/zip")
+
+
 @router.post("/{payout_run_id}/previous_sepa_xml", response_model=str)
 async def previous_payout_run_sepa_xml(
     token: CurrentAuthToken,
@@ -93,6 +125,30 @@ async def previous_payout_run_sepa_xml(
     )
 
 
+@router.post(
+    "/{payout_run_id}/previous_sepa_xml_zip",
+    responses={
+        "200": {
+            "description": "Successful Response",
+            "content": {"application/zip": {}},
+        }
+    },
+)
+async def previous_payout_run_sepa_xml_zip(
+    token: CurrentAuthToken,
+    payout_run_id: int,
+    customer_service: ContextCustomerService,
+    node_id: int,
+):
+    sepa_xml_files = await customer_service.payout.get_previous_payout_run_sepa_xml_files(
+        token=token,
+        node_id=node_id,
+        payout_run_id=payout_run_id,
+    )
+    headers = {"Content-Disposition": f'attachment; filename="sepa__run_{payout_run_id}.zip"'}
+    return Response(sepa_xml_files_as_zip(payout_run_id, sepa_xml_files), headers=headers, media_type="application/zip")
+
+
 @router.post("/{payout_run_id}/set-as-done")
 async def set_payout_run_as_done(
     token: CurrentAuthToken,
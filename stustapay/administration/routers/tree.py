@@ -3,6 +3,7 @@ from pydantic import BaseModel
 
 from stustapay.bon.bon import BonJson
 from stustapay.core.http.auth_user import CurrentAuthToken
+from stustapay.core.http.caching import IfNoneMatch, json_response_with_etag
 from stustapay.core.http.context import ContextTreeService
 from stustapay.core.schema.tree import (
     NewEvent,
@@ -20,9 +21,12 @@ router = APIRouter(
 )
 
 
-@router.get("/")
-async def get_tree_for_current_user(token: CurrentAuthToken, tree_service: ContextTreeService) -> NodeSeenByUser:
-    return await tree_service.get_tree_for_current_user(token=token)
+@router.get("/", response_model=NodeSeenByUser)
+async def get_tree_for_current_user(
+    token: CurrentAuthToken, tree_service: ContextTreeService, if_none_match: IfNoneMatch = None
+):
+    tree = await tree_service.get_serialized_tree_for_current_user(token=token)
+    return json_response_with_etag(tree.body, tree.etag, if_none_match)
 
 
 @router.post("/nodes/{node_id}/create-node")
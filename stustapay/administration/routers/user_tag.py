@@ -1,11 +1,17 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from pydantic import BaseModel
 
 from stustapay.core.http.auth_user import CurrentAuthToken
 from stustapay.core.http.context import ContextUserTagService
 from stustapay.core.http.normalize_data import NormalizedList, normalize_list
 from stustapay.core.schema.account import UserTagDetail
-from stustapay.core.schema.user_tag import NewUserTag, NewUserTagSecret, UserTagSecret
+from stustapay.core.schema.user_tag import (
+    NewUserTag,
+    NewUserTagSecret,
+    UserTagImportResult,
+    UserTagSecret,
+)
+from stustapay.core.service.user_tag import parse_user_tag_csv
 
 router = APIRouter(
     prefix="",
@@ -43,6 +49,22 @@ async def create_user_tags(
     return await user_tag_service.create_user_tags(token=token, node_id=node_id, new_user_tags=new_user_tags)
 
 
+@router.post("/user-tags/import", response_model=UserTagImportResult)
+async def import_user_tags(
+    token: CurrentAuthToken,
+    user_tag_service: ContextUserTagService,
+    request: Request,
+    node_id: int,
+):
+    """
+    Bulk import user tags from a csv request body with a header line and the columns pin, restriction and secret_id.
+    The body is streamed into the database without being buffered as a whole.
+    """
+    return await user_tag_service.import_user_tags(
+        token=token, node_id=node_id, records=parse_user_tag_csv(request.stream())
+    )
+
+
 class FindUserTagPayload(BaseModel):
     search_term: str
 
@@ -112,6 +112,10 @@ class Api:
         order_service = OrderService(db_pool=db_pool, config=self.cfg, auth_service=auth_service)
         config_service = ConfigService(db_pool=db_pool, config=self.cfg, auth_service=auth_service)
         mail_service = MailService(db_pool=db_pool, config=self.cfg)
+        tree_service = TreeService(db_pool=db_pool, config=self.cfg, auth_service=auth_service)
+        customer_service = CustomerService(
+            db_pool=db_pool, config=self.cfg, auth_service=auth_service, config_service=config_service
+        )
 
         context = Context(
             config=self.cfg,
@@ -126,10 +130,8 @@ class Api:
             ticket_service=TicketService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             user_tag_service=UserTagService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             tse_service=TseService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
-            tree_service=TreeService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
-            customer_service=CustomerService(
-                db_pool=db_pool, config=self.cfg, auth_service=auth_service, config_service=config_service
-            ),
+            tree_service=tree_service,
+            customer_service=customer_service,
             sumup_service=SumUpService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             terminal_service=TerminalService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             mail_service=mail_service,
@@ -137,6 +139,8 @@ class Api:
         try:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="administration")))
             self.server.add_task(asyncio.create_task(mail_service.run_mail_service()))
+            self.server.add_task(asyncio.create_task(tree_service.run_tree_cache_invalidation()))
             await self.server.run(context)
         finally:
+            await customer_service.close()
             await db_pool.close()
@@ -3,6 +3,7 @@ import asyncio
 import json
 import logging
 import sys
+import time
 
 from asyncpg.exceptions import PostgresError
 from sftkit.database import Connection, DatabaseHook
@@ -11,6 +12,11 @@ from stustapay.bon.bon import generate_bon_json
 from stustapay.core.config import Config
 from stustapay.core.database import get_database
 from stustapay.core.healthcheck import run_healthcheck
+from stustapay.core.metrics import METRICS, run_metrics_snapshots
+
+BON_GENERATION_DURATION = METRICS.histogram("bon_generation_duration_seconds", "Time to generate and store a bon")
+TIME_TO_BON = METRICS.histogram("bon_time_to_bon_seconds", "Time from booking an order until its bon was generated")
+BON_GENERATION_FAILURES = METRICS.counter("bon_generation_failures_total", "Number of failed bon generations")
 
 
 class GeneratorWorker:
@@ -44,6 +50,7 @@ class GeneratorWorker:
         self.tasks = [
             asyncio.create_task(self.db_hook.run()),
             asyncio.create_task(run_healthcheck(db, service_name="bon")),
+            asyncio.create_task(run_metrics_snapshots(service_name="bon")),
         ]
 
         try:
@@ -78,10 +85,13 @@ class GeneratorWorker:
             assert bon_exists is not None
             await self.process_bon(order_id=bon_id)
         except json.JSONDecodeError as e:
+            BON_GENERATION_FAILURES.inc(reason="invalid_payload")
             self.logger.error(f"Error while trying to decode database payload for bon notification: {e}")
         except PostgresError as e:
+            BON_GENERATION_FAILURES.inc(reason="database")
             self.logger.error(f"Database error while processing bon: {e}")
         except Exception:  # pylint: disable=broad-except
+            BON_GENERATION_FAILURES.inc(reason="unexpected")
             exc_type, exc_value, exc_traceback = sys.exc_info()
             import traceback
 
@@ -95,8 +105,10 @@ class GeneratorWorker:
         Then saves the result back to the database
         """
         self.logger.debug(f"Generating Bon for order {order_id}...")
+        start = time.monotonic()
         bon_json = await generate_bon_json(db_pool=self.pool, order_id=order_id)
         if bon_json is None:
+            BON_GENERATION_FAILURES.inc(reason="missing_data")
             self.logger.error(
                 f"Error while generating bon data for order {order_id}. This is an internal stustapay error and should not occur naturally"
             )
@@ -104,11 +116,15 @@ class GeneratorWorker:
 
         async with self.pool.acquire() as conn:
             async with conn.transaction(isolation="serializable"):
-                await conn.execute(
-                    "update bon set bon_json = $2, generated_at = now() where id = $1",
+                time_to_bon = await conn.fetchval(
+                    "update bon set bon_json = $2, generated_at = now() where id = $1 "
+                    "returning extract(epoch from bon.generated_at - (select booked_at from ordr where id = $1))",
                     order_id,
                     bon_json.model_dump_json(),
                 )
+        BON_GENERATION_DURATION.observe(time.monotonic() - start)
+        if time_to_bon is not None:
+            TIME_TO_BON.observe(float(time_to_bon))
 
 
 class Generator:
@@ -1,7 +1,7 @@
 import asyncio
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Annotated
+from typing import Annotated, Optional
 
 import typer
 from sftkit.util import log_setup
@@ -64,6 +64,13 @@ def dsfinvk_export(
         "./stustapay/dsfinvk/assets/gdpdu-01-09-2004.dtd"
     ),
     dry_run: bool = False,
+    jobs: Annotated[
+        int, typer.Option("--jobs", "-j", help="number of worker processes exporting the tills in parallel")
+    ] = 1,
+    cache_dir: Annotated[
+        Optional[Path],
+        typer.Option(help="directory to cache the exported Kassenabschlüsse in, unchanged ones are reused"),
+    ] = None,
 ):
     """Export all data required by dsfinvk to the given zip file."""
     generator = DsfinvkGenerator(
@@ -73,6 +80,8 @@ def dsfinvk_export(
         dtd=str(dtd_file),
         simulate=dry_run,
         event_node_id=node_id,
+        jobs=jobs,
+        cache_dir=str(cache_dir) if cache_dir is not None else None,
     )
     asyncio.run(generator.run())
 
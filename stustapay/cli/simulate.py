@@ -6,6 +6,10 @@ import typer
 from stustapay.festivalsimulator.database_setup import DatabaseSetup
 from stustapay.festivalsimulator.festivalsetup import FestivalSetup
 from stustapay.festivalsimulator.festivalsimulator import Simulator
+from stustapay.tse.diebold_nixdorf_usb.simulator import (
+    LatencyDistribution,
+    LatencyDistributionType,
+)
 
 simulate_cli = typer.Typer()
 
@@ -21,6 +25,7 @@ def setup(
     n_topup_tills: Annotated[int, typer.Option(help="number of topup tills to create")] = 8,
     n_beer_tills: Annotated[int, typer.Option(help="number of beer tills to create")] = 20,
     n_cocktail_tills: Annotated[int, typer.Option(help="number of cocktail tills to create")] = 3,
+    n_tses: Annotated[int, typer.Option(help="number of simulated TSEs to create")] = 1,
 ):
     """Prepare the database for a future stustapay simulation."""
     config = ctx.obj.config
@@ -32,6 +37,7 @@ def setup(
         n_entry_tills=n_entry_tills,
         n_cashiers=n_cashiers,
         n_tags=n_tags,
+        n_tses=n_tses,
     )
     asyncio.run(database_setup.run())
 
@@ -41,10 +47,33 @@ def api(
     ctx: typer.Context,
     no_bon: Annotated[bool, typer.Option(help="Do not run the bon generator")] = False,
     no_tse: Annotated[bool, typer.Option(help="Do not run the TSE signature processor")] = False,
+    n_tses: Annotated[int, typer.Option(help="number of virtual TSEs to simulate, see 'simulate setup'")] = 1,
+    tse_latency: Annotated[
+        Optional[float], typer.Option(help="mean signing latency of the simulated TSEs in seconds, default none")
+    ] = None,
+    tse_latency_spread: Annotated[float, typer.Option(help="spread of the simulated signing latency")] = 0.0,
+    tse_latency_distribution: Annotated[
+        LatencyDistributionType, typer.Option(help="distribution of the simulated signing latency")
+    ] = LatencyDistributionType.fixed,
+    tse_failure_rate: Annotated[float, typer.Option(help="probability of a simulated signing failure")] = 0.0,
+    tse_disconnect_rate: Annotated[
+        float, typer.Option(help="probability of a simulated TSE disconnect after signing")
+    ] = 0.0,
 ):
     """Start all APIs which are necessary for a working, simulated environment."""
     config = ctx.obj.config
-    api_starter = FestivalSetup(config=config, no_bon=no_bon, no_tse=no_tse)
+    latency = None
+    if tse_latency is not None:
+        latency = LatencyDistribution(type=tse_latency_distribution, mean=tse_latency, spread=tse_latency_spread)
+    api_starter = FestivalSetup(
+        config=config,
+        no_bon=no_bon,
+        no_tse=no_tse,
+        n_tses=n_tses,
+        tse_latency=latency,
+        tse_failure_rate=tse_failure_rate,
+        tse_disconnect_rate=tse_disconnect_rate,
+    )
     api_starter.run()
 
 
@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import Annotated, Optional
+
 import typer
 
 from stustapay import token_generation
@@ -6,8 +9,22 @@ token_cli = typer.Typer()
 
 
 @token_cli.command()
-def generate_nfc(count: int = 10):
-    token_generation.generate_nfc(count)
+def generate_nfc(
+    ctx: typer.Context,
+    count: int = 10,
+    out: Annotated[Optional[Path], typer.Option(help="csv file to write the pins to, defaults to stdout")] = None,
+    node_id: Annotated[
+        Optional[int], typer.Option(help="check the pins for uniqueness against the user tags of this node's tree")
+    ] = None,
+    secret_id: Annotated[
+        Optional[int], typer.Option(help="directly create user tags with this secret at --node-id")
+    ] = None,
+):
+    """Generate unique random pins for nfc wristbands."""
+    if secret_id is not None and node_id is None:
+        print("--secret-id requires --node-id")
+        raise typer.Exit(1)
+    token_generation.generate_nfc(count, out=out, config=ctx.obj.config, node_id=node_id, secret_id=secret_id)
 
 
 @token_cli.command()
@@ -3,6 +3,10 @@ from typing import Annotated, Optional
 
 import typer
 
+from stustapay.tse.diebold_nixdorf_usb.simulator import (
+    LatencyDistribution,
+    LatencyDistributionType,
+)
 from stustapay.tse.signature_processor import SignatureProcessor
 from stustapay.tse.simulator import Simulator
 from stustapay.tse.tse_switchover import TseSwitchover
@@ -11,8 +15,16 @@ tse_cli = typer.Typer()
 
 
 @tse_cli.command()
-def signature_processor(ctx: typer.Context):
-    processor = SignatureProcessor(config=ctx.obj.config)
+def signature_processor(
+    ctx: typer.Context,
+    rebalance_latency_factor: Annotated[
+        Optional[float],
+        typer.Option(
+            help="move idle tills away from TSEs signing slower than this factor times the median TSE latency"
+        ),
+    ] = None,
+):
+    processor = SignatureProcessor(config=ctx.obj.config, rebalance_latency_factor=rebalance_latency_factor)
     asyncio.run(processor.run())
 
 
@@ -32,6 +44,18 @@ def simulator(
     ] = None,
     gen_key: Annotated[bool, typer.Option("--gen_key", "-g", help="generate new secret key")] = False,
     broken: Annotated[bool, typer.Option("--broken", "-b", help="simulator with error")] = False,
+    n_tses: Annotated[
+        int, typer.Option("--n-tses", help="number of virtual TSEs, TSE i is served at ws://host:port/i")
+    ] = 1,
+    latency_distribution: Annotated[
+        LatencyDistributionType, typer.Option(help="distribution of the artificial signature delay")
+    ] = LatencyDistributionType.fixed,
+    latency_spread: Annotated[float, typer.Option(help="spread of the artificial signature delay")] = 0.0,
+    failure_rate: Annotated[float, typer.Option(help="probability of an injected signing failure")] = 0.0,
+    disconnect_rate: Annotated[float, typer.Option(help="probability of an injected disconnect after signing")] = 0.0,
+    fast_sign: Annotated[
+        bool, typer.Option(help="sign with the OpenSSL backend of cryptography instead of python ecdsa")
+    ] = False,
 ):
     sim = Simulator(
         host,
@@ -42,6 +66,11 @@ def simulator(
         secret_key,
         gen_key,
         broken,
+        n_tses=n_tses,
+        latency=LatencyDistribution(type=latency_distribution, mean=delay, spread=latency_spread),
+        failure_rate=failure_rate,
+        disconnect_rate=disconnect_rate,
+        fast_sign=fast_sign,
     )
     asyncio.run(sim.run())
 
@@ -0,0 +1,36 @@
+"""
+helpers for http caching with entity tags.
+"""
+
+from typing import Annotated, Optional
+
+from fastapi import Header, Response, status
+
+IfNoneMatch = Annotated[Optional[str], Header()]
+
+# for responses which never change once they exist
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Check whether an If-None-Match request header matches the given (strong, quoted) entity tag.
+    """
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def json_response_with_etag(
+    body: bytes, etag: str, if_none_match: str | None, cache_control: str | None = None
+) -> Response:
+    """
+    Respond with an already serialized json body, or with 304 Not Modified if the client has it already.
+    """
+    headers = {"ETag": etag}
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
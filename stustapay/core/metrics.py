@@ -0,0 +1,188 @@
+"""
+Minimal in-process metrics (counters, gauges and histograms) for the background services.
+
+The metrics of a process are periodically written as a json snapshot next to the healthcheck status files.
+"""
+
+import asyncio
+import bisect
+import logging
+import traceback
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from pydantic import BaseModel
+
+from stustapay.core.healthcheck import get_healthcheck_dir
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str | int]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class MetricSample(BaseModel):
+    labels: dict[str, str]
+    value: float
+
+
+class HistogramSample(BaseModel):
+    labels: dict[str, str]
+    count: int
+    sum: float
+    # upper bucket bound -> cumulative number of observations
+    buckets: dict[str, int]
+
+
+class Metric(BaseModel):
+    name: str
+    type: str
+    help: str
+    samples: list[MetricSample] = []
+    histogram_samples: list[HistogramSample] = []
+
+
+class MetricsSnapshot(BaseModel):
+    timestamp: str
+    service_name: str
+    metrics: list[Metric]
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str | int):
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> Metric:
+        return Metric(
+            name=self.name,
+            type="counter",
+            help=self.help,
+            samples=[MetricSample(labels=dict(key), value=value) for key, value in self._values.items()],
+        )
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels: str | int):
+        self._values[_labels(labels)] = value
+
+    def clear(self):
+        self._values.clear()
+
+    def snapshot(self) -> Metric:
+        metric = super().snapshot()
+        metric.type = "gauge"
+        return metric
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        # per label set: observations per bucket (the last one counts values above the largest bound), count, sum
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str | int):
+        key = _labels(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0, 0.0])
+        bucket_counts, totals = self._values[key]
+        bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += 1
+        totals[1] += value
+
+    def snapshot(self) -> Metric:
+        samples = []
+        for key, (bucket_counts, totals) in self._values.items():
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets, bucket_counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            buckets["+Inf"] = int(totals[0])
+            samples.append(HistogramSample(labels=dict(key), count=int(totals[0]), sum=totals[1], buckets=buckets))
+        return Metric(name=self.name, type="histogram", help=self.help, histogram_samples=samples)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"metric {metric.name} is already registered with a different type")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def snapshot(self, service_name: str) -> MetricsSnapshot:
+        return MetricsSnapshot(
+            timestamp=datetime.now().isoformat(),
+            service_name=service_name,
+            metrics=[metric.snapshot() for metric in self._metrics.values()],
+        )
+
+
+# metrics registry of this process
+METRICS = MetricsRegistry()
+
+
+def write_metrics_snapshot(registry: MetricsRegistry, metrics_dir: Path, service_name: str):
+    snapshot_file_name = metrics_dir / f"{service_name}.metrics.json"
+    snapshot_file_name.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file_name = snapshot_file_name.with_suffix(".tmp")
+    with tmp_file_name.open("w+") as f:
+        f.write(registry.snapshot(service_name).model_dump_json())
+    tmp_file_name.replace(snapshot_file_name)
+
+
+async def run_metrics_snapshots(
+    service_name: str,
+    collect: Optional[Callable[[], Awaitable[None]]] = None,
+    registry: MetricsRegistry = METRICS,
+    interval: float = 10,
+):
+    """
+    Periodically writes a snapshot of all metrics of this process next to the healthcheck status files.
+    collect is awaited before every snapshot to update gauges which are sampled instead of tracked.
+    """
+    try:
+        metrics_dir = get_healthcheck_dir()
+    except:  # pylint: disable=bare-except
+        logging.error(f"An unexpected error while trying to obtain the metrics output dir {traceback.format_exc()}")
+        return
+
+    try:
+        while True:
+            try:
+                if collect is not None:
+                    await collect()
+                write_metrics_snapshot(registry, metrics_dir=metrics_dir, service_name=service_name)
+            except:  # pylint: disable=bare-except
+                logging.error(f"An unexpected error occured while writing metrics {traceback.format_exc()}")
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        return
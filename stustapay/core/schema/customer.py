@@ -5,7 +5,7 @@ from typing import Optional
 from pydantic import BaseModel
 
 from stustapay.core.schema.account import Account
-from stustapay.core.schema.order import Order
+from stustapay.core.schema.order import Order, OrderType, PaymentMethod
 from stustapay.core.schema.payout import Payout
 from stustapay.payment.sumup.api import SumUpCheckoutStatus
 
@@ -32,6 +32,31 @@ class OrderWithBon(Order):
     bon_generated: Optional[bool]
 
 
+class CustomerOrder(BaseModel):
+    """
+    compact representation of an order in the order history of a customer, without line items
+    """
+
+    id: int
+    uuid: uuid.UUID
+    booked_at: datetime.datetime
+    payment_method: PaymentMethod
+    order_type: OrderType
+    cancels_order: Optional[int]
+
+    total_price: float
+    total_tax: float
+    total_no_tax: float
+
+    bon_generated: bool
+
+
+class CustomerOrderPage(BaseModel):
+    orders: list[CustomerOrder]
+    # cursor of the next page, None if there are no more orders
+    next_cursor: Optional[int]
+
+
 class PayoutTransaction(BaseModel):
     amount: float
     booked_at: datetime.datetime
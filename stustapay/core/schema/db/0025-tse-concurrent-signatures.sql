@@ -0,0 +1,6 @@
+-- migration: 5d3b8e21
+-- requires: 706ba453
+
+-- number of signature requests for different tills that may be in flight on a TSE at the same time
+alter table tse add column max_concurrent_signatures int not null default 1
+    constraint max_concurrent_signatures_positive check (max_concurrent_signatures >= 1);
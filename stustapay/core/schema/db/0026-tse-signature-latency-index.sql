@@ -0,0 +1,5 @@
+-- migration: 9a61c0f4
+-- requires: 5d3b8e21
+
+-- used to compute the rolling signing latency per TSE
+create index on tse_signature (tse_id, id) where signature_status = 'done';
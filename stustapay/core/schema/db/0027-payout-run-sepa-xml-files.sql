@@ -0,0 +1,5 @@
+-- migration: 3e8a51c7
+-- requires: 9a61c0f4
+
+-- large payout runs are exported as multiple sepa xml files with a bounded number of transactions each
+alter table payout_run alter column sepa_xml type text[] using case when sepa_xml is null then null else array[sepa_xml] end;
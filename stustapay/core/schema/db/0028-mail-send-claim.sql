@@ -0,0 +1,7 @@
+-- migration: 6b0d2f93
+-- requires: 3e8a51c7
+
+-- mails are claimed in batches by the senders, a claim expires if the sender does not finish sending in time
+alter table mails add column send_claimed_until timestamp;
+
+create index on mails (scheduled_send_date) where send_date is null;
@@ -0,0 +1,5 @@
+-- migration: 9c4e1a57
+-- requires: 6b0d2f93
+
+-- the sumup checkout poller only ever looks at pending checkouts
+create index on customer_sumup_checkout (customer_account_id) where status = 'PENDING';
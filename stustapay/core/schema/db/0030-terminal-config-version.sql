@@ -0,0 +1,9 @@
+-- migration: 5e2b7d18
+-- requires: 9c4e1a57
+
+-- bumped by triggers whenever anything which is part of the config of a terminal changes,
+-- terminals without an entry have version 0
+create table terminal_config_version (
+    terminal_id bigint primary key references terminal(id) on delete cascade,
+    version bigint not null default 0
+);
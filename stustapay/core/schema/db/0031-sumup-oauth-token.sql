@@ -0,0 +1,12 @@
+-- migration: a71f3c92
+-- requires: 5e2b7d18
+
+-- sumup oauth access tokens, shared by all terminal server processes
+create table sumup_oauth_token (
+    event_id bigint primary key references event(id) on delete cascade,
+    access_token text not null,
+    refresh_token text not null,
+    token_type text not null,
+    expires_in bigint not null,
+    expires_at timestamptz not null
+);
@@ -0,0 +1,26 @@
+-- migration: 3d8f6a21
+-- requires: a71f3c92
+
+-- hex representation of the tag uid as shown in the ui, so it can be searched without recomputing it for every row
+alter table user_tag add column uid_hex text generated always as (to_hex(uid::bigint)) stored;
+
+-- search hits on tags are joined back to their account
+create index on account (user_tag_id);
+
+-- trigram indices speed up the substring searches of the administration ui.
+-- pg_trgm ships with the postgres contrib package, if it is not installed the searches fall back to a sequential scan.
+do $$
+begin
+    if exists (select from pg_available_extensions where name = 'pg_trgm') then
+        create extension if not exists pg_trgm;
+
+        create index account_name_trgm_idx on account using gin (lower(name) gin_trgm_ops);
+        create index account_comment_trgm_idx on account using gin (lower(comment) gin_trgm_ops);
+        create index user_tag_pin_trgm_idx on user_tag using gin (lower(pin) gin_trgm_ops);
+        create index user_tag_uid_hex_trgm_idx on user_tag using gin (uid_hex gin_trgm_ops);
+        create index customer_info_email_trgm_idx on customer_info using gin (lower(email) gin_trgm_ops);
+        create index customer_info_iban_trgm_idx on customer_info using gin (lower(iban) gin_trgm_ops);
+        create index customer_info_account_name_trgm_idx on customer_info using gin (lower(account_name) gin_trgm_ops);
+    end if;
+end
+$$;
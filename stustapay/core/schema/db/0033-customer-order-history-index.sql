@@ -0,0 +1,5 @@
+-- migration: 01c972a8
+-- requires: 3d8f6a21
+
+-- keyset pagination of the order history in the customer portal
+create index on ordr (customer_account_id, booked_at, id);
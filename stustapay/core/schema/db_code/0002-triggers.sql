@@ -423,7 +423,7 @@ begin
     -- send general notifications, used e.g. for instant UI updates
     perform pg_notify('order',
                       json_build_object('order_id', NEW.id, 'order_uuid', NEW.uuid, 'cashier_id', NEW.cashier_id,
-                                        'till_id', NEW.till_id)::text);
+                                        'till_id', NEW.till_id, 'customer_account_id', NEW.customer_account_id)::text);
 
     return NEW;
 end;
@@ -446,6 +446,28 @@ end;
 $$ language plpgsql
     set search_path = "$user", public;
 
+-- the bon of an order became available, e.g. for the order history of the customer
+create or replace function bon_generated_trigger_procedure() returns trigger as
+$$
+begin
+    perform pg_notify('order',
+                      (select json_build_object('order_id', o.id, 'order_uuid', o.uuid, 'cashier_id', o.cashier_id,
+                                                'till_id', o.till_id, 'customer_account_id', o.customer_account_id,
+                                                'bon_generated', true)
+                       from ordr o where o.id = NEW.id)::text);
+    return NEW;
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists bon_generated_trigger on bon;
+create trigger bon_generated_trigger
+    after update of bon_json
+    on bon
+    for each row
+    when (OLD.bon_json is null and NEW.bon_json is not null)
+execute function bon_generated_trigger_procedure();
+
 drop trigger if exists tse_signature_update_trigger on tse_signature;
 create trigger tse_signature_update_trigger
     before update
@@ -562,3 +584,308 @@ create trigger create_customer_info_trigger
     for each row
     when (NEW.type = 'private')
 execute function create_customer_info();
+
+-- notify the mail senders about new mails, once per statement to keep bulk inserts cheap
+create or replace function mails_inserted_trigger_procedure() returns trigger as
+$$
+begin
+    perform pg_notify('mail', '');
+    return null;
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists mails_inserted_trigger on mails;
+create trigger mails_inserted_trigger
+    after insert
+    on mails
+    for each statement
+execute function mails_inserted_trigger_procedure();
+
+-- terminal configs are cached as long as their version does not change
+create or replace function bump_terminal_config_version(terminal_ids bigint[]) returns void as
+$$
+    insert into terminal_config_version (terminal_id, version)
+    select t.id, 1 from terminal t where t.id = any(terminal_ids)
+    on conflict (terminal_id) do update set version = terminal_config_version.version + 1;
+$$ language sql
+    set search_path = "$user", public;
+
+-- terminals or tills which are located at the given node or below it
+create or replace function terminals_in_subtree(node_id bigint) returns bigint[] as
+$$
+    select array(
+        select t.id
+        from terminal t join node n on t.node_id = n.id
+        where n.id = terminals_in_subtree.node_id or terminals_in_subtree.node_id = any(n.parent_ids)
+        union
+        select t.terminal_id
+        from till t join node n on t.node_id = n.id
+        where t.terminal_id is not null
+            and (n.id = terminals_in_subtree.node_id or terminals_in_subtree.node_id = any(n.parent_ids))
+    );
+$$ language sql
+    stable
+    set search_path = "$user", public;
+
+-- terminals whose till uses the given layout
+create or replace function terminals_with_layout(layout_ids bigint[]) returns bigint[] as
+$$
+    select array(
+        select t.terminal_id
+        from till t join till_profile tp on t.active_profile_id = tp.id
+        where tp.layout_id = any(layout_ids) and t.terminal_id is not null
+    );
+$$ language sql
+    stable
+    set search_path = "$user", public;
+
+-- terminals whose config depends on a row of the given table
+create or replace function terminals_affected_by_config_change(table_name text, r jsonb) returns bigint[] as
+$$
+begin
+    case table_name
+        when 'terminal' then
+            return array[(r->>'id')::bigint];
+        when 'till' then
+            return array_remove(array[(r->>'terminal_id')::bigint], null);
+        when 'till_profile' then
+            return array(
+                select t.terminal_id from till t
+                where t.active_profile_id = (r->>'id')::bigint and t.terminal_id is not null
+            );
+        when 'till_layout_to_button', 'till_layout_to_ticket' then
+            return terminals_with_layout(array[(r->>'layout_id')::bigint]);
+        when 'till_button' then
+            return terminals_with_layout(array(
+                select tltb.layout_id from till_layout_to_button tltb where tltb.button_id = (r->>'id')::bigint
+            ));
+        when 'till_button_product' then
+            return terminals_with_layout(array(
+                select tltb.layout_id from till_layout_to_button tltb where tltb.button_id = (r->>'button_id')::bigint
+            ));
+        when 'product' then
+            return terminals_with_layout(array(
+                select tltb.layout_id
+                from till_layout_to_button tltb join till_button_product tbp on tltb.button_id = tbp.button_id
+                where tbp.product_id = (r->>'id')::bigint
+            ));
+        when 'cash_register' then
+            return array(
+                select t.terminal_id from till t
+                where t.active_cash_register_id = (r->>'id')::bigint and t.terminal_id is not null
+            );
+        when 'user_to_role' then
+            return array(select t.id from terminal t where t.active_user_id = (r->>'user_id')::bigint);
+        when 'user_role_to_privilege' then
+            return terminals_in_subtree((select ur.node_id from user_role ur where ur.id = (r->>'role_id')::bigint));
+        when 'event' then
+            return terminals_in_subtree((select n.id from node n where n.event_id = (r->>'id')::bigint));
+        when 'sumup_oauth_token' then
+            return terminals_in_subtree((select n.id from node n where n.event_id = (r->>'event_id')::bigint));
+        when 'node' then
+            return terminals_in_subtree((r->>'id')::bigint);
+        else
+            -- user_role, user_tag_secret
+            return terminals_in_subtree((r->>'node_id')::bigint);
+    end case;
+end
+$$ language plpgsql
+    stable
+    set search_path = "$user", public;
+
+create or replace function terminal_config_changed() returns trigger as
+$$
+<<locals>> declare
+    terminal_ids bigint[] := '{}';
+begin
+    if TG_OP <> 'INSERT' then
+        locals.terminal_ids := terminals_affected_by_config_change(TG_TABLE_NAME, to_jsonb(OLD));
+    end if;
+    if TG_OP <> 'DELETE' then
+        locals.terminal_ids := locals.terminal_ids || terminals_affected_by_config_change(TG_TABLE_NAME, to_jsonb(NEW));
+    end if;
+    perform bump_terminal_config_version(locals.terminal_ids);
+    return null;
+end
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists terminal_config_changed_trigger on terminal;
+create trigger terminal_config_changed_trigger
+    after update of name, description, node_id, active_user_id, active_user_role_id
+    on terminal
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till;
+create trigger terminal_config_changed_trigger
+    after insert or delete or update of name, description, node_id, terminal_id, active_profile_id, active_cash_register_id
+    on till
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till_profile;
+create trigger terminal_config_changed_trigger
+    after update
+    on till_profile
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till_layout_to_button;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on till_layout_to_button
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till_layout_to_ticket;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on till_layout_to_ticket
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till_button;
+create trigger terminal_config_changed_trigger
+    after update
+    on till_button
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on till_button_product;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on till_button_product
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on product;
+create trigger terminal_config_changed_trigger
+    after update
+    on product
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on cash_register;
+create trigger terminal_config_changed_trigger
+    after update of name
+    on cash_register
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on user_to_role;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on user_to_role
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on user_role;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on user_role
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on user_role_to_privilege;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on user_role_to_privilege
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on user_tag_secret;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on user_tag_secret
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on event;
+create trigger terminal_config_changed_trigger
+    after update
+    on event
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on node;
+create trigger terminal_config_changed_trigger
+    after update of name, parent, event_id, read_only
+    on node
+    for each row
+execute function terminal_config_changed();
+
+drop trigger if exists terminal_config_changed_trigger on sumup_oauth_token;
+create trigger terminal_config_changed_trigger
+    after insert or update or delete
+    on sumup_oauth_token
+    for each row
+execute function terminal_config_changed();
+
+-- the administration caches the tree with privileges seen by each user, notify it on any change to nodes,
+-- events or roles
+create or replace function tree_changed_trigger_procedure() returns trigger as
+$$
+begin
+    perform pg_notify('tree', '');
+    return null;
+end;
+$$ language plpgsql
+    set search_path = "$user", public;
+
+drop trigger if exists tree_changed_trigger on node;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on node
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on event;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on event
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on translation_text;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on translation_text
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on forbidden_objects_at_node;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on forbidden_objects_at_node
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on forbidden_objects_in_subtree_at_node;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on forbidden_objects_in_subtree_at_node
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on user_to_role;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on user_to_role
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on user_role;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on user_role
+    for each statement
+execute function tree_changed_trigger_procedure();
+
+drop trigger if exists tree_changed_trigger on user_role_to_privilege;
+create trigger tree_changed_trigger
+    after insert or update or delete
+    on user_role_to_privilege
+    for each statement
+execute function tree_changed_trigger_procedure();
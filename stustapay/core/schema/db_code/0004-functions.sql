@@ -156,3 +156,23 @@ $$ language sql
     stable
     security invoker
     set search_path = "$user", public;
+
+-- ranks how well a text column matches an already lowercased search term:
+-- 3 for an exact match, 2 for a prefix match, 1 if it is contained, 0 otherwise
+create or replace function search_rank(
+    value text,
+    term text
+) returns int as
+$$
+select
+    case
+        when value is null then 0
+        when lower(value) = term then 3
+        when starts_with(lower(value), term) then 2
+        when strpos(lower(value), term) > 0 then 1
+        else 0
+    end;
+$$ language sql
+    immutable
+    security invoker
+    set search_path = "$user", public;
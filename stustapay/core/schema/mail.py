@@ -21,3 +21,14 @@ class Mail(BaseModel):
     send_date: datetime | None
     scheduled_send_date: datetime
     attachments: list[MailAttachment]
+
+
+class MailMetadata(BaseModel):
+    """A claimed mail without its content, which is only loaded when the mail is sent"""
+
+    id: int
+    node_id: int
+    to_addr: str
+    scheduled_send_date: datetime
+    n_attachments: int
+    attachments_size: int
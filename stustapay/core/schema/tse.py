@@ -20,11 +20,14 @@ class UpdateTse(BaseModel):
     ws_url: str
     ws_timeout: float
     password: str
+    # left unchanged on updates if not given
+    max_concurrent_signatures: Optional[int] = None
 
 
 class NewTse(UpdateTse):
     type: TseType
     serial: Optional[str]
+    max_concurrent_signatures: int = 1
 
 
 class Tse(NewTse):
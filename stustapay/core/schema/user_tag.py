@@ -18,3 +18,7 @@ class NewUserTag(BaseModel):
     pin: str
     restriction: ProductRestriction | None = None
     secret_id: int
+
+
+class UserTagImportResult(BaseModel):
+    n_imported: int
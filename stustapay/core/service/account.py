@@ -17,6 +17,11 @@ from stustapay.core.service.common.decorators import (
     requires_user,
 )
 from stustapay.core.service.common.error import InvalidArgument, NotFound
+from stustapay.core.service.common.search import (
+    SEARCH_RESULT_LIMIT,
+    contains_pattern,
+    normalize_search_term,
+)
 from stustapay.core.service.customer.common import fetch_customer
 from stustapay.core.service.transaction import book_transaction
 
@@ -85,20 +90,36 @@ class AccountService(Service[Config]):
     @requires_node(event_only=True)
     @requires_user([Privilege.node_administration, Privilege.customer_management])
     async def find_customers(self, *, conn: Connection, node: Node, search_term: str) -> list[Customer]:
+        term = normalize_search_term(search_term)
+        # first collect the ids of the best matches from the base tables, only hydrate those via the customer view
         return await conn.fetch_many(
             Customer,
-            "select c.* from customer c "
-            "where c.node_id = any ($2) and "
-            "   (c.name like $1 "
-            "   or c.comment like $1 "
-            "   or (c.user_tag_pin is not null and lower(c.user_tag_pin) like $1) "
-            "   or (c.user_tag_uid is not null and to_hex(c.user_tag_uid::bigint) like $1) "
-            "   or lower(c.email) like $1 "
-            "   or c.account_name @@ $3 "
-            "   or lower(c.iban) like $1)",
-            f"%{search_term.lower()}%",
+            "with matches as ( "
+            "   select a.id, greatest(search_rank(a.name, $1), search_rank(a.comment, $1)) as rank "
+            "   from account a where lower(a.name) like $2 or lower(a.comment) like $2 "
+            "   union all "
+            "   select a.id, greatest(search_rank(ut.pin, $1), search_rank(ut.uid_hex, $1)) as rank "
+            "   from user_tag ut join account a on a.user_tag_id = ut.id "
+            "   where lower(ut.pin) like $2 or ut.uid_hex like $2 "
+            "   union all "
+            "   select ci.customer_account_id as id, "
+            "       greatest(search_rank(ci.email, $1), search_rank(ci.iban, $1), search_rank(ci.account_name, $1)) "
+            "       as rank "
+            "   from customer_info ci "
+            "   where lower(ci.email) like $2 or lower(ci.iban) like $2 or lower(ci.account_name) like $2 "
+            "), ranked as ( "
+            "   select m.id, max(m.rank) as rank "
+            "   from matches m join account a on a.id = m.id "
+            "   where a.type = 'private' and a.node_id = any($3) "
+            "   group by m.id "
+            "   order by rank desc, m.id "
+            "   limit $4 "
+            ") "
+            "select c.* from ranked r join customer c on c.id = r.id order by r.rank desc, r.id",
+            term,
+            contains_pattern(term),
             node.ids_to_root,
-            search_term.lower(),
+            SEARCH_RESULT_LIMIT,
         )
 
     @with_db_transaction(read_only=True)
@@ -130,16 +151,29 @@ class AccountService(Service[Config]):
     @requires_node(event_only=True)
     @requires_user([Privilege.node_administration])
     async def find_accounts(self, *, conn: Connection, node: Node, search_term: str) -> list[Account]:
+        term = normalize_search_term(search_term)
         return await conn.fetch_many(
             Account,
-            "select * from account_with_history a "
-            "where a.node_id = any ($2) and "
-            "   (a.name like $1 "
-            "   or a.comment like $1 "
-            "   or (a.user_tag_pin is not null and a.user_tag_pin like $1)) "
-            "   or (a.user_tag_uid is not null and to_hex(a.user_tag_uid::bigint) like $1) ",
-            f"%{search_term.lower()}%",
+            "with matches as ( "
+            "   select a.id, greatest(search_rank(a.name, $1), search_rank(a.comment, $1)) as rank "
+            "   from account a where lower(a.name) like $2 or lower(a.comment) like $2 "
+            "   union all "
+            "   select a.id, greatest(search_rank(ut.pin, $1), search_rank(ut.uid_hex, $1)) as rank "
+            "   from user_tag ut join account a on a.user_tag_id = ut.id "
+            "   where lower(ut.pin) like $2 or ut.uid_hex like $2 "
+            "), ranked as ( "
+            "   select m.id, max(m.rank) as rank "
+            "   from matches m join account a on a.id = m.id "
+            "   where a.node_id = any($3) "
+            "   group by m.id "
+            "   order by rank desc, m.id "
+            "   limit $4 "
+            ") "
+            "select a.* from ranked r join account_with_history a on a.id = r.id order by r.rank desc, r.id",
+            term,
+            contains_pattern(term),
             node.ids_to_root,
+            SEARCH_RESULT_LIMIT,
         )
 
     @with_db_transaction
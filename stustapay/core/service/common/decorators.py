@@ -69,7 +69,7 @@ def requires_node(
                 raise RuntimeError("No node_id was passed as an argument. Cannot set current tree node.")
 
             if node is None:
-                node = await fetch_node(conn=conn, node_id=node_id)
+                node = await fetch_node(conn=conn, node_id=node_id, with_translations=False)
                 if node is None:
                     raise RuntimeError(f"Node with id {node_id} does not exist")
 
@@ -287,13 +287,13 @@ def requires_terminal(
             signature_params = signature(func).parameters
             func_is_read_only = _is_func_read_only(kwargs, func)
 
-            event_node = await fetch_event_node_for_node(conn=conn, node_id=terminal.node_id)
+            event_node = await fetch_event_node_for_node(conn=conn, node_id=terminal.node_id, with_translations=False)
             if event_node is None:
                 raise InvalidArgument("Terminals should not be able to be created outside of events")
 
             node: Node | None = event_node
             if till is not None:
-                node = await fetch_node(conn=conn, node_id=till.node_id)
+                node = await fetch_node(conn=conn, node_id=till.node_id, with_translations=False)
             assert node is not None
 
             logged_in_user = await conn.fetch_maybe_one(
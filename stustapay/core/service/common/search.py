@@ -0,0 +1,12 @@
+# maximum number of hits returned by the administration search endpoints
+SEARCH_RESULT_LIMIT = 100
+
+
+def normalize_search_term(search_term: str) -> str:
+    return search_term.strip().lower()
+
+
+def contains_pattern(search_term: str) -> str:
+    """like pattern matching all values containing the normalized search term literally"""
+    escaped = search_term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
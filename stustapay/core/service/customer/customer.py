@@ -1,18 +1,22 @@
 # pylint: disable=unexpected-keyword-arg
 # pylint: disable=unused-argument
+import json
 import logging
 import re
+from collections import OrderedDict
 from typing import Optional
 
 import asyncpg
 from pydantic import BaseModel, EmailStr
 from schwifty import IBAN
-from sftkit.database import Connection
+from sftkit.database import Connection, DatabaseHook
 from sftkit.service import Service, with_db_transaction
 
 from stustapay.core.config import Config
 from stustapay.core.schema.customer import (
     Customer,
+    CustomerOrder,
+    CustomerOrderPage,
     OrderWithBon,
     PayoutInfo,
     PayoutTransaction,
@@ -20,7 +24,7 @@ from stustapay.core.schema.customer import (
 from stustapay.core.schema.tree import Language
 from stustapay.core.service.auth import AuthService, CustomerTokenMetadata
 from stustapay.core.service.common.decorators import requires_customer
-from stustapay.core.service.common.error import AccessDenied, InvalidArgument
+from stustapay.core.service.common.error import AccessDenied, InvalidArgument, NotFound
 from stustapay.core.service.config import ConfigService
 from stustapay.core.service.customer.payout import PayoutService
 from stustapay.core.service.customer.sumup import SumupService
@@ -56,18 +60,73 @@ class CustomerBank(BaseModel):
     donation: float = 0.0
 
 
+async def fetch_customer_orders(
+    conn: Connection, customer_account_id: int, cursor: Optional[int], limit: int
+) -> CustomerOrderPage:
+    cursor_booked_at = None
+    if cursor is not None:
+        cursor_booked_at = await conn.fetchval(
+            "select booked_at from ordr where id = $1 and customer_account_id = $2", cursor, customer_account_id
+        )
+        if cursor_booked_at is None:
+            raise InvalidArgument("Invalid cursor")
+
+    orders = await conn.fetch_many(
+        CustomerOrder,
+        "select "
+        "   o.id, o.uuid, o.booked_at, o.payment_method, o.order_type, o.cancels_order, "
+        "   coalesce(li.total_price, 0) as total_price, "
+        "   coalesce(li.total_tax, 0) as total_tax, "
+        "   coalesce(li.total_price - li.total_tax, 0) as total_no_tax, "
+        "   b.bon_json is not null as bon_generated "
+        "from ordr o "
+        "left join lateral ( "
+        "   select sum(l.total_price) as total_price, sum(l.total_tax) as total_tax "
+        "   from line_item l where l.order_id = o.id "
+        ") li on true "
+        "left join bon b on o.id = b.id "
+        "where o.customer_account_id = $1 and ($2::timestamptz is null or (o.booked_at, o.id) < ($2, $3)) "
+        "order by o.booked_at desc, o.id desc "
+        "limit $4",
+        customer_account_id,
+        cursor_booked_at,
+        cursor,
+        limit + 1,
+    )
+    # one more order than requested is fetched to know whether there is a next page
+    page = orders[:limit]
+    next_cursor = page[-1].id if len(orders) > limit else None
+    return CustomerOrderPage(orders=page, next_cursor=next_cursor)
+
+
 class CustomerService(Service[Config]):
+    CUSTOMER_ORDERS_PAGE_SIZE = 50
+    CUSTOMER_ORDERS_MAX_PAGE_SIZE = 500
+    # number of customers whose order history is cached
+    CUSTOMER_ORDER_CACHE_SIZE = 10000
+
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService, config_service: ConfigService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
         self.config_service = config_service
         self.logger = logging.getLogger("customer")
 
+        # customer account id -> (cursor, limit) -> page of the order history,
+        # only used while we are notified about new orders
+        self.order_cache: OrderedDict[int, dict[tuple[Optional[int], int], CustomerOrderPage]] = OrderedDict()
+        self.order_cache_enabled = False
+        # incremented on every invalidation, histories fetched concurrently to an invalidation are not cached
+        self.order_cache_generation = 0
+
         self.sumup = SumupService(db_pool=db_pool, config=config, auth_service=auth_service)
         self.payout = PayoutService(
             db_pool=db_pool, config=config, auth_service=auth_service, config_service=config_service
         )
 
+    async def close(self):
+        await self.sumup.close()
+        await self.payout.close()
+
     @with_db_transaction
     async def login_customer(self, *, conn: Connection, pin: str) -> CustomerLoginSuccess:
         # Customer has hardware tag and pin
@@ -138,6 +197,90 @@ class CustomerService(Service[Config]):
             current_customer.id,
         )
 
+    async def _get_customer_orders(
+        self, *, conn: Connection, customer_account_id: int, cursor: Optional[int], limit: int
+    ) -> CustomerOrderPage:
+        if self.order_cache_enabled:
+            pages = self.order_cache.get(customer_account_id)
+            if pages is not None and (cursor, limit) in pages:
+                self.order_cache.move_to_end(customer_account_id)
+                return pages[(cursor, limit)]
+
+        # read committed, the page is fetched in a new snapshot taken after reading the generation
+        generation = self.order_cache_generation
+        page = await fetch_customer_orders(
+            conn=conn, customer_account_id=customer_account_id, cursor=cursor, limit=limit
+        )
+
+        if self.order_cache_enabled and generation == self.order_cache_generation:
+            self.order_cache.setdefault(customer_account_id, {})[(cursor, limit)] = page
+            self.order_cache.move_to_end(customer_account_id)
+            if len(self.order_cache) > self.CUSTOMER_ORDER_CACHE_SIZE:
+                self.order_cache.popitem(last=False)
+        return page
+
+    @with_db_transaction(read_only=True)
+    @requires_customer
+    async def get_orders(
+        self, *, conn: Connection, current_customer: Customer, cursor: Optional[int] = None, limit: Optional[int] = None
+    ) -> CustomerOrderPage:
+        """
+        Get a page of the order history of the current customer, newest orders first.
+        The cursor is the id of the last order of the previous page.
+        """
+        if limit is None:
+            limit = self.CUSTOMER_ORDERS_PAGE_SIZE
+        if limit < 1 or limit > self.CUSTOMER_ORDERS_MAX_PAGE_SIZE:
+            raise InvalidArgument(f"The page size must be between 1 and {self.CUSTOMER_ORDERS_MAX_PAGE_SIZE}")
+
+        return await self._get_customer_orders(
+            conn=conn, customer_account_id=current_customer.id, cursor=cursor, limit=limit
+        )
+
+    @with_db_transaction(read_only=True)
+    @requires_customer
+    async def get_order_with_bon(self, *, conn: Connection, current_customer: Customer, order_id: int) -> OrderWithBon:
+        order = await conn.fetch_maybe_one(
+            OrderWithBon,
+            "select o.*, b.bon_json is not null as bon_generated "
+            "from order_value_prefiltered(array[$1]::bigint[]) o left join bon b on o.id = b.id "
+            "where o.customer_account_id = $2",
+            order_id,
+            current_customer.id,
+        )
+        if order is None:
+            raise NotFound(element_type="order", element_id=order_id)
+        return order
+
+    async def _on_order_notification(self, payload: Optional[str]):
+        self.order_cache_generation += 1
+        if payload is None:
+            # (re)connected, notifications might have been missed in between
+            self.order_cache.clear()
+            self.order_cache_enabled = True
+            return
+
+        try:
+            customer_account_id = json.loads(payload).get("customer_account_id")
+        except ValueError:
+            self.logger.warning(f"Received invalid order notification {payload}")
+            self.order_cache.clear()
+            return
+        if customer_account_id is not None:
+            self.order_cache.pop(customer_account_id, None)
+
+    async def run_order_cache_invalidation(self):
+        """
+        Keep the order histories of customers cached, as orders are immutable they only change on new orders
+        or generated bons, which are notified on the order channel.
+        """
+        hook = DatabaseHook(self.db_pool, "order", self._on_order_notification, initial_run=True)
+        try:
+            await hook.run()
+        finally:
+            self.order_cache_enabled = False
+            self.order_cache.clear()
+
     @with_db_transaction(read_only=True)
     @requires_customer
     async def get_payout_transactions(self, *, conn: Connection, current_customer: Customer) -> list[PayoutTransaction]:
@@ -1,7 +1,13 @@
+import asyncio
 import csv
 import datetime
+import functools
 import io
+import multiprocessing
+import os
 import re
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 import asyncpg
 from schwifty import IBAN
@@ -115,46 +121,52 @@ def dump_payout_run_as_csv(
     return output.getvalue()
 
 
-def dump_payout_run_as_sepa_xml(
-    payouts: list[Payout],
-    currency_ident: str,
-    sepa_config: SEPAConfig,
-    execution_date: datetime.date,
-) -> str:
-    if len(payouts) == 0:
-        raise InvalidArgument("No customers with bank data found. Nothing to export.")
+SEPA_DESCRIPTION_PATTERN = re.compile(r"^[a-zA-Z0-9 \-.,:()/?'+]*$")
+# payouts fetched per round trip while streaming a payout run into sepa xml files
+SEPA_PAYOUT_CURSOR_PREFETCH = 1000
+
+# customer_account_id, account_name, iban, amount, user_tag_uid
+SepaPayout = tuple[int, str | None, str | None, float, int]
 
-    batch = payouts
+
+def _sepa_sender_config(sepa_config: SEPAConfig, currency_ident: str, execution_date: datetime.date) -> dict:
     iban = IBAN(sepa_config.sender_iban)
     config = {
         "name": sepa_config.sender_name,
         "IBAN": iban.compact,
         "BIC": str(iban.bic),
-        "batch": len(batch) > 1,
         "currency": currency_ident,  # ISO 4217
     }
-    sepa = SepaTransfer(config, clean=True)
     if config["BIC"] == "None":
         raise ValueError("Sender BIC couldn't calculated correctly from given IBAN")
     if execution_date < datetime.date.today():
         raise ValueError("Execution date cannot be in the past")
+    return config
+
 
-    for customer in batch:
-        assert customer.iban is not None
+def dump_sepa_xml_file(
+    sender_config: dict, description: str, execution_date: datetime.date, payouts: list[SepaPayout]
+) -> str:
+    """
+    Build and validate a single sepa xml file, this is cpu heavy and runs in worker processes for large payout runs.
+    """
+    sepa = SepaTransfer(dict(sender_config, batch=len(payouts) > 1), clean=True)
+    for customer_account_id, account_name, iban, amount, user_tag_uid in payouts:
+        assert iban is not None
         payment = {
-            "name": customer.account_name,
-            "IBAN": IBAN(customer.iban).compact,
-            "amount": round(customer.amount * 100),  # in cents
+            "name": account_name,
+            "IBAN": IBAN(iban).compact,
+            "amount": round(amount * 100),  # in cents
             "execution_date": execution_date,
-            "description": sepa_config.description.format(user_tag_uid=format_user_tag_uid(customer.user_tag_uid)),
+            "description": description.format(user_tag_uid=format_user_tag_uid(user_tag_uid)),
         }
 
-        if not re.match(r"^[a-zA-Z0-9 \-.,:()/?'+]*$", payment["description"]):  # type: ignore
+        if not SEPA_DESCRIPTION_PATTERN.match(payment["description"]):  # type: ignore
             raise ValueError(
-                f"Description contains invalid characters: {payment['description']}, id: {customer.customer_account_id}"
+                f"Description contains invalid characters: {payment['description']}, id: {customer_account_id}"
             )
         if payment["amount"] <= 0:  # type: ignore
-            raise ValueError(f"Amount must be greater than 0: {payment['amount']}, id: {customer.customer_account_id}")
+            raise ValueError(f"Amount must be greater than 0: {payment['amount']}, id: {customer_account_id}")
 
         sepa.add_payment(payment)
 
@@ -162,11 +174,153 @@ def dump_payout_run_as_sepa_xml(
     return sepa_xml.decode("utf-8")
 
 
+def dump_payout_run_as_sepa_xml(
+    payouts: list[Payout],
+    currency_ident: str,
+    sepa_config: SEPAConfig,
+    execution_date: datetime.date,
+) -> str:
+    if len(payouts) == 0:
+        raise InvalidArgument("No customers with bank data found. Nothing to export.")
+
+    sender_config = _sepa_sender_config(sepa_config, currency_ident, execution_date)
+    return dump_sepa_xml_file(
+        sender_config,
+        sepa_config.description,
+        execution_date,
+        [(p.customer_account_id, p.account_name, p.iban, p.amount, p.user_tag_uid) for p in payouts],
+    )
+
+
+async def dump_payout_run_as_sepa_xml_files(
+    conn: Connection,
+    executor: Executor,
+    payout_run_id: int,
+    currency_ident: str,
+    sepa_config: SEPAConfig,
+    execution_date: datetime.date,
+    max_transactions_per_file: int | None = None,
+) -> list[str]:
+    """
+    Stream the payouts of a payout run into sepa xml files of at most max_transactions_per_file transactions each.
+    The files are generated and validated concurrently in the given executor.
+    """
+    if max_transactions_per_file is not None and max_transactions_per_file <= 0:
+        raise InvalidArgument("Max number of transactions per sepa xml file must be larger than zero")
+
+    sender_config = _sepa_sender_config(sepa_config, currency_ident, execution_date)
+    n_payouts = await conn.fetchval(
+        "select count(*) from payout_view where payout_run_id = $1 and round(amount, 2) > 0", payout_run_id
+    )
+    if n_payouts == 0:
+        raise InvalidArgument("No customers with bank data found. Nothing to export.")
+    file_size = min(n_payouts, max_transactions_per_file or n_payouts)
+
+    async def files():
+        payouts: list[SepaPayout] = []
+        async for row in conn.cursor(
+            "select customer_account_id, account_name, iban, amount, user_tag_uid from payout_view "
+            "where payout_run_id = $1 and round(amount, 2) > 0 "
+            "order by customer_account_id asc",
+            payout_run_id,
+            prefetch=SEPA_PAYOUT_CURSOR_PREFETCH,
+        ):
+            payouts.append(
+                (
+                    row["customer_account_id"],
+                    row["account_name"],
+                    row["iban"],
+                    float(row["amount"]),
+                    int(row["user_tag_uid"]),
+                )
+            )
+            if len(payouts) == file_size:
+                yield payouts
+                payouts = []
+        if payouts:
+            yield payouts
+
+    loop = asyncio.get_running_loop()
+    futures: list[asyncio.Future[str]] = []
+    try:
+        async for payouts in files():
+            futures.append(
+                loop.run_in_executor(
+                    executor, dump_sepa_xml_file, sender_config, sepa_config.description, execution_date, payouts
+                )
+            )
+        return await asyncio.gather(*futures)
+    finally:
+        # if one file fails the others are not needed anymore, files which are not being generated yet are dropped
+        for future in futures:
+            future.cancel()
+
+
+def sepa_xml_files_as_zip(payout_run_id: int, sepa_xml_files: list[str]) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for i, sepa_xml in enumerate(sepa_xml_files):
+            zf.writestr(f"sepa__run_{payout_run_id}__{i + 1:04d}_of_{len(sepa_xml_files):04d}.xml", sepa_xml)
+    return output.getvalue()
+
+
+async def generate_payout_run_sepa_xml_files(
+    *,
+    conn: Connection,
+    executor: Executor,
+    node: Node,
+    payout_run_id: int,
+    execution_date: datetime.date,
+    max_transactions_per_file: int | None,
+) -> list[str]:
+    event_node = await fetch_event_node_for_node(conn=conn, node_id=node.id)
+    assert event_node is not None
+    assert event_node.event is not None
+    sepa_config = event_node.event.sepa_config
+    if sepa_config is None:
+        raise InvalidArgument("SEPA payout is disabled for this event")
+    sepa_xml_files = await dump_payout_run_as_sepa_xml_files(
+        conn=conn,
+        executor=executor,
+        payout_run_id=payout_run_id,
+        sepa_config=sepa_config,
+        currency_ident=event_node.event.currency_identifier,
+        execution_date=execution_date,
+        max_transactions_per_file=max_transactions_per_file,
+    )
+
+    await conn.execute("update payout_run set sepa_xml = $1 where id = $2", sepa_xml_files, payout_run_id)
+
+    return sepa_xml_files
+
+
+async def fetch_payout_run_sepa_xml_files(conn: Connection, node: Node, payout_run_id: int) -> list[str]:
+    row = await conn.fetchrow(
+        "select id, sepa_xml from payout_run where id = $1 and node_id = $2", payout_run_id, node.id
+    )
+    if row is None:
+        raise NotFound(element_id=payout_run_id, element_type="payout_run")
+    if row["sepa_xml"] is None:
+        raise InvalidArgument("SEPA xml has not been generated for this payout run yet")
+
+    return row["sepa_xml"]
+
+
 class PayoutService(Service[Config]):
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService, config_service: ConfigService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
         self.config_service = config_service
+        # generates and validates sepa xml files, its worker processes are only started when they are needed
+        self.sepa_executor = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    async def close(self):
+        # waiting for the workers to exit must not block the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.sepa_executor.shutdown, wait=True, cancel_futures=True)
+        )
 
     @with_db_transaction(read_only=True)
     @requires_node(event_only=True)
@@ -213,30 +367,36 @@ class PayoutService(Service[Config]):
         payout_run_id: int,
         execution_date: datetime.date,
     ) -> str:
-        event_node = await fetch_event_node_for_node(conn=conn, node_id=node.id)
-        assert event_node is not None
-        assert event_node.event is not None
-        sepa_config = event_node.event.sepa_config
-        if sepa_config is None:
-            raise InvalidArgument("SEPA payout is disabled for this event")
-        payouts = await conn.fetch_many(
-            Payout,
-            "select * from payout_view "
-            "where payout_run_id = $1 and round(amount, 2) > 0 "
-            "order by customer_account_id asc",
-            payout_run_id,
-        )
-        currency_identifier = event_node.event.currency_identifier
-        sepa_xml = dump_payout_run_as_sepa_xml(
-            payouts=payouts,
-            sepa_config=sepa_config,
-            currency_ident=currency_identifier,
+        sepa_xml_files = await generate_payout_run_sepa_xml_files(
+            conn=conn,
+            executor=self.sepa_executor,
+            node=node,
+            payout_run_id=payout_run_id,
             execution_date=execution_date,
+            max_transactions_per_file=None,
         )
+        return sepa_xml_files[0]
 
-        await conn.execute("update payout_run set sepa_xml = $1 where id = $2", sepa_xml, payout_run_id)
-
-        return sepa_xml
+    @with_db_transaction
+    @requires_node(event_only=True)
+    @requires_user([Privilege.payout_management])
+    async def get_payout_run_sepa_xml_files(
+        self,
+        *,
+        conn: Connection,
+        node: Node,
+        payout_run_id: int,
+        execution_date: datetime.date,
+        max_transactions_per_file: int | None = None,
+    ) -> list[str]:
+        return await generate_payout_run_sepa_xml_files(
+            conn=conn,
+            executor=self.sepa_executor,
+            node=node,
+            payout_run_id=payout_run_id,
+            execution_date=execution_date,
+            max_transactions_per_file=max_transactions_per_file,
+        )
 
     @with_db_transaction(read_only=True)
     @requires_node(event_only=True)
@@ -248,15 +408,22 @@ class PayoutService(Service[Config]):
         node: Node,
         payout_run_id: int,
     ) -> str:
-        row = await conn.fetchrow(
-            "select id, sepa_xml from payout_run where id = $1 and node_id = $2", payout_run_id, node.id
-        )
-        if row is None:
-            raise NotFound(element_id=payout_run_id, element_type="payout_run")
-        if row["sepa_xml"] is None:
-            raise InvalidArgument("SEPA xml has not been generated for this payout run yet")
+        sepa_xml_files = await fetch_payout_run_sepa_xml_files(conn=conn, node=node, payout_run_id=payout_run_id)
+        if len(sepa_xml_files) != 1:
+            raise InvalidArgument("SEPA xml of this payout run was split into multiple files, download it as zip")
+        return sepa_xml_files[0]
 
-        return row["sepa_xml"]
+    @with_db_transaction(read_only=True)
+    @requires_node(event_only=True)
+    @requires_user([Privilege.payout_management])
+    async def get_previous_payout_run_sepa_xml_files(
+        self,
+        *,
+        conn: Connection,
+        node: Node,
+        payout_run_id: int,
+    ) -> list[str]:
+        return await fetch_payout_run_sepa_xml_files(conn=conn, node=node, payout_run_id=payout_run_id)
 
     @with_db_transaction
     @requires_node(event_only=True)
@@ -309,24 +476,27 @@ class PayoutService(Service[Config]):
             current_user.id,
         )
 
+        res_config = await fetch_restricted_event_settings_for_node(conn, node.id)
+        if not res_config.email_enabled or not res_config.payout_done_subject or not res_config.payout_done_message:
+            return
+
         payouts = await conn.fetch_many(
             Payout,
-            "select * from payout_view p where p.payout_run_id = $1",
+            "select * from payout_view p where p.payout_run_id = $1 and p.email is not null",
             payout_run_id,
         )
-
-        res_config = await fetch_restricted_event_settings_for_node(conn, node.id)
-        for payout in payouts:
-            if payout.email is None:
-                continue
-            assert res_config.payout_done_message is not None
-            await mail_service.send_mail(
-                subject=res_config.payout_done_subject,
-                message=res_config.payout_done_message.format(**payout.model_dump()),
-                from_addr=res_config.payout_sender,
-                to_addr=payout.email,
-                node_id=node.id,
-            )
+        recipients = [(payout.email, payout.model_dump()) for payout in payouts if payout.email is not None]
+        if len(recipients) == 0:
+            return
+
+        await mail_service.send_bulk_mail(
+            conn=conn,
+            subject=res_config.payout_done_subject,
+            message_template=res_config.payout_done_message,
+            recipients=recipients,
+            from_addr=res_config.payout_sender,
+            node_id=node.id,
+        )
 
     @with_db_transaction
     @requires_node(event_only=True)
@@ -1,7 +1,7 @@
 import asyncio
 import logging
 import uuid
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
 from functools import wraps
 
 import aiohttp
@@ -41,6 +41,7 @@ from stustapay.payment.sumup.api import (
     SumUpCheckout,
     SumUpCheckoutStatus,
     SumUpCreateCheckout,
+    create_sumup_session,
 )
 
 
@@ -93,6 +94,10 @@ class SumupService(Service[Config]):
     SUMUP_API_URL = "https://api.sumup.com/v0.1"
     SUMUP_CHECKOUT_POLL_INTERVAL = timedelta(seconds=5)
     SUMUP_INITIAL_CHECK_TIMEOUT = timedelta(seconds=20)
+    # number of checkout states which are queried from sumup at the same time
+    SUMUP_MAX_CONCURRENT_CHECKS = 10
+    # maximum number of due checkouts which are checked per polling round
+    SUMUP_CHECKOUT_BATCH_SIZE = 500
 
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
@@ -100,6 +105,8 @@ class SumupService(Service[Config]):
         self.logger = logging.getLogger("customer")
 
         self.sumup_reachable = True
+        # merchant code -> long-lived http session used for all requests of this merchant
+        self._sumup_sessions: dict[str, aiohttp.ClientSession] = {}
 
     async def check_sumup_auth(self, event: RestrictedEventSettings):
         sumup_enabled = event.is_sumup_topup_enabled(self.config.core)
@@ -124,15 +131,26 @@ class SumupService(Service[Config]):
         self.logger.info("Successfully validated the sumup api key")
         self.sumup_reachable = True
 
+    def _sumup_api(self, event: RestrictedEventSettings) -> SumUpApi:
+        session = self._sumup_sessions.get(event.sumup_merchant_code)
+        if session is None or session.closed:
+            session = create_sumup_session()
+            self._sumup_sessions[event.sumup_merchant_code] = session
+        return SumUpApi(merchant_code=event.sumup_merchant_code, api_key=event.sumup_api_key, session=session)
+
+    async def close(self):
+        sessions = list(self._sumup_sessions.values())
+        self._sumup_sessions.clear()
+        for session in sessions:
+            await session.close()
+
     async def _create_sumup_checkout(
         self, *, event: RestrictedEventSettings, checkout: SumUpCreateCheckout
     ) -> SumUpCheckout:
-        api = SumUpApi(merchant_code=event.sumup_merchant_code, api_key=event.sumup_api_key)
-        return await api.create_sumup_checkout(checkout)
+        return await self._sumup_api(event).create_sumup_checkout(checkout)
 
     async def _get_checkout(self, *, event: RestrictedEventSettings, checkout_id: str) -> SumUpCheckout:
-        api = SumUpApi(merchant_code=event.sumup_merchant_code, api_key=event.sumup_api_key)
-        return await api.get_checkout(checkout_id)
+        return await self._sumup_api(event).get_checkout(checkout_id)
 
     @staticmethod
     async def _get_db_checkout(*, conn: Connection, checkout_id: str) -> CustomerCheckout:
@@ -193,16 +211,59 @@ class SumupService(Service[Config]):
             bookings=bookings,
         )
 
-    @staticmethod
-    async def _get_pending_checkouts(*, conn: Connection) -> list[CustomerCheckout]:
-        return await conn.fetch_many(
-            CustomerCheckout,
-            "select c.* from customer_sumup_checkout c "
+    async def _get_due_checkouts(self, *, conn: Connection) -> list[tuple[str, int]]:
+        """
+        Pending checkouts whose initial check timeout and backoff interval have passed, as (checkout id, node id of
+        the customer account), least recently checked first.
+        """
+        rows = await conn.fetch(
+            "select c.id, a.node_id from customer_sumup_checkout c "
             "join account a on c.customer_account_id = a.id "
             "join node n on n.id = a.node_id "
-            "join event e on n.event_id = n.event_id "
-            "where c.status = $1 and not n.read_only and e.sumup_topup_enabled",
+            "join node en on en.id = n.event_node_id "
+            "join event e on e.id = en.event_id "
+            "where c.status = $1 and not n.read_only and e.sumup_topup_enabled "
+            "   and c.date + $2 <= now() "
+            "   and (c.last_checked is null or c.last_checked + make_interval(secs => c.check_interval) <= now()) "
+            "order by coalesce(c.last_checked, c.date) "
+            "limit $3",
             SumUpCheckoutStatus.PENDING.value,
+            self.SUMUP_INITIAL_CHECK_TIMEOUT,
+            self.SUMUP_CHECKOUT_BATCH_SIZE,
+        )
+        return [(row["id"], row["node_id"]) for row in rows]
+
+    async def _check_pending_checkout(
+        self, semaphore: asyncio.Semaphore, checkout_id: str, event_settings: RestrictedEventSettings
+    ):
+        async with semaphore:
+            self.logger.debug(f"checking pending checkout {checkout_id}")
+            try:
+                async with self.db_pool.acquire() as conn, conn.transaction(isolation="serializable"):
+                    status = await self._update_checkout_status(
+                        conn=conn, checkout_id=checkout_id, event_settings=event_settings
+                    )
+                if status != SumUpCheckoutStatus.PENDING:
+                    self.logger.info(f"Sumup checkout {checkout_id} updated to status {status}")
+            except Exception as e:
+                self.logger.error(f"checking pending checkout {checkout_id} threw an error: {e}")
+
+    async def _process_pending_checkouts(self):
+        async with self.db_pool.acquire() as conn:
+            due_checkouts = await self._get_due_checkouts(conn=conn)
+            # the event settings are only fetched once per node and polling round
+            event_settings: dict[int, RestrictedEventSettings] = {}
+            for _, node_id in due_checkouts:
+                if node_id not in event_settings:
+                    event_settings[node_id] = await fetch_restricted_event_settings_for_node(conn=conn, node_id=node_id)
+
+        # one slow sumup response must not stall all other checkouts
+        semaphore = asyncio.Semaphore(self.SUMUP_MAX_CONCURRENT_CHECKS)
+        await asyncio.gather(
+            *(
+                self._check_pending_checkout(semaphore, checkout_id, event_settings[node_id])
+                for checkout_id, node_id in due_checkouts
+            )
         )
 
     async def run_sumup_checkout_processing(self):
@@ -212,40 +273,26 @@ class SumupService(Service[Config]):
             return
 
         self.logger.info("Staring periodic job to check pending sumup transactions")
-        while True:
-            await asyncio.sleep(self.SUMUP_CHECKOUT_POLL_INTERVAL.seconds)
-            try:
-                # get all pending checkouts
-                async with self.db_pool.acquire() as conn:
-                    pending_checkouts = await self._get_pending_checkouts(conn=conn)
-
-                    # for each pending checkout, check the status with sumup
-                    for pending_checkout in pending_checkouts:
-                        if datetime.now(tz=timezone.utc) < pending_checkout.date + self.SUMUP_INITIAL_CHECK_TIMEOUT or (
-                            pending_checkout.last_checked is not None
-                            and datetime.now(tz=timezone.utc)
-                            < pending_checkout.last_checked + timedelta(seconds=pending_checkout.check_interval)
-                        ):
-                            self.logger.debug(
-                                f"skipping pending checkout {pending_checkout.checkout_reference} due to backoff"
-                            )
-                            continue
-
-                        self.logger.debug(f"checking pending checkout {pending_checkout.checkout_reference}")
-                        async with conn.transaction(isolation="serializable"):
-                            status = await self._update_checkout_status(conn=conn, checkout_id=pending_checkout.id)
-                            if status != SumUpCheckoutStatus.PENDING:
-                                self.logger.info(f"Sumup checkout {pending_checkout.id} updated to status {status}")
-            except Exception as e:
-                self.logger.error(f"process pending checkouts threw an error: {e}")
-
-    async def _update_checkout_status(self, conn: Connection, checkout_id: str) -> SumUpCheckoutStatus:
+        try:
+            while True:
+                await asyncio.sleep(self.SUMUP_CHECKOUT_POLL_INTERVAL.total_seconds())
+                try:
+                    await self._process_pending_checkouts()
+                except Exception as e:
+                    self.logger.error(f"process pending checkouts threw an error: {e}")
+        finally:
+            await self.close()
+
+    async def _update_checkout_status(
+        self, conn: Connection, checkout_id: str, event_settings: RestrictedEventSettings | None = None
+    ) -> SumUpCheckoutStatus:
         stored_checkout = await self._get_db_checkout(conn=conn, checkout_id=checkout_id)
-        customer_account_node_id = await conn.fetchval(
-            "select node_id from account where id = $1", stored_checkout.customer_account_id
-        )
-        assert customer_account_node_id is not None
-        event_settings = await fetch_restricted_event_settings_for_node(conn=conn, node_id=customer_account_node_id)
+        if event_settings is None:
+            customer_account_node_id = await conn.fetchval(
+                "select node_id from account where id = $1", stored_checkout.customer_account_id
+            )
+            assert customer_account_node_id is not None
+            event_settings = await fetch_restricted_event_settings_for_node(conn=conn, node_id=customer_account_node_id)
         sumup_checkout = await self._get_checkout(event=event_settings, checkout_id=stored_checkout.id)
 
         if stored_checkout.status != SumUpCheckoutStatus.PENDING:
@@ -4,30 +4,114 @@
 # pylint: disable=missing-kwoa
 import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
+from typing import Any, Awaitable, Callable, Iterable
 
 import aiosmtplib
 import asyncpg
-from sftkit.database import Connection
+from sftkit.database import Connection, DatabaseHook
 from sftkit.service import Service, with_db_transaction
 
 from stustapay.core.config import Config
-from stustapay.core.schema.mail import Mail
+from stustapay.core.schema.config import SMTPConfig
+from stustapay.core.schema.mail import Mail, MailAttachment, MailMetadata
+from stustapay.core.schema.tree import RestrictedEventSettings
 from stustapay.core.service.tree.common import fetch_restricted_event_settings_for_node
 
 
+class SMTPConnectionPool:
+    """
+    Persistent connections to a single SMTP server.
+    At most max_connections are used concurrently, all of them together send at most one mail per send_interval.
+    """
+
+    def __init__(self, smtp_config: SMTPConfig, max_connections: int, send_interval: timedelta):
+        self.smtp_config = smtp_config
+        self.send_interval = send_interval.total_seconds()
+        self.last_used = time.monotonic()
+        self._idle: list[aiosmtplib.SMTP] = []
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._next_send = 0.0
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        assert self.smtp_config.smtp_host is not None and self.smtp_config.smtp_port is not None
+        client = aiosmtplib.SMTP(
+            hostname=self.smtp_config.smtp_host,
+            port=self.smtp_config.smtp_port,
+            username=self.smtp_config.smtp_username,
+            password=self.smtp_config.smtp_password,
+            start_tls=True,
+        )
+        await client.connect()
+        return client
+
+    async def _wait_for_send_slot(self):
+        now = time.monotonic()
+        slot = max(now, self._next_send)
+        self._next_send = slot + self.send_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send(self, build_message: Callable[[], Awaitable[MIMEMultipart]]):
+        """
+        The message is only built once a connection is available, so at most max_connections messages are held
+        in memory at once.
+        """
+        async with self._semaphore:
+            await self._wait_for_send_slot()
+            self.last_used = time.monotonic()
+            message = await build_message()
+            client = self._idle.pop() if self._idle else None
+            try:
+                if client is not None and client.is_connected:
+                    try:
+                        await client.send_message(message)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # the server closed the idle connection in the meantime
+                        client = await self._connect()
+                        await client.send_message(message)
+                else:
+                    client = await self._connect()
+                    await client.send_message(message)
+            except Exception:
+                if client is not None:
+                    client.close()
+                raise
+            self._idle.append(client)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for client in idle:
+            try:
+                await client.quit()
+            except aiosmtplib.SMTPException:
+                client.close()
+
+
 class MailService(Service[Config]):
+    # poll interval after mails were sent, doubled up to MAIL_SEND_CHECK_MAX_INTERVAL while there is nothing to do
+    # and reset when new mails are inserted
     MAIL_SEND_CHECK_INTERVAL = timedelta(seconds=1)
+    MAIL_SEND_CHECK_MAX_INTERVAL = timedelta(seconds=30)
+    # minimum interval between two mails sent to the same smtp server
     MAIL_SEND_INTERVAL = timedelta(seconds=0.05)
+    MAIL_CLAIM_BATCH_SIZE = 100
+    # claimed mails which were not sent within this time are retried, by this or another sender
+    MAIL_CLAIM_DURATION = timedelta(minutes=5)
+    SMTP_MAX_CONNECTIONS = 4
+    SMTP_IDLE_TIMEOUT = timedelta(minutes=1)
 
     def __init__(self, db_pool: asyncpg.Pool, config: Config):
         super().__init__(db_pool, config)
         self.logger = logging.getLogger("mail_service")
+        self._smtp_pools: dict[tuple, SMTPConnectionPool] = {}
+        self._new_mails = asyncio.Event()
 
     @with_db_transaction
     async def send_mail(
@@ -76,48 +160,184 @@ class MailService(Service[Config]):
             )
         self.logger.debug(f"Added mail to database buffer for {to_addr}")
 
-    @with_db_transaction(read_only=True)
-    async def _fetch_mail(self, *, conn: Connection) -> list[Mail]:
-        # fetch all unsent mails from nodes with email enabled
+    @with_db_transaction
+    async def send_bulk_mail(
+        self,
+        *,
+        conn: Connection,
+        node_id: int,
+        subject: str,
+        message_template: str,
+        recipients: Iterable[tuple[str, dict[str, Any]]],
+        html_message: bool = False,
+        from_addr: str | None = None,
+        scheduled_send_date: datetime | None = None,
+    ) -> int:
+        """
+        Schedule the same mail for many recipients with a single insert.
+        recipients are pairs of the receiving address and the arguments the message template is formatted with.
+        Returns the number of scheduled mails.
+        """
+        res_config = await fetch_restricted_event_settings_for_node(conn, node_id)
+        if not res_config.email_enabled:
+            self.logger.warning(
+                f"Mails with subject {subject} were not scheduled for sending because event with node id {node_id} has mail sending deactivated"
+            )
+            return 0
+        to_addrs = []
+        messages = []
+        for to_addr, template_args in recipients:
+            to_addrs.append(to_addr)
+            messages.append(message_template.format(**template_args))
+        if not to_addrs:
+            return 0
+        await conn.execute(
+            """
+            INSERT INTO mails (node_id, subject, message, html_message, to_addr, from_addr, scheduled_send_date)
+            SELECT $1, $2, m.message, $3, m.to_addr, $4, $5
+            FROM unnest($6::text[], $7::text[]) WITH ORDINALITY AS m(to_addr, message, i)
+            ORDER BY m.i
+            """,
+            node_id,
+            subject,
+            html_message,
+            from_addr if from_addr is not None else res_config.email_default_sender,
+            scheduled_send_date if scheduled_send_date is not None else datetime.now(),
+            to_addrs,
+            messages,
+        )
+        self.logger.debug(f"Added {len(to_addrs)} mails to database buffer")
+        return len(to_addrs)
 
-        return await conn.fetch_many(
-            Mail,
+    @with_db_transaction
+    async def _claim_mails(self, *, conn: Connection) -> tuple[list[MailMetadata], dict[int, RestrictedEventSettings]]:
+        """
+        Claim a batch of due mails for sending, mails claimed by other senders are skipped.
+        Only the metadata of the mails is fetched, their content is loaded when they are sent, see _fetch_mail.
+        Returns the claimed mails and the event settings of their nodes.
+        """
+        now = datetime.now()
+        mails = await conn.fetch_many(
+            MailMetadata,
             """
-            select *
-            from mail_with_attachments
-            where scheduled_send_date <= $1 and send_date is null
+            with claimed as (
+                update mails set send_claimed_until = $2
+                where id in (
+                    select id from mails
+                    where scheduled_send_date <= $1 and send_date is null
+                        and (send_claimed_until is null or send_claimed_until < $1)
+                    order by scheduled_send_date
+                    limit $3
+                    for update skip locked
+                )
+                returning id, node_id, to_addr, scheduled_send_date
+            )
+            select
+                c.id,
+                c.node_id,
+                c.to_addr,
+                c.scheduled_send_date,
+                count(a.id) as n_attachments,
+                coalesce(sum(octet_length(a.content)), 0) as attachments_size
+            from claimed c left join mail_attachments a on a.mail_id = c.id
+            group by c.id, c.node_id, c.to_addr, c.scheduled_send_date
+            order by c.scheduled_send_date
             """,
-            datetime.now(),
+            now,
+            now + self.MAIL_CLAIM_DURATION,
+            self.MAIL_CLAIM_BATCH_SIZE,
         )
+        settings = {}
+        for node_id in {mail.node_id for mail in mails}:
+            settings[node_id] = await fetch_restricted_event_settings_for_node(conn, node_id)
+        return mails, settings
 
-    async def run_mail_service(self):
-        self.logger.info("Staring periodic job to send mails.")
-        while True:
-            try:
-                await asyncio.sleep(self.MAIL_SEND_CHECK_INTERVAL.seconds)
-                mails = await self._fetch_mail()
-                for mail in mails:
-                    await self._send_mail(mail=mail)
-                    await asyncio.sleep(self.MAIL_SEND_INTERVAL.seconds)
-            except Exception as e:
-                self.logger.exception(f"Failed to send mail with error {e}")
+    @with_db_transaction(read_only=True)
+    async def _fetch_mail(self, *, conn: Connection, mail: MailMetadata) -> Mail:
+        row = await conn.fetchrow("select * from mails where id = $1", mail.id)
+        attachments = []
+        if mail.n_attachments > 0:
+            attachments = await conn.fetch_many(
+                MailAttachment, "select * from mail_attachments where mail_id = $1 order by id", mail.id
+            )
+        return Mail.model_validate({**dict(row), "attachments": attachments})
 
     @with_db_transaction
-    async def _send_mail(
-        self,
-        *,
-        conn: Connection,
-        mail: Mail,
-    ) -> None:
-        self.logger.debug(f"Sending mail to {mail.to_addr}")
-        res_config = await fetch_restricted_event_settings_for_node(conn, mail.node_id)
-        smtp_config = res_config.smtp_config
-        if not smtp_config:
-            self.logger.info(
-                f"The mail was not send because event with node id {mail.node_id} has mail sending deactivated"
+    async def _mark_mails_as_sent(self, *, conn: Connection, mail_ids: list[int]):
+        await conn.execute(
+            "update mails set send_date = $1, send_claimed_until = null where id = any($2)", datetime.now(), mail_ids
+        )
+
+    def _smtp_pool(self, smtp_config: SMTPConfig) -> SMTPConnectionPool:
+        key = (smtp_config.smtp_host, smtp_config.smtp_port, smtp_config.smtp_username, smtp_config.smtp_password)
+        pool = self._smtp_pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(
+                smtp_config, max_connections=self.SMTP_MAX_CONNECTIONS, send_interval=self.MAIL_SEND_INTERVAL
             )
-            return
+            self._smtp_pools[key] = pool
+        return pool
+
+    async def _close_smtp_pools(self, idle_for: timedelta = timedelta(0)):
+        now = time.monotonic()
+        for key, pool in list(self._smtp_pools.items()):
+            if now - pool.last_used >= idle_for.total_seconds():
+                del self._smtp_pools[key]
+                await pool.close()
+
+    async def _send_pending_mails(self) -> int:
+        """
+        Send one claimed batch of due mails, returns the number of claimed mails.
+        """
+        mails, settings = await self._claim_mails()
+        if not mails:
+            return 0
+        results = await asyncio.gather(
+            *(self._send_mail(mail=mail, res_config=settings[mail.node_id]) for mail in mails)
+        )
+        sent_ids = [mail.id for mail, sent in zip(mails, results) if sent]
+        if sent_ids:
+            await self._mark_mails_as_sent(mail_ids=sent_ids)
+        return len(mails)
+
+    async def _on_new_mails(self, payload: str | None):
+        del payload
+        self._new_mails.set()
 
+    async def run_mail_service(self):
+        self.logger.info("Staring periodic job to send mails.")
+        hook = DatabaseHook(self.db_pool, "mail", self._on_new_mails)
+        hook_task = asyncio.create_task(hook.run())
+        interval = self.MAIL_SEND_CHECK_INTERVAL
+        try:
+            while True:
+                try:
+                    self._new_mails.clear()
+                    n_claimed = 0
+                    while True:
+                        n_batch = await self._send_pending_mails()
+                        n_claimed += n_batch
+                        if n_batch < self.MAIL_CLAIM_BATCH_SIZE:
+                            break
+                    await self._close_smtp_pools(idle_for=self.SMTP_IDLE_TIMEOUT)
+                    if n_claimed > 0:
+                        interval = self.MAIL_SEND_CHECK_INTERVAL
+                    else:
+                        interval = min(interval * 2, self.MAIL_SEND_CHECK_MAX_INTERVAL)
+                except Exception as e:
+                    self.logger.exception(f"Failed to send mail with error {e}")
+                    interval = self.MAIL_SEND_CHECK_INTERVAL
+                try:
+                    await asyncio.wait_for(self._new_mails.wait(), timeout=interval.total_seconds())
+                except TimeoutError:
+                    pass
+        finally:
+            await hook.stop_async()
+            hook_task.cancel()
+            await self._close_smtp_pools()
+
+    @staticmethod
+    def _build_message(mail: Mail, res_config: RestrictedEventSettings) -> MIMEMultipart:
         message = MIMEMultipart()
         message["Subject"] = mail.subject
         message["From"] = mail.from_addr if mail.from_addr else res_config.email_default_sender
@@ -138,28 +358,27 @@ class MailService(Service[Config]):
             encoders.encode_base64(part)
             part.add_header("Content-Disposition", f"attachment; filename= {attachment.file_name}")
             message.attach(part)
+        return message
 
-        try:
-            assert smtp_config.smtp_host is not None and smtp_config.smtp_port is not None
-            await aiosmtplib.send(
-                message,
-                hostname=smtp_config.smtp_host,
-                port=smtp_config.smtp_port,
-                username=smtp_config.smtp_username,
-                password=smtp_config.smtp_password,
-                start_tls=True,
+    async def _send_mail(self, *, mail: MailMetadata, res_config: RestrictedEventSettings) -> bool:
+        """
+        Returns whether the mail was sent, unsent mails are retried once their claim expired.
+        """
+        self.logger.debug(f"Sending mail to {mail.to_addr}")
+        smtp_config = res_config.smtp_config
+        if not smtp_config:
+            self.logger.info(
+                f"The mail was not send because event with node id {mail.node_id} has mail sending deactivated"
             )
+            return False
+
+        async def build_message() -> MIMEMultipart:
+            return self._build_message(await self._fetch_mail(mail=mail), res_config)
+
+        try:
+            await self._smtp_pool(smtp_config).send(build_message)
             self.logger.debug(f"Mail sent to {mail.to_addr}")
         except Exception as e:
             self.logger.exception(f"Failed to send mail to {mail.to_addr} with error {e}")
-            return
-
-        await conn.execute(
-            """
-            update mails
-            set send_date = $1
-            where id = $2
-            """,
-            datetime.now(),
-            mail.id,
-        )
+            return False
+        return True
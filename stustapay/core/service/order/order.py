@@ -1,5 +1,7 @@
+import hashlib
 import logging
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
 from typing import Dict, Optional, Set
 from uuid import UUID
 
@@ -9,7 +11,6 @@ from sftkit.database import Connection
 from sftkit.error import NotFound
 from sftkit.service import Service, with_db_transaction
 
-from stustapay.bon.bon import BonJson
 from stustapay.core.config import Config
 from stustapay.core.schema.account import (
     Account,
@@ -64,7 +65,6 @@ from stustapay.core.service.common.error import InvalidArgument, ServiceExceptio
 from stustapay.core.service.product import (
     fetch_discount_product,
     fetch_pay_out_product,
-    fetch_product,
     fetch_top_up_product,
 )
 from stustapay.core.service.till.common import fetch_virtual_till
@@ -216,10 +216,26 @@ async def fetch_order(*, conn: Connection, order_id: int) -> Optional[Order]:
     return await conn.fetch_maybe_one(Order, "select * from order_value where id = $1", order_id)
 
 
+@dataclass(frozen=True)
+class SerializedBon:
+    etag: str
+    body: bytes
+
+    @classmethod
+    def from_bon_json(cls, bon_json: str) -> "SerializedBon":
+        body = bon_json.encode()
+        return cls(etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body=body)
+
+
 class OrderService(Service[Config]):
+    # number of generated bons kept in memory
+    BON_CACHE_SIZE = 10000
+
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
+        # order uuid -> generated bon, bons never change once they are generated
+        self.bon_cache: OrderedDict[UUID, SerializedBon] = OrderedDict()
         self.voucher_service = VoucherService(db_pool=db_pool, config=config, auth_service=auth_service)
         self.stats = OrderStatsService(db_pool=db_pool, config=config, auth_service=auth_service)
 
@@ -1130,51 +1146,52 @@ class OrderService(Service[Config]):
     async def check_ticket_scan(
         self, *, conn: Connection, node: Node, current_till: Till, new_ticket_scan: NewTicketScan
     ) -> TicketScanResult:
-        can_sell_tickets = await conn.fetchval(
-            "select allow_ticket_sale from till_profile where id = $1", current_till.active_profile_id
+        profile = await conn.fetchrow(
+            "select allow_ticket_sale, layout_id from till_profile where id = $1", current_till.active_profile_id
         )
-        if not can_sell_tickets:
+        if profile is None or not profile["allow_ticket_sale"]:
             raise TillPermissionException("This terminal is not allowed to sell tickets")
 
-        layout_id = await conn.fetchval(
-            "select layout_id from till_profile tp where id = $1", current_till.active_profile_id
-        )
-        customer_pins = list(map(lambda x: x.tag_pin, new_ticket_scan.customer_tags))
+        customer_pins = [customer_tag.tag_pin for customer_tag in new_ticket_scan.customer_tags]
+        if len(set(customer_pins)) != len(customer_pins):
+            duplicate_pins = sorted(set(pin for pin in customer_pins if customer_pins.count(pin) > 1))
+            raise InvalidArgument(f"Ticket scanned multiple times: {', '.join(duplicate_pins)}")
 
-        known_tag_ids = await conn.fetch(
-            "select u.pin as user_tag_pin "
-            "from account a join user_tag u on a.user_tag_id = u.id "
-            "where u.pin = any($1) and u.node_id = any($2)",
+        # look up all scanned tags at once, the number of queries must not grow with the group size
+        tags = await conn.fetch(
+            "select ut.pin, a.id as account_id "
+            "from user_tag ut left join account a on a.user_tag_id = ut.id "
+            "where ut.pin = any($1) and ut.node_id = any($2)",
             customer_pins,
             node.ids_to_root,
         )
-
+        known_tag_ids = [tag for tag in tags if tag["account_id"] is not None]
         if len(known_tag_ids) > 0:
-            formatted_pins = ", ".join(a["user_tag_pin"] for a in known_tag_ids)
+            formatted_pins = ", ".join(tag["pin"] for tag in known_tag_ids)
             raise InvalidArgument(f"Ticket already has account: {formatted_pins}")
 
-        known_pins = await conn.fetch(
-            "select pin from user_tag where pin = any($1)",
+        unknown_ids = set(customer_pins) - set(tag["pin"] for tag in tags)
+        if len(unknown_ids) > 0:
+            raise InvalidArgument(f"Unknown Ticket ID: {', '.join(unknown_ids)}")
+
+        ticket_rows = await conn.fetch(
+            "select distinct on (ut.pin) ut.pin as customer_tag_pin, t.* "
+            "from ticket t "
+            "join till_layout_to_ticket tltt on tltt.ticket_id = t.id "
+            "join user_tag ut "
+            "   on (ut.restriction = any(t.restrictions) "
+            "       or t.restrictions = '{}'::text array and ut.restriction is null) "
+            "where tltt.layout_id = $1 and ut.pin = any($2) and ut.node_id = any($3) "
+            "order by ut.pin, t.id",
+            profile["layout_id"],
             customer_pins,
+            node.ids_to_root,
         )
-        if len(known_pins) != len(new_ticket_scan.customer_tags):
-            unknown_ids = set(customer_pins) - set(i["pin"] for i in known_pins)
-            raise InvalidArgument(f"Unknown Ticket ID: {', '.join(unknown_ids)}")
+        tickets = {row["customer_tag_pin"]: Ticket.model_validate(dict(row)) for row in ticket_rows}
 
         scanned_tickets = []
         for customer_tag in new_ticket_scan.customer_tags:
-            ticket = await conn.fetch_maybe_one(
-                Ticket,
-                "select t.* "
-                "from ticket t "
-                "join till_layout_to_ticket tltt on tltt.ticket_id = t.id "
-                "join user_tag ut "
-                "   on (ut.restriction = any(t.restrictions) "
-                "       or t.restrictions = '{}'::text array and ut.restriction is null) "
-                "where tltt.layout_id = $1 and ut.pin = $2",
-                layout_id,
-                customer_tag.tag_pin,
-            )
+            ticket = tickets.get(customer_tag.tag_pin)
             if ticket is None:
                 raise InvalidArgument("This terminal is not allowed to sell this ticket")
             scanned_tickets.append(
@@ -1236,14 +1253,21 @@ class OrderService(Service[Config]):
             tax_rate_id=top_up_product.tax_rate_id,
         )
 
+        # tickets are products but for compatibility with other code we need them as such, fetch all at once
+        ticket_products = {
+            product.id: product
+            for product in await conn.fetch_many(
+                Product,
+                "select * from product_with_tax_and_restrictions "
+                "where id = any($1) and type = 'ticket' and node_id = any($2)",
+                list({ticket_scan.ticket.id for ticket_scan in ticket_scan_result.scanned_tickets}),
+                node.ids_to_event_node,
+            )
+        }
+
         for ticket_scan in ticket_scan_result.scanned_tickets:
             ticket = ticket_scan.ticket
-
-            # TODO: this should not be necessary, tickets are products but for compatibility
-            #  with other code we fetch it again
-            ticket_product = await fetch_product(
-                conn=conn, node=node, product_id=ticket.id, product_type=ProductType.ticket
-            )
+            ticket_product = ticket_products.get(ticket.id)
             assert ticket_product is not None
             assert ticket_product.price is not None
 
@@ -1323,24 +1347,35 @@ class OrderService(Service[Config]):
         # create a new customer account for the given tag ,
         # store the initial topup amount as well as restriction for each newly created customer
         customers: dict[int, tuple[float, Optional[str]]] = {}
-        for scanned_ticket in pending_ticket_sale.scanned_tickets:
-            restriction = await conn.fetchval(
-                "select restriction from user_tag where pin = $1 and node_id = any($2)",
-                scanned_ticket.customer_tag_pin,
-                node.ids_to_root,
-            )
-            user_tag_id = await conn.fetchval(
-                "update user_tag set uid = $1 where pin = $2 and node_id = any($3) returning id",
-                scanned_ticket.customer_tag_uid,
-                scanned_ticket.customer_tag_pin,
-                node.ids_to_root,
-            )
-            customer_account_id = await conn.fetchval(
-                "insert into account (node_id, user_tag_id, type) values ($1, $2, 'private') returning id",
-                node.event_node_id,
-                user_tag_id,
+        scanned_tickets = {
+            scanned_ticket.customer_tag_pin: scanned_ticket for scanned_ticket in pending_ticket_sale.scanned_tickets
+        }
+        # assign the scanned uids to all tags and create their accounts in one statement, in scan order
+        new_customers = await conn.fetch(
+            "with scanned as ( "
+            "   select * from unnest($1::text array, $2::numeric array) with ordinality as s(pin, uid, idx) "
+            "), tags as ( "
+            "   update user_tag ut set uid = s.uid from scanned s "
+            "   where ut.pin = s.pin and ut.node_id = any($3) "
+            "   returning ut.id, ut.pin, ut.restriction, s.idx "
+            "), accounts as ( "
+            "   insert into account (node_id, user_tag_id, type) "
+            "   select $4, tags.id, 'private' from tags order by tags.idx "
+            "   returning id, user_tag_id "
+            ") "
+            "select a.id as account_id, t.pin, t.restriction from accounts a join tags t on t.id = a.user_tag_id "
+            "order by t.idx",
+            [scanned_ticket.customer_tag_pin for scanned_ticket in pending_ticket_sale.scanned_tickets],
+            [scanned_ticket.customer_tag_uid for scanned_ticket in pending_ticket_sale.scanned_tickets],
+            node.ids_to_root,
+            node.event_node_id,
+        )
+        for new_customer in new_customers:
+            scanned_ticket = scanned_tickets[new_customer["pin"]]
+            customers[new_customer["account_id"]] = (
+                scanned_ticket.ticket.initial_top_up_amount,
+                new_customer["restriction"],
             )
-            customers[customer_account_id] = (scanned_ticket.ticket.initial_top_up_amount, restriction)
 
         oldest_customer_account_id = self._find_oldest_customer(customers)
 
@@ -1472,24 +1507,44 @@ class OrderService(Service[Config]):
     async def get_order(self, *, conn: Connection, order_id: int) -> Optional[Order]:
         return await fetch_order(conn=conn, order_id=order_id)
 
-    @with_db_transaction
-    async def get_bon_by_uuid(self, *, conn: Connection, order_uuid: str) -> BonJson:
-        row = await conn.fetchrow(
-            "select b.bon_json from bon b join ordr o on b.id = o.id where o.uuid = $1",
+    @with_db_transaction(read_only=True)
+    async def _fetch_generated_bon_json(self, *, conn: Connection, order_uuid: UUID) -> str | None:
+        return await conn.fetchval(
+            "select b.bon_json::text from bon b join ordr o on b.id = o.id "
+            "where o.uuid = $1 and b.generated_at is not null",
             order_uuid,
         )
-        if not row or row["bon_json"] is None:
+
+    async def get_serialized_bon_by_uuid(self, *, order_uuid: str) -> SerializedBon:
+        """
+        Get a generated bon as json as it was stored by the bon generator, without parsing it.
+        """
+        try:
+            key = UUID(order_uuid)
+        except ValueError as e:
+            raise NotFound(element_type="bon", element_id=order_uuid) from e
+
+        bon = self.bon_cache.get(key)
+        if bon is not None:
+            self.bon_cache.move_to_end(key)
+            return bon
+
+        bon_json = await self._fetch_generated_bon_json(order_uuid=key)  # pylint: disable=missing-kwoa
+        if bon_json is None:
             raise NotFound(element_type="bon", element_id=order_uuid)
 
-        return BonJson.model_validate_json(row["bon_json"])
+        bon = SerializedBon.from_bon_json(bon_json)
+        self.bon_cache[key] = bon
+        if len(self.bon_cache) > self.BON_CACHE_SIZE:
+            self.bon_cache.popitem(last=False)
+        return bon
 
-    @with_db_transaction
-    async def get_bon_by_id(self, *, conn: Connection, order_id: int) -> BonJson:
-        row = await conn.fetchrow(
-            "select b.bon_json from bon b where b.id = $1",
+    @with_db_transaction(read_only=True)
+    async def get_serialized_bon_by_id(self, *, conn: Connection, order_id: int) -> SerializedBon:
+        bon_json = await conn.fetchval(
+            "select b.bon_json::text from bon b where b.id = $1 and b.generated_at is not null",
             order_id,
         )
-        if not row or row["bon_json"] is None:
+        if bon_json is None:
             raise NotFound(element_type="bon", element_id=order_id)
-
-        return BonJson.model_validate_json(row["bon_json"])
+        return SerializedBon.from_bon_json(bon_json)
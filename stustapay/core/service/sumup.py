@@ -1,14 +1,140 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
 import asyncpg
 from sftkit.database import Connection
 from sftkit.service import Service, with_db_transaction
 
 from stustapay.core.config import Config
-from stustapay.core.schema.tree import Node
+from stustapay.core.schema.tree import Node, RestrictedEventSettings
 from stustapay.core.schema.user import Privilege
 from stustapay.core.service.auth import AuthService
 from stustapay.core.service.common.decorators import requires_node, requires_user
 from stustapay.core.service.tree.common import fetch_restricted_event_settings_for_node
-from stustapay.payment.sumup.api import SumUpApi, SumUpCheckout, SumUpTransaction
+from stustapay.payment.sumup.api import (
+    SUMUP_AUTH_REFRESH_THRESHOLD,
+    SumUpApi,
+    SumUpCheckout,
+    SumUpOAuthToken,
+    SumUpTransaction,
+    fetch_new_oauth_token,
+)
+
+logger = logging.getLogger(__name__)
+
+# first key of the advisory locks which serialize the token refreshes of an event across processes
+SUMUP_OAUTH_REFRESH_LOCK = 7319
+# minimum time between two refresh attempts of the token of one event in one process
+SUMUP_OAUTH_REFRESH_RETRY_INTERVAL = timedelta(seconds=10)
+
+
+async def fetch_stored_sumup_oauth_token(conn: Connection, event_id: int) -> SumUpOAuthToken | None:
+    return await conn.fetch_maybe_one(
+        SumUpOAuthToken,
+        "select access_token, refresh_token, token_type, expires_in, expires_at "
+        "from sumup_oauth_token where event_id = $1",
+        event_id,
+    )
+
+
+class SumUpOAuthTokenCache:
+    """
+    Cache of the sumup oauth access tokens of all events.
+
+    Tokens are stored in the database and thereby shared by all processes. Once a token is about to expire it is
+    refreshed in the background, by at most one task per process and one process per event at a time.
+    Callers never wait for sumup, they get the current token or None if there is no usable token yet.
+    """
+
+    def __init__(self, db_pool: asyncpg.Pool):
+        self.db_pool = db_pool
+        # event id -> token
+        self.tokens: dict[int, SumUpOAuthToken] = {}
+        # event id -> running refresh
+        self.refreshes: dict[int, asyncio.Task] = {}
+        # event id -> monotonic time of the last refresh attempt
+        self.last_refresh: dict[int, float] = {}
+
+    async def get_token(self, conn: Connection, event_settings: RestrictedEventSettings) -> SumUpOAuthToken | None:
+        token = self.tokens.get(event_settings.id)
+        if token is None or not token.is_valid():
+            # another process might have refreshed the token already
+            stored = await fetch_stored_sumup_oauth_token(conn=conn, event_id=event_settings.id)
+            if stored is not None and (token is None or stored.expires_at > token.expires_at):
+                token = stored
+                self.tokens[event_settings.id] = stored
+
+        if token is None or not token.is_valid():
+            self._schedule_refresh(event_settings)
+
+        if token is not None and token.is_valid(tolerance=SUMUP_AUTH_REFRESH_THRESHOLD):
+            return token
+        return None
+
+    def _schedule_refresh(self, event_settings: RestrictedEventSettings):
+        running = self.refreshes.get(event_settings.id)
+        if running is not None and not running.done():
+            return
+        last_refresh = self.last_refresh.get(event_settings.id)
+        if (
+            last_refresh is not None
+            and time.monotonic() - last_refresh < SUMUP_OAUTH_REFRESH_RETRY_INTERVAL.total_seconds()
+        ):
+            return
+        self.last_refresh[event_settings.id] = time.monotonic()
+        self.refreshes[event_settings.id] = asyncio.create_task(self._refresh(event_settings))
+
+    async def _refresh(self, event_settings: RestrictedEventSettings):
+        try:
+            async with self.db_pool.acquire() as conn, conn.transaction():
+                locked = await conn.fetchval(
+                    "select pg_try_advisory_xact_lock($1, $2)", SUMUP_OAUTH_REFRESH_LOCK, event_settings.id
+                )
+                if not locked:
+                    logger.debug(f"SumUp Oauth token for event with ID {event_settings.id} is refreshed elsewhere")
+                    return
+
+                stored = await fetch_stored_sumup_oauth_token(conn=conn, event_id=event_settings.id)
+                if stored is not None and stored.is_valid():
+                    self.tokens[event_settings.id] = stored
+                    return
+
+                logger.info(f"Refreshing SumUp Oauth token for event with ID {event_settings.id}")
+                token = await fetch_new_oauth_token(
+                    client_id=event_settings.sumup_oauth_client_id,
+                    client_secret=event_settings.sumup_oauth_client_secret,
+                    refresh_token=event_settings.sumup_oauth_refresh_token,
+                )
+                if token is None:
+                    return
+
+                await conn.execute(
+                    "insert into sumup_oauth_token "
+                    "   (event_id, access_token, refresh_token, token_type, expires_in, expires_at) "
+                    "values ($1, $2, $3, $4, $5, $6) "
+                    "on conflict (event_id) do update set "
+                    "   access_token = excluded.access_token, refresh_token = excluded.refresh_token, "
+                    "   token_type = excluded.token_type, expires_in = excluded.expires_in, "
+                    "   expires_at = excluded.expires_at",
+                    event_settings.id,
+                    token.access_token,
+                    token.refresh_token,
+                    token.token_type,
+                    token.expires_in,
+                    token.expires_at,
+                )
+            self.tokens[event_settings.id] = token
+        except Exception:  # pylint: disable=bare-except
+            logger.exception(f"Refreshing the SumUp Oauth token for event with ID {event_settings.id} failed")
+
+    async def close(self):
+        refreshes = list(self.refreshes.values())
+        self.refreshes.clear()
+        for task in refreshes:
+            task.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
 
 
 class SumUpService(Service[Config]):
@@ -1,5 +1,6 @@
 import logging
-from datetime import timedelta
+from dataclasses import dataclass
+from datetime import datetime
 from typing import Optional
 
 import asyncpg
@@ -35,7 +36,8 @@ from stustapay.core.service.common.decorators import (
     requires_terminal,
     requires_user,
 )
-from stustapay.core.service.common.error import AccessDenied, NotFound
+from stustapay.core.service.common.error import AccessDenied, NotFound, Unauthorized
+from stustapay.core.service.sumup import SumUpOAuthTokenCache
 from stustapay.core.service.till.till import (
     assign_cash_register_to_till_if_available,
     assign_till_to_terminal,
@@ -48,7 +50,7 @@ from stustapay.core.service.tree.common import (
     fetch_restricted_event_settings_for_node,
 )
 from stustapay.core.service.user import list_assignable_roles_for_user_at_node
-from stustapay.payment.sumup.api import SumUpOAuthToken, fetch_new_oauth_token
+from stustapay.payment.sumup.api import SUMUP_OAUTH_VALIDITY_TOLERANCE, SumUpOAuthToken
 
 logger = logging.getLogger(__name__)
 
@@ -63,12 +65,26 @@ async def _fetch_terminal(conn: Connection, node: Node, terminal_id: int) -> Ter
     )
 
 
+@dataclass(frozen=True)
+class SerializedTerminalConfig:
+    version: int
+    etag: str
+    body: bytes
+    # the config has to be rebuilt after this point in time, even if its version did not change
+    valid_until: datetime | None
+
+    def is_valid(self) -> bool:
+        return self.valid_until is None or datetime.now().astimezone() < self.valid_until
+
+
 class TerminalService(Service[Config]):
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
 
-        self.sumup_oauth_cache: dict[int, SumUpOAuthToken] = {}
+        self.sumup_oauth_tokens = SumUpOAuthTokenCache(db_pool=db_pool)
+        # terminal id -> its last built config
+        self.terminal_config_cache: dict[int, SerializedTerminalConfig] = {}
 
     @with_db_transaction
     @requires_node(object_types=[ObjectType.terminal])
@@ -197,41 +213,15 @@ class TerminalService(Service[Config]):
             )
 
     async def _get_terminal_sumup_oauth_token(
-        self, terminal_id: int, node: Node, event_settings: RestrictedEventSettings
+        self, conn: Connection, event_settings: RestrictedEventSettings
     ) -> SumUpOAuthToken | None:
-        del terminal_id
         if not event_settings.sumup_payment_enabled:
             return None
         if event_settings.sumup_oauth_client_id == "" or event_settings.sumup_oauth_client_secret == "":
             return None
+        return await self.sumup_oauth_tokens.get_token(conn=conn, event_settings=event_settings)
 
-        event_node_id = node.event_node_id
-        assert event_node_id is not None
-
-        current_token = self.sumup_oauth_cache.get(event_node_id, None)
-        if current_token and current_token.is_valid():
-            return current_token
-
-        logger.info(f"Refreshing SumUp Oauth token for event with ID {event_node_id}")
-        new_token = await fetch_new_oauth_token(
-            client_id=event_settings.sumup_oauth_client_id,
-            client_secret=event_settings.sumup_oauth_client_secret,
-            refresh_token=event_settings.sumup_oauth_refresh_token,
-        )
-        if new_token is None and current_token is not None and current_token.is_valid(tolerance=timedelta(minutes=2)):
-            return current_token
-
-        if new_token is None:
-            return None
-
-        self.sumup_oauth_cache[node.id] = new_token
-        return new_token
-
-    async def _get_terminal_till_config(
-        self, conn: Connection, terminal_id: int, till: Till, event_node: Node
-    ) -> TerminalTillConfig:
-        node = await fetch_node(conn=conn, node_id=till.node_id)
-        assert node is not None
+    async def _get_terminal_till_config(self, conn: Connection, till: Till, event_node: Node) -> TerminalTillConfig:
         event_settings = await fetch_restricted_event_settings_for_node(conn=conn, node_id=event_node.id)
         profile = await conn.fetch_one(
             TillProfile,
@@ -272,9 +262,7 @@ class TerminalService(Service[Config]):
         sumup_api_oauth_valid_until = None
         if event_settings.sumup_payment_enabled and (profile.allow_ticket_sale or profile.allow_top_up):
             sumup_affiliate_key = event_settings.sumup_affiliate_key
-            oauth_token = await self._get_terminal_sumup_oauth_token(
-                terminal_id=terminal_id, node=node, event_settings=event_settings
-            )
+            oauth_token = await self._get_terminal_sumup_oauth_token(conn=conn, event_settings=event_settings)
             sumup_api_oauth_token = oauth_token.access_token if oauth_token is not None else ""
             sumup_api_oauth_valid_until = oauth_token.expires_at if oauth_token is not None else None
 
@@ -330,10 +318,8 @@ class TerminalService(Service[Config]):
             )
         return available_roles
 
-    @with_db_transaction(read_only=True)
-    @requires_terminal(requires_till=False)
-    async def get_terminal_config(
-        self, *, conn: Connection, current_terminal: CurrentTerminal
+    async def _build_terminal_config(
+        self, conn: Connection, current_terminal: CurrentTerminal
     ) -> TerminalConfig | None:
         event_node = await fetch_event_node_for_node(conn=conn, node_id=current_terminal.node_id)
         assert event_node is not None
@@ -349,7 +335,7 @@ class TerminalService(Service[Config]):
         till_config = None
         if current_terminal.till is not None:
             till_config = await self._get_terminal_till_config(
-                conn=conn, terminal_id=current_terminal.id, till=current_terminal.till, event_node=event_node
+                conn=conn, till=current_terminal.till, event_node=event_node
             )
         available_roles = await self._get_assignable_roles_for_user_at_node(
             conn=conn, current_terminal=current_terminal
@@ -369,6 +355,69 @@ class TerminalService(Service[Config]):
             test_mode_message=self.config.core.test_mode_message,
         )
 
+    @with_db_transaction(read_only=True)
+    @requires_terminal(requires_till=False)
+    async def get_terminal_config(
+        self, *, conn: Connection, current_terminal: CurrentTerminal
+    ) -> TerminalConfig | None:
+        return await self._build_terminal_config(conn=conn, current_terminal=current_terminal)
+
+    @with_db_transaction(read_only=True)
+    @requires_terminal(requires_till=False)
+    async def _serialize_terminal_config(
+        self, *, conn: Connection, current_terminal: CurrentTerminal
+    ) -> SerializedTerminalConfig | None:
+        # the version is read in the same transaction as the config, a concurrent change will bump it again
+        version = await conn.fetchval(
+            "select coalesce((select version from terminal_config_version where terminal_id = $1), 0)",
+            current_terminal.id,
+        )
+        terminal_config = await self._build_terminal_config(conn=conn, current_terminal=current_terminal)
+        if terminal_config is None:
+            return None
+
+        etag = f"{current_terminal.id}-{version}"
+        valid_until = None
+        sumup_secrets = terminal_config.till.sumup_secrets if terminal_config.till is not None else None
+        if sumup_secrets is not None and sumup_secrets.sumup_api_key_expires_at is not None:
+            # the contained oauth token is refreshed once it is about to expire
+            valid_until = sumup_secrets.sumup_api_key_expires_at - SUMUP_OAUTH_VALIDITY_TOLERANCE
+            etag = f"{etag}-{int(sumup_secrets.sumup_api_key_expires_at.timestamp())}"
+
+        serialized = SerializedTerminalConfig(
+            version=version,
+            etag=f'"{etag}"',
+            body=terminal_config.model_dump_json().encode(),
+            valid_until=valid_until,
+        )
+        self.terminal_config_cache[current_terminal.id] = serialized
+        return serialized
+
+    async def get_serialized_terminal_config(self, *, token: str) -> SerializedTerminalConfig | None:
+        """
+        Get the json encoded config of a terminal. The config is cached until its version changes, unchanged
+        configs only cost a lookup of the terminal session and its config version.
+        """
+        token_payload = self.auth_service.decode_terminal_jwt_payload(token)
+        if token_payload is None:
+            raise Unauthorized("invalid terminal token")
+
+        async with self.db_pool.acquire() as conn:
+            version = await conn.fetchval(
+                "select coalesce(v.version, 0) "
+                "from terminal t left join terminal_config_version v on t.id = v.terminal_id "
+                "where t.id = $1 and t.session_uuid = $2",
+                token_payload.terminal_id,
+                token_payload.session_uuid,
+            )
+        if version is None:
+            raise Unauthorized("invalid terminal token")
+
+        cached = self.terminal_config_cache.get(token_payload.terminal_id)
+        if cached is not None and cached.version == version and cached.is_valid():
+            return cached
+        return await self._serialize_terminal_config(token=token)  # pylint: disable=missing-kwoa
+
     @with_db_transaction(read_only=True)
     @requires_terminal()
     async def check_user_login(
@@ -13,31 +13,41 @@ from stustapay.core.service.common.error import NotFound
 
 
 class TranslationText(BaseModel):
+    event_id: int
     lang_code: Language
     type: str
     content: str
 
 
-async def _fetch_translation_textx(conn: Connection, event_id: int) -> dict[Language, dict[str, str]]:
+async def _fetch_translation_texts(conn: Connection, event_ids: list[int]) -> dict[int, dict[Language, dict[str, str]]]:
+    """load the translation texts of all given events at once, mapping event id -> lang_code -> type -> content"""
     texts = await conn.fetch_many(
-        TranslationText, "select lang_code, type, content from translation_text where event_id = $1", event_id
+        TranslationText,
+        "select event_id, lang_code, type, content from translation_text where event_id = any($1)",
+        event_ids,
     )
-    result: dict[Language, dict[str, str]] = {}
+    result: dict[int, dict[Language, dict[str, str]]] = {event_id: {} for event_id in event_ids}
     for text in texts:
-        if text.lang_code not in result:
-            result[text.lang_code] = {}
-        result[text.lang_code][text.type] = text.content
+        result[text.event_id].setdefault(text.lang_code, {})[text.type] = text.content
     return result
 
 
-async def fetch_node(conn: Connection, node_id: int) -> Node | None:
+async def _fetch_translation_textx(conn: Connection, event_id: int) -> dict[Language, dict[str, str]]:
+    texts = await _fetch_translation_texts(conn=conn, event_ids=[event_id])
+    return texts[event_id]
+
+
+async def fetch_node(conn: Connection, node_id: int, with_translations: bool = True) -> Node | None:
+    """
+    Fetch a node with its whole subtree.
+    The translation texts of the contained events are only loaded if with_translations is set, callers which only
+    check permissions or export data can skip them.
+    """
     node = await conn.fetch_maybe_one(
         Node, "select n.*, '{}'::json array as children from node_with_allowed_objects n where n.id = $1", node_id
     )
     if node is None:
         return None
-    if node.event is not None:
-        node.event.translation_texts = await _fetch_translation_textx(conn=conn, event_id=node.event.id)
     node_map: dict[int, Node] = {node.id: node}
 
     children = await conn.fetch_many(
@@ -48,11 +58,16 @@ async def fetch_node(conn: Connection, node_id: int) -> Node | None:
         f"{node.path}/%",
     )
     for child in children:
-        if child.event is not None:
-            child.event.translation_texts = await _fetch_translation_textx(conn=conn, event_id=child.event.id)
         node_map[child.parent].children.append(child)
         node_map[child.id] = child
 
+    if with_translations:
+        events = [n.event for n in node_map.values() if n.event is not None]
+        if len(events) > 0:
+            texts = await _fetch_translation_texts(conn=conn, event_ids=[event.id for event in events])
+            for event in events:
+                event.translation_texts = texts[event.id]
+
     return node
 
 
@@ -112,11 +127,11 @@ async def fetch_event_for_node(conn: Connection, node: Node) -> PublicEventSetti
     )
 
 
-async def fetch_event_node_for_node(conn: Connection, node_id: int) -> Node | None:
+async def fetch_event_node_for_node(conn: Connection, node_id: int, with_translations: bool = True) -> Node | None:
     event_node_id = await conn.fetchval("select event_node_id from node where id = $1", node_id)
     if event_node_id is None:
         raise NotFound(element_type="node", element_id=node_id)
-    return await fetch_node(conn=conn, node_id=event_node_id)
+    return await fetch_node(conn=conn, node_id=event_node_id, with_translations=with_translations)
 
 
 async def fetch_restricted_event_settings_for_node(conn: Connection, node_id: int) -> RestrictedEventSettings:
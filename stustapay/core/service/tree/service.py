@@ -1,5 +1,10 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
 import asyncpg
-from sftkit.database import Connection
+from sftkit.database import Connection, DatabaseHook
 from sftkit.service import Service, with_db_transaction
 
 from stustapay.bon.bon import BonJson, generate_dummy_bon_json
@@ -265,10 +270,29 @@ async def create_event(conn: Connection, parent_id: int, event: NewEvent) -> Nod
     return node
 
 
+@dataclass(frozen=True)
+class SerializedTree:
+    etag: str
+    body: bytes
+
+    @classmethod
+    def from_tree(cls, tree: NodeSeenByUser) -> "SerializedTree":
+        body = tree.model_dump_json().encode()
+        return cls(etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body=body)
+
+
 class TreeService(Service[Config]):
+    # number of users whose tree is kept in memory
+    TREE_CACHE_SIZE = 1000
+
     def __init__(self, db_pool: asyncpg.Pool, config: Config, auth_service: AuthService):
         super().__init__(db_pool, config)
         self.auth_service = auth_service
+        # (user id, user node id) -> tree with privileges as seen by this user
+        self.tree_cache: OrderedDict[tuple[int, int], SerializedTree] = OrderedDict()
+        self.tree_cache_enabled = False
+        # incremented on every invalidation, trees fetched concurrently to an invalidation are not cached
+        self.tree_cache_generation = 0
 
     @with_db_transaction
     @requires_node()
@@ -366,6 +390,47 @@ class TreeService(Service[Config]):
     async def get_tree_for_current_user(self, *, conn: Connection, current_user: CurrentUser) -> NodeSeenByUser:
         return await get_tree_for_current_user(conn=conn, current_user=current_user)
 
+    @with_db_transaction(read_only=True)
+    @requires_user(node_required=False)
+    async def get_serialized_tree_for_current_user(
+        self, *, conn: Connection, current_user: CurrentUser
+    ) -> SerializedTree:
+        key = (current_user.id, current_user.node_id)
+        if self.tree_cache_enabled:
+            cached = self.tree_cache.get(key)
+            if cached is not None:
+                self.tree_cache.move_to_end(key)
+                return cached
+
+        # the read only transaction is read committed, the tree queries see all changes notified before this point
+        generation = self.tree_cache_generation
+        tree = SerializedTree.from_tree(await get_tree_for_current_user(conn=conn, current_user=current_user))
+
+        if self.tree_cache_enabled and generation == self.tree_cache_generation:
+            self.tree_cache[key] = tree
+            if len(self.tree_cache) > self.TREE_CACHE_SIZE:
+                self.tree_cache.popitem(last=False)
+        return tree
+
+    async def _on_tree_notification(self, payload: Optional[str]):
+        self.tree_cache_generation += 1
+        self.tree_cache.clear()
+        if payload is None:
+            # (re)connected, notifications might have been missed in between
+            self.tree_cache_enabled = True
+
+    async def run_tree_cache_invalidation(self):
+        """
+        Keep the trees seen by the users cached, they are dropped whenever nodes, events or roles change which is
+        notified on the tree channel.
+        """
+        hook = DatabaseHook(self.db_pool, "tree", self._on_tree_notification, initial_run=True)
+        try:
+            await hook.run()
+        finally:
+            self.tree_cache_enabled = False
+            self.tree_cache.clear()
+
     @with_db_transaction(read_only=True)
     @requires_node(event_only=True)
     @requires_user(privileges=[Privilege.node_administration])
@@ -435,3 +500,5 @@ class TreeService(Service[Config]):
         await conn.execute(
             "update event set sumup_oauth_refresh_token = $1 where id = $2", token.refresh_token, node.event.id
         )
+        # access tokens obtained with the previous refresh token are not refreshed anymore
+        await conn.execute("delete from sumup_oauth_token where event_id = $1", node.event.id)
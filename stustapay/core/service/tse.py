@@ -25,14 +25,15 @@ class TseService(Service[Config]):
     @requires_user([Privilege.node_administration])
     async def create_tse(self, *, conn: Connection, node: Node, new_tse: NewTse) -> Tse:
         tse_id = await conn.fetchval(
-            "insert into tse (node_id, name, serial, ws_url, ws_timeout, password, status) "
-            "values ($1, $2, $3, $4, $5, $6, 'new') returning id",
+            "insert into tse (node_id, name, serial, ws_url, ws_timeout, password, max_concurrent_signatures, status) "
+            "values ($1, $2, $3, $4, $5, $6, $7, 'new') returning id",
             node.id,
             new_tse.name,
             new_tse.serial,
             new_tse.ws_url,
             new_tse.ws_timeout,
             new_tse.password,
+            new_tse.max_concurrent_signatures,
         )
         return await conn.fetch_one(Tse, "select * from tse where id = $1", tse_id)
 
@@ -41,12 +42,14 @@ class TseService(Service[Config]):
     @requires_user([Privilege.node_administration])
     async def update_tse(self, *, conn: Connection, node: Node, tse_id: int, updated_tse: UpdateTse) -> Tse:
         tse_id = await conn.fetchval(
-            "update tse set name = $1, ws_timeout = $2, ws_url = $3, password = $4 "
-            "where id = $5 and node_id = any($6) returning id",
+            "update tse set name = $1, ws_timeout = $2, ws_url = $3, password = $4, "
+            "   max_concurrent_signatures = coalesce($5, max_concurrent_signatures) "
+            "where id = $6 and node_id = any($7) returning id",
             updated_tse.name,
             updated_tse.ws_timeout,
             updated_tse.ws_url,
             updated_tse.password,
+            updated_tse.max_concurrent_signatures,
             tse_id,
             node.ids_to_event_node,
         )
@@ -1,4 +1,7 @@
-from typing import Optional
+import codecs
+import csv
+import logging
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional
 
 import asyncpg
 from sftkit.database import Connection
@@ -8,10 +11,20 @@ from stustapay.core.config import Config
 from stustapay.core.schema.account import UserTagDetail
 from stustapay.core.schema.tree import Node, ObjectType
 from stustapay.core.schema.user import CurrentUser, Privilege
-from stustapay.core.schema.user_tag import NewUserTag, NewUserTagSecret, UserTagSecret
+from stustapay.core.schema.user_tag import (
+    NewUserTag,
+    NewUserTagSecret,
+    UserTagImportResult,
+    UserTagSecret,
+)
 from stustapay.core.service.auth import AuthService
 from stustapay.core.service.common.decorators import requires_node, requires_user
 from stustapay.core.service.common.error import InvalidArgument, NotFound
+from stustapay.core.service.common.search import (
+    SEARCH_RESULT_LIMIT,
+    contains_pattern,
+    normalize_search_term,
+)
 
 
 async def fetch_user_tag_secret(conn: Connection, secret_id: int) -> UserTagSecret | None:
@@ -46,18 +59,186 @@ async def create_user_tag_secret(conn: Connection, node_id: int, secret: NewUser
     return result
 
 
-async def create_user_tags(conn: Connection, node_id: int, tags: list[NewUserTag]):
-    if len(tags) == 0:
-        raise InvalidArgument("List of tags to create is empty")
+# (csv line number, pin, restriction, secret id)
+UserTagImportRecord = tuple[int, str, Optional[str], int]
+
+USER_TAG_IMPORT_PROGRESS_INTERVAL = 10000
+USER_TAG_IMPORT_MAX_REPORTED_ERRORS = 10
+
+logger = logging.getLogger(__name__)
+
+
+async def parse_user_tag_csv(chunks: AsyncIterable[bytes]) -> AsyncIterator[UserTagImportRecord]:
+    """
+    Incrementally parse an uploaded user tag csv with the columns pin, restriction (optional) and secret_id.
+    The first line has to be a header naming the columns.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    columns: Optional[dict[str, int]] = None
+    line_number = 0
+    buffer = ""
+
+    def parse_line(line: str) -> Optional[UserTagImportRecord]:
+        nonlocal columns
+        if line.strip() == "":
+            return None
+        fields = next(csv.reader([line]))
+        if columns is None:
+            columns = {name.strip(): idx for idx, name in enumerate(fields)}
+            if "pin" not in columns or "secret_id" not in columns:
+                raise InvalidArgument("User tag csv needs a header with at least the columns 'pin' and 'secret_id'")
+            return None
+        try:
+            pin = fields[columns["pin"]].strip()
+            secret_id = int(fields[columns["secret_id"]])
+            restriction = None
+            if "restriction" in columns:
+                restriction = fields[columns["restriction"]].strip() or None
+        except (IndexError, ValueError) as e:
+            raise InvalidArgument(f"Invalid user tag in line {line_number}: {line}") from e
+        if pin == "":
+            raise InvalidArgument(f"Missing pin in line {line_number}")
+        return line_number, pin, restriction, secret_id
+
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_number += 1
+            record = parse_line(line.rstrip("\r"))
+            if record is not None:
+                yield record
+
+    buffer += decoder.decode(b"", final=True)
+    line_number += 1
+    record = parse_line(buffer.rstrip("\r"))
+    if record is not None:
+        yield record
+
 
-    for tag in tags:
+async def _report_import_progress(
+    records: AsyncIterable[UserTagImportRecord] | Iterable[UserTagImportRecord],
+) -> AsyncIterator[UserTagImportRecord]:
+    async def as_async_iterable(items: Iterable[UserTagImportRecord]) -> AsyncIterator[UserTagImportRecord]:
+        for item in items:
+            yield item
+
+    if not isinstance(records, AsyncIterable):
+        records = as_async_iterable(records)
+
+    n_records = 0
+    async for record in records:
+        yield record
+        n_records += 1
+        if n_records % USER_TAG_IMPORT_PROGRESS_INTERVAL == 0:
+            logger.info(f"Copied {n_records} user tags into the import staging table")
+
+
+async def _check_user_tag_import(conn: Connection, query: str, message: str, *args):
+    rows = await conn.fetch(query + " order by s.line limit $1", USER_TAG_IMPORT_MAX_REPORTED_ERRORS, *args)
+    if len(rows) > 0:
+        lines = ", ".join(f"line {row['line']} ({row['value']})" for row in rows)
+        raise InvalidArgument(f"{message}: {lines}")
+
+
+async def import_user_tags(
+    conn: Connection,
+    node_id: int,
+    records: AsyncIterable[UserTagImportRecord] | Iterable[UserTagImportRecord],
+) -> int:
+    """
+    Bulk import user tags by copying them into a staging table, validating them set based and inserting them
+    with a single statement.
+    Returns the number of imported tags.
+    """
+    # the staging table is only visible to this transaction, start one (or a savepoint) to scope it
+    async with conn.transaction():
         await conn.execute(
-            "insert into user_tag (node_id, pin, restriction, secret_id) values ($1, $2, $3, $4)",
+            "create temporary table user_tag_import (line bigint, pin text, restriction text, secret_id bigint) "
+            "on commit drop"
+        )
+        await conn.copy_records_to_table(
+            "user_tag_import",
+            records=_report_import_progress(records),
+            columns=["line", "pin", "restriction", "secret_id"],
+        )
+        await conn.execute("analyze user_tag_import")
+
+        n_tags = await conn.fetchval("select count(*) from user_tag_import")
+        if n_tags == 0:
+            raise InvalidArgument("List of tags to create is empty")
+
+        await _check_user_tag_import(
+            conn,
+            "select s.line, s.secret_id::text as value from user_tag_import s "
+            "join node target on target.id = $2 "
+            "left join user_tag_secret uts on uts.id = s.secret_id "
+            "   and (uts.node_id = target.id or uts.node_id = any(target.parent_ids)) "
+            "where uts.id is null",
+            "Unknown user tag secrets",
             node_id,
-            tag.pin,
-            tag.restriction.value if tag.restriction is not None else None,
-            tag.secret_id,
         )
+        await _check_user_tag_import(
+            conn,
+            "select s.line, s.restriction as value from user_tag_import s "
+            "where s.restriction is not null and s.restriction not in (select name from restriction_type)",
+            "Unknown restrictions",
+        )
+        await _check_user_tag_import(
+            conn,
+            "select s.line, s.pin as value from ( "
+            "   select line, pin, count(*) over (partition by pin) as n from user_tag_import "
+            ") s where s.n > 1",
+            "Duplicate pins",
+        )
+        await _check_user_tag_import(
+            conn,
+            "select s.line, s.pin as value from user_tag_import s "
+            "join user_tag ut on ut.pin = s.pin "
+            "join node n on n.id = ut.node_id "
+            "join node target on target.id = $2 "
+            "where n.id = target.id or n.id = any(target.parent_ids) or n.path like target.path || '/%'",
+            "Pins already exist",
+            node_id,
+        )
+
+        await conn.execute(
+            "insert into user_tag (node_id, pin, restriction, secret_id) "
+            "select $1, pin, restriction, secret_id from user_tag_import order by line",
+            node_id,
+        )
+        await conn.execute("drop table user_tag_import")
+    logger.info(f"Finished importing {n_tags} user tags")
+    return n_tags
+
+
+async def fetch_existing_user_tag_pins(conn: Connection, node_id: int, pins: list[str]) -> set[str]:
+    """returns all given pins which would collide with user tags in the tree of the given node"""
+    rows = await conn.fetch(
+        "select ut.pin from user_tag ut "
+        "join node n on n.id = ut.node_id "
+        "join node target on target.id = $2 "
+        "where ut.pin = any($1) "
+        "   and (n.id = target.id or n.id = any(target.parent_ids) or n.path like target.path || '/%')",
+        pins,
+        node_id,
+    )
+    return {row["pin"] for row in rows}
+
+
+async def create_user_tags(conn: Connection, node_id: int, tags: list[NewUserTag]):
+    if len(tags) == 0:
+        raise InvalidArgument("List of tags to create is empty")
+
+    # all lists go through the import to validate them the same way, the line is the position in the list
+    await import_user_tags(
+        conn=conn,
+        node_id=node_id,
+        records=[
+            (idx, tag.pin, tag.restriction.value if tag.restriction is not None else None, tag.secret_id)
+            for idx, tag in enumerate(tags, start=1)
+        ],
+    )
 
 
 async def get_or_assign_user_tag(conn: Connection, node: Node, pin: Optional[str], uid: int) -> int:
@@ -111,6 +292,16 @@ class UserTagService(Service[Config]):
     async def create_user_tags(self, *, conn: Connection, node: Node, new_user_tags: list[NewUserTag]):
         return await create_user_tags(conn=conn, node_id=node.id, tags=new_user_tags)
 
+    # the records are streamed from the request and can only be consumed once, a retry would see no tags
+    @with_db_transaction(read_only=False, n_retries=1)
+    @requires_node(event_only=True, object_types=[ObjectType.user_tag])
+    @requires_user([Privilege.node_administration])
+    async def import_user_tags(
+        self, *, conn: Connection, node: Node, records: AsyncIterable[UserTagImportRecord]
+    ) -> UserTagImportResult:
+        n_imported = await import_user_tags(conn=conn, node_id=node.id, records=records)
+        return UserTagImportResult(n_imported=n_imported)
+
     @with_db_transaction(read_only=True)
     @requires_node(event_only=True, object_types=[ObjectType.user_tag])
     @requires_user([Privilege.node_administration])
@@ -143,10 +334,19 @@ class UserTagService(Service[Config]):
     @requires_node(event_only=True)
     @requires_user([Privilege.node_administration])
     async def find_user_tags(self, *, conn: Connection, node: Node, search_term: str) -> list[UserTagDetail]:
+        term = normalize_search_term(search_term)
         return await conn.fetch_many(
             UserTagDetail,
-            "select * from user_tag_with_history utwh "
-            "where ((uid is not null and to_hex(uid::bigint) like $1) or lower(pin) like $1) and node_id = any($2)",
-            f"%{search_term.lower()}%",
+            "with ranked as ( "
+            "   select ut.id, greatest(search_rank(ut.pin, $1), search_rank(ut.uid_hex, $1)) as rank "
+            "   from user_tag ut "
+            "   where (lower(ut.pin) like $2 or ut.uid_hex like $2) and ut.node_id = any($3) "
+            "   order by rank desc, ut.id "
+            "   limit $4 "
+            ") "
+            "select utwh.* from ranked r join user_tag_with_history utwh on utwh.id = r.id order by r.rank desc, r.id",
+            term,
+            contains_pattern(term),
             node.ids_to_event_node,
+            SEARCH_RESULT_LIMIT,
         )
@@ -2,10 +2,17 @@
 some basic api endpoints.
 """
 
+from typing import Optional
+
 from fastapi import APIRouter, status
 
 from stustapay.bon.bon import BonJson
 from stustapay.core.http.auth_customer import CurrentAuthToken
+from stustapay.core.http.caching import (
+    IMMUTABLE_CACHE_CONTROL,
+    IfNoneMatch,
+    json_response_with_etag,
+)
 from stustapay.core.http.context import (
     ContextCustomerService,
     ContextMailService,
@@ -13,6 +20,7 @@ from stustapay.core.http.context import (
 )
 from stustapay.core.schema.customer import (
     Customer,
+    CustomerOrderPage,
     OrderWithBon,
     PayoutInfo,
     PayoutTransaction,
@@ -49,6 +57,29 @@ async def get_orders(
     return await customer_service.get_orders_with_bon(token=token)
 
 
+@router.get(
+    "/orders",
+    summary="Obtain a page of the customer orders, newest first, without line items",
+    response_model=CustomerOrderPage,
+)
+async def get_order_page(
+    token: CurrentAuthToken,
+    customer_service: ContextCustomerService,
+    cursor: Optional[int] = None,
+    limit: Optional[int] = None,
+):
+    return await customer_service.get_orders(token=token, cursor=cursor, limit=limit)
+
+
+@router.get("/orders/{order_id}", summary="Obtain a customer order with its line items", response_model=OrderWithBon)
+async def get_order(
+    token: CurrentAuthToken,
+    customer_service: ContextCustomerService,
+    order_id: int,
+):
+    return await customer_service.get_order_with_bon(token=token, order_id=order_id)
+
+
 @router.post("/customer_info", summary="set iban, account name and email", status_code=status.HTTP_204_NO_CONTENT)
 async def update_customer_info(
     token: CurrentAuthToken,
@@ -100,8 +131,14 @@ async def get_customer_config(
     return await customer_service.get_api_config(base_url=base_url)
 
 
-@router.get("/bon/{order_uuid}", summary="Retrieve a bon", response_model=BonJson)
-async def get_bon(order_service: ContextOrderService, order_uuid: str):
-    return await order_service.get_bon_by_uuid(
-        order_uuid=order_uuid,
+@router.get(
+    "/bon/{order_uuid}",
+    summary="Retrieve a bon",
+    response_model=BonJson,
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the bon did not change, bons never change"}},
+)
+async def get_bon(order_service: ContextOrderService, order_uuid: str, if_none_match: IfNoneMatch = None):
+    bon = await order_service.get_serialized_bon_by_uuid(order_uuid=order_uuid)
+    return json_response_with_etag(
+        body=bon.body, etag=bon.etag, if_none_match=if_none_match, cache_control=IMMUTABLE_CACHE_CONTROL
     )
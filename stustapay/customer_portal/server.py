@@ -71,6 +71,8 @@ class Api:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="customer_portal")))
             self.server.add_task(asyncio.create_task(customer_service.sumup.run_sumup_checkout_processing()))
             self.server.add_task(asyncio.create_task(mail_service.run_mail_service()))
+            self.server.add_task(asyncio.create_task(customer_service.run_order_cache_invalidation()))
             await self.server.run(context)
         finally:
+            await customer_service.close()
             await db_pool.close()
@@ -0,0 +1,80 @@
+"""
+Cache of the csv fragments of single Kassenabschluesse (till, z_nr) of earlier DSFinV-K exports.
+
+Every fragment is stored with the fingerprint of the data it was generated from and a checksum per csv file, a
+fragment is only reused if both still match.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from .dsfinvk.collection import Collection
+
+LOGGER = logging.getLogger(__name__)
+
+# bump whenever the generated csv rows change to invalidate all existing cache entries
+CACHE_VERSION = 2
+
+
+def fingerprint(*parts) -> str:
+    """sha256 over the json representation of all given parts, non json types are converted with str()"""
+    return hashlib.sha256(json.dumps([CACHE_VERSION, *parts], default=str).encode("utf-8")).hexdigest()
+
+
+def _checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ExportCache:
+    def __init__(self, directory: Path, node_id: int):
+        self.directory = directory / str(node_id)
+
+    def path(self, till_id: int, z_nr: int) -> Path:
+        return self.directory / str(till_id) / str(z_nr)
+
+    def load(self, till_id: int, z_nr: int, expected_fingerprint: str) -> Optional[list[str]]:
+        """
+        Returns the table file names of the cached fragment if it is still valid.
+        """
+        path = self.path(till_id, z_nr)
+        try:
+            with open(path / "meta.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("fingerprint") != expected_fingerprint:
+            return None
+        try:
+            for filename, checksum in meta["checksums"].items():
+                if _checksum(path / filename) != checksum:
+                    LOGGER.warning(f"Checksum mismatch of cached {filename} of till {till_id} z_nr {z_nr}")
+                    return None
+        except OSError:
+            return None
+        return meta["tables"]
+
+    def store(self, till_id: int, z_nr: int, data_fingerprint: str, collection: Collection) -> list[str]:
+        path = self.path(till_id, z_nr)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        tables = collection.save(tmp_path)
+        meta = {
+            "fingerprint": data_fingerprint,
+            "tables": tables,
+            "checksums": {filename: _checksum(tmp_path / filename) for filename in tables},
+        }
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        tmp_path.rename(path)
+        return tables
@@ -2,30 +2,104 @@
 # with modifications by StuStaPay, 2023
 
 import csv
-from collections import defaultdict
-from io import StringIO
-from zipfile import ZIP_DEFLATED, ZipFile
+import io
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
 from .table import Model
 
 
 class Collection:
+    """
+    Collects the records of an export.
+
+    Records are written to a temporary csv file per table as soon as they are added, the zip file is assembled
+    from these files in write(). Tables appear in the zip in the order in which their first record was added.
+    """
+
     def __init__(self):
-        self.records = defaultdict(list)
+        # table file name -> (csv file, its writerow function)
+        self.tables: dict[str, tuple[io.TextIOWrapper, Callable[[Iterable], Any]]] = {}
+        self.counts: dict[str, int] = {}
+
+    def _table(self, filename: str) -> tuple[io.TextIOWrapper, Callable[[Iterable], Any]]:
+        # pylint: disable=consider-using-with
+        buffer = io.TextIOWrapper(tempfile.TemporaryFile(), encoding="utf-8", newline="")
+        writer = csv.writer(buffer, delimiter=";", lineterminator="\r\n")
+        table = buffer, writer.writerow
+        self.tables[filename] = table
+        self.counts[filename] = 0
+        return table
+
+    def _writerow(self, model: type[Model], row: Iterable):
+        table = self.tables.get(model.filename)
+        if table is None:
+            table = self._table(model.filename)
+            table[1](model._field_names)  # pylint: disable=protected-access
+        table[1](row)
+        self.counts[model.filename] += 1
 
     def add(self, record: Model):
-        self.records[record.filename].append(record)
+        self._writerow(type(record), record._values)  # pylint: disable=protected-access
+
+    def add_row(self, model: type[Model], **values):
+        """
+        Add a record of the given table without creating a Model instance, see Model.row.
+        """
+        self._writerow(model, model.row(**values))
+
+    def save(self, directory: Path) -> list[str]:
+        """
+        Write the csv file of every table into directory, returns the table file names in collection order.
+        """
+        for k, (buffer, _) in self.tables.items():
+            buffer.flush()
+            raw = buffer.buffer
+            raw.seek(0)
+            with open(directory / k, "wb") as f:
+                shutil.copyfileobj(raw, f)
+        return list(self.tables.keys())
+
+    def extend(self, directory: Path, filenames: list[str]):
+        """
+        Append the tables saved by another collection to this one, as if their records had been added here.
+        """
+        for k in filenames:
+            with open(directory / k, "rb") as f:
+                header = f.readline()
+                table = self.tables.get(k)
+                if table is None:
+                    table = self._table(k)
+                    table[0].buffer.write(header)
+                buffer = table[0]
+                buffer.flush()
+                for line in f:
+                    buffer.buffer.write(line)
+                    self.counts[k] += 1
 
     def write(self, name, xml_path, dtd_path):
         with ZipFile(name, "w", compression=ZIP_DEFLATED, compresslevel=9) as zf:
-            for k, l in self.records.items():
-                b = StringIO()
-                w = csv.DictWriter(b, fieldnames=[f.name for f in l[0]._fields], delimiter=";", lineterminator="\r\n")
-                w.writeheader()
-                for r in l:
-                    if r.data:
-                        w.writerow(r.data)
-                b.seek(0)
-                zf.writestr(k, b.read())
+            for k, (buffer, _) in self.tables.items():
+                buffer.flush()
+                raw = buffer.buffer
+                zinfo = ZipInfo(filename=k, date_time=time.localtime(time.time())[:6])
+                zinfo.compress_type = zf.compression
+                zinfo._compresslevel = zf.compresslevel  # pylint: disable=protected-access
+                zinfo.file_size = raw.seek(0, io.SEEK_END)
+                raw.seek(0)
+                with zf.open(zinfo, "w") as dest:
+                    shutil.copyfileobj(raw, dest)
             zf.write(xml_path, "index.xml")
             zf.write(dtd_path, "gdpdu-01-08-2002.dtd")
+
+    def close(self):
+        for buffer, _ in self.tables.values():
+            buffer.close()
+        self.tables.clear()
+
+    def __repr__(self):
+        return f"Collection({', '.join(f'{k}: {v} records' for k, v in self.counts.items())})"
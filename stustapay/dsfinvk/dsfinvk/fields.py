@@ -1,12 +1,16 @@
 # based on https://github.com/pretix/python-dsfinvk, Coypright rami.io GmbH, Apache Lizenz
 # with modifications by StuStaPay, 2023
 
+import functools
 import re
 from datetime import date, datetime
 from decimal import ROUND_HALF_UP, Decimal
 
 import pytz
 
+# number of distinct values whose formatted representation is cached per field
+FORMAT_CACHE_SIZE = 4096
+
 
 class Field:
     def __init__(self, required=False, default=None, _d=None):
@@ -14,22 +18,27 @@ class Field:
         self.default = default
         self.__doc__ = _d
         self.name = ""
+        self.index = -1  # column of this field in the rows of its table, set by the table class
         super().__init__()
 
     def __get__(self, instance, objtype):
-        if instance.data.get(self.name, None) is None:
-            instance.data[self.name] = self.default
-        return instance.data[self.name]
+        if instance._values[self.index] is None:
+            instance._values[self.index] = self.default
+        return instance._values[self.index]
 
     def __set__(self, instance, value):
-        raise AttributeError("Read-only!")
+        instance._values[self.index] = self.format(value)
 
     def __delete__(self, instance):
-        del instance.data[self.name]
+        instance._values[self.index] = None
 
     def __set_name__(self, owner, name):
         self.name = name
 
+    def format(self, value):
+        """Validates a value and converts it to its csv representation."""
+        raise AttributeError("Read-only!")
+
 
 class StringField(Field):
     def __init__(self, *args, max_length=None, regex=None, **kwargs):
@@ -37,62 +46,78 @@ class StringField(Field):
         self.regex = re.compile(regex) if regex else None
         super().__init__(*args, **kwargs)
 
-    def __set__(self, instance, value):
+    def format(self, value):
         # TODO: Make it configurable if this should raise an error
         # if self.max_length and len(value) > self.max_length:
         #    raise ValueError("Value for {} is longer than {} characters.".format(self.name, self.max_length))
         if self.regex and not self.regex.match(value):
             raise ValueError("Value {} for {} does not have the valid format.".format(value, self.name))
-        instance.data[self.name] = value
+        return value
 
 
 class NumericField(Field):
     def __init__(self, *args, places=0, **kwargs):
         self.places = places
+        self._quantum = Decimal("1") / 10**places
+        self._format_string = "{:,.%df}" % places
+        self._format_cached = functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)(self._format_decimal)
         super().__init__(*args, **kwargs)
 
-    def __set__(self, instance, value):
+    def _format_decimal(self, value: Decimal) -> str:
+        if self.places > 0:
+            return self._format_string.format(value.quantize(self._quantum, ROUND_HALF_UP)).translate(
+                {ord(","): ".", ord("."): ","}
+            )
+        return "{:,d}".format(int(value)).replace(",", ".")
+
+    def format(self, value):
         if not isinstance(value, (Decimal, int)):
             raise TypeError("Value is not a decimal or int")
         if isinstance(value, int):
             value = Decimal(value)
-        if self.places > 0:
-            instance.data[self.name] = (
-                ("{:,.%df}" % self.places)
-                .format(value.quantize(Decimal("1") / 10**self.places, ROUND_HALF_UP))
-                .translate({ord(","): ".", ord("."): ","})
-            )
-        else:
-            instance.data[self.name] = "{:,d}".format(int(value)).replace(",", ".")
+        # equal decimals have the same representation, except for the sign of zero
+        if not value or not value.is_finite():
+            return self._format_decimal(value)
+        return self._format_cached(value)
 
 
 class BooleanField(Field):
-    def __set__(self, instance, value):
+    def format(self, value):
         if not isinstance(value, bool):
             raise TypeError("Value is not a boolean")
-        instance.data[self.name] = "1" if value else "0"
+        return "1" if value else "0"
 
 
 class DateField(Field):
-    def __set__(self, instance, value):
+    def format(self, value):
         if not isinstance(value, date):
             raise TypeError("Value is not a date")
-        instance.data[self.name] = value.isoformat()
+        return value.isoformat()
 
 
 class LocalDateTimeField(Field):
-    def __set__(self, instance, value):
+    def __init__(self, *args, **kwargs):
+        self._format_cached = functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)(self._format_datetime)
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def _format_datetime(value: datetime, utcoffset) -> str:
+        del utcoffset  # only part of the cache key, equal datetimes in different time zones differ in local time
+        return value.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def format(self, value):
         if not isinstance(value, datetime):
             raise TypeError("Value is not a datetime")
-        if value.utcoffset() is None:
+        utcoffset = value.utcoffset()
+        if utcoffset is None:
             raise TypeError("Value is not timezone-aware")
-        instance.data[self.name] = value.strftime("%Y-%m-%dT%H:%M:%S")
+        return self._format_cached(value, utcoffset)
 
 
 class ISODateTimeField(Field):
-    def __set__(self, instance, value):
+    def format(self, value):
         if not isinstance(value, datetime):
             raise TypeError("Value is not a datetime")
         if value.utcoffset() is None:
             raise TypeError("Value is not timezone-aware")
-        instance.data[self.name] = value.astimezone(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        return value.astimezone(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
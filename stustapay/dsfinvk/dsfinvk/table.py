@@ -18,24 +18,54 @@ class BaseTableMeta(type):
 
     @no_type_check
     def __new__(mcls, name, bases, attrs):
+        # records only store the list of their column values
+        attrs.setdefault("__slots__", ())
         cls = super(BaseTableMeta, mcls).__new__(mcls, name, bases, attrs)
         fields = list(cls._fields) if hasattr(cls, "_fields") else []
         for attr, obj in attrs.items():
             if isinstance(obj, Field):
                 if sys.version_info < (3, 6):
                     obj.__set_name__(cls, attr)
+                obj.index = len(fields)
                 fields.append(obj)
         cls._fields = fields
+        # compiled once per table: column names, default row and the formatter of every column
+        cls._field_names = tuple(f.name for f in fields)
+        cls._defaults = tuple(f.default for f in fields)
+        cls._columns = {f.name: (f.index, f.format) for f in fields}
         return cls
 
 
 class Model(metaclass=BaseTableMeta):
+    __slots__ = ("_values",)
+
     @no_type_check
     def __init__(self, **kwargs):
-        self.data = OrderedDict([(f.name, f.default) for f in self._fields])  # pylint: disable=no-member
+        self._values = list(self._defaults)  # pylint: disable=no-member
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    @property
+    def data(self) -> OrderedDict:
+        """The record as column name -> value mapping"""
+        return OrderedDict(zip(self._field_names, self._values))  # pylint: disable=no-member
+
     @property
     def filename(self):
         raise NotImplementedError
+
+    @classmethod
+    @no_type_check
+    def row(cls, **values) -> list:
+        """
+        Build the csv row of a record of this table directly, without a Model instance.
+        Unset columns keep their default, the values are validated and formatted just like attribute assignments.
+        """
+        row = list(cls._defaults)
+        for name, value in values.items():
+            try:
+                index, formatter = cls._columns[name]
+            except KeyError:
+                raise AttributeError(f"{cls.__name__} has no field {name}") from None
+            row[index] = formatter(value)
+        return row
@@ -1,24 +1,274 @@
 # based on https://github.com/pretix/python-dsfinvk, Coypright rami.io GmbH, Apache Lizenz
 # with modifications by StuStaPay, 2023
 
+import contextlib
 import csv
+import hashlib
+import io
 import os
 import re
 import sys
 import xml.etree.ElementTree as ET
+import zipfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterator, NamedTuple, Optional, Union
+
+# value warnings reported per table, further ones are only counted
+MAX_WARNINGS_PER_TABLE = 100
+# dangling references reported per table, further ones are only counted
+MAX_REFERENCE_EXAMPLES = 10
+
+# every record of these tables belongs to a record of transactions.csv (Bonkopf)
+BON_KEY = ("Z_KASSE_ID", "Z_ERSTELLUNG", "Z_NR", "BON_ID")
+BON_TABLE = "transactions.csv"
+BON_REFERENCES = (
+    "lines.csv",
+    "lines_vat.csv",
+    "itemamounts.csv",
+    "subitems.csv",
+    "transactions_vat.csv",
+    "allocation_groups.csv",
+    "datapayment.csv",
+    "references.csv",
+    "transactions_tse.csv",
+)
 
 
 class ValidationException(Exception):
     pass
 
 
-def validate_files(filemap):
+class ZipMember(NamedTuple):
+    """A csv file inside of an export zip, can be used in the filemap of validate_files"""
+
+    zip_path: str
+    name: str
+
+
+Source = Union[str, ZipMember]
+
+
+@dataclass
+class ColumnSpec:
+    name: str
+    kind: str  # numeric, alphanumeric, date or unsupported
+    pattern: Optional[re.Pattern] = None
+    dec_places: int = 0
+    max_length: Optional[int] = None
+
+
+@dataclass
+class TableSpec:
+    """The column definitions of a table in index.xml, compiled once and shipped to the worker processes"""
+
+    column_delim: str
+    record_delim: str
+    text_encaps: str
+    columns: list[ColumnSpec]
+    # names of the columns whose values are collected as compact key hashes, see _key_hash
+    key_columns: tuple[str, ...] = ()
+
+
+@dataclass
+class TableResult:
+    error: Optional[str] = None
+    warnings: list[str] = field(default_factory=list)
+    n_warnings: int = 0
+    n_rows: int = 0
+    # sorted hashes of the key columns of all rows
+    keys: array = field(default_factory=lambda: array("q"))
+
+
+@contextlib.contextmanager
+def _open_text(source: Source, newline: str) -> Iterator[io.TextIOWrapper]:
+    if isinstance(source, ZipMember):
+        with zipfile.ZipFile(source.zip_path) as zf, zf.open(source.name) as f:
+            yield io.TextIOWrapper(f, encoding="utf-8", newline=newline)
+    else:
+        with open(source, newline=newline, encoding="utf-8") as f:
+            yield f
+
+
+def _key_indices(spec: TableSpec) -> list[int]:
+    names = [c.name for c in spec.columns]
+    return [names.index(k) for k in spec.key_columns]
+
+
+def _key_hash(values: list[str]) -> int:
+    """64 bit hash of a key, the keys of a table are kept as an array of these instead of a set of tuples of strings"""
+    digest = hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _table_spec(table: ET.Element, key_columns: tuple[str, ...] = ()) -> TableSpec:
+    dec_symb = table.find("./DecimalSymbol").text
+    digit_group_symb = table.find("./DigitGroupingSymbol").text
+    if not table.findall("./Range"):
+        range_start = 1
+    else:
+        range_start = int(table.find("./Range").find("./From").text)
+
+    if range_start != 2:
+        raise ValidationException(
+            "Range is != [2, End], this is not technically invalid but prevents ' ' column header validation."
+        )
+
+    if table.findall("./FixedLength"):
+        raise ValidationException("Fixed length validation is currently not supported.")
+
+    if table.findall("./VariableLength/VariablePrimaryKey"):
+        raise ValidationException("Primary key validation is currently not supported.")
+
+    regex_part_integer = r"-?([0-9]+|[0-9]{1,3}(%s[0-9]{3})*)" % re.escape(digit_group_symb)
+
+    columns = []
+    for c in table.findall("./VariableLength/VariableColumn"):
+        name = c.find("./Name").text
+        if c.findall("./Numeric"):
+            regex = regex_part_integer
+            dec_places = 0
+            if c.findall("./Numeric/Accuracy"):
+                dec_places = int(c.find("./Numeric/Accuracy").text)
+                regex += r"%s[0-9]{%s}" % (re.escape(dec_symb), dec_places)
+            columns.append(ColumnSpec(name=name, kind="numeric", pattern=re.compile(regex), dec_places=dec_places))
+        elif c.findall("./AlphaNumeric"):
+            max_length = int(c.find("./MaxLength").text) if c.findall("./MaxLength") else None
+            columns.append(ColumnSpec(name=name, kind="alphanumeric", max_length=max_length))
+        elif c.findall("./Date"):
+            columns.append(ColumnSpec(name=name, kind="date"))
+        else:
+            columns.append(ColumnSpec(name=name, kind="unsupported"))
+
+    return TableSpec(
+        column_delim=table.find("./VariableLength/ColumnDelimiter").text,
+        record_delim=table.find("./VariableLength/RecordDelimiter").text,
+        text_encaps=table.find("./VariableLength/TextEncapsulator").text,
+        columns=columns,
+        # tables without all key columns are left out of the reference checks
+        key_columns=key_columns if set(key_columns) <= {c.name for c in columns} else (),
+    )
+
+
+def _check_table(source: Source, spec: TableSpec) -> TableResult:
+    """
+    Validate a single csv file row by row, runs in the worker processes of validate_files.
+    Structural errors end the check of the table, invalid values are collected as warnings.
+    """
+    result = TableResult()
+
+    def warn(msg: str):
+        result.n_warnings += 1
+        if result.n_warnings <= MAX_WARNINGS_PER_TABLE:
+            result.warnings.append(msg)
+
+    ncols = len(spec.columns)
+    key_indices = _key_indices(spec)
+    keys = result.keys
+    with _open_text(source, spec.record_delim) as csvfile:
+        csvreader = csv.reader(
+            csvfile, delimiter=spec.column_delim, quotechar=spec.text_encaps, quoting=csv.QUOTE_MINIMAL
+        )
+        try:
+            for i, row in enumerate(csvreader):
+                if len(row) != ncols:
+                    raise ValidationException(
+                        "Line {}: Row has {} fields but index.xml defines {} fields.".format(i + 1, len(row), ncols)
+                    )
+                if i == 0:
+                    for j, c in enumerate(spec.columns):
+                        if c.name != row[j]:
+                            raise ValidationException(
+                                "Expected column {} to be {}, but headline is {}.".format(j + 1, c.name, row[j])
+                            )
+                    continue
+
+                for j, c in enumerate(spec.columns):
+                    value = row[j]
+                    if c.kind == "numeric":
+                        if value == "":
+                            # It's unclear if empty strings are allowed in numeric fields
+                            continue
+                        if not c.pattern.fullmatch(value):
+                            warn(
+                                "Line {}: Value {} in column {} is not a valid decimal with {} places".format(
+                                    i + 1, value, j + 1, c.dec_places
+                                )
+                            )
+                    elif c.kind == "alphanumeric":
+                        if c.max_length is not None and len(value) > c.max_length:
+                            warn(
+                                "Line {}: Value {} in column {} is not allowed to have more than {} "
+                                "characters".format(i + 1, repr(value), j + 1, c.max_length)
+                            )
+                    elif c.kind == "date":
+                        raise ValidationException("Date validation currently not supported")
+                    else:
+                        raise ValidationException("Unsupported data type for column {}".format(j + 1))
+
+                result.n_rows += 1
+                if key_indices:
+                    keys.append(_key_hash([row[k] for k in key_indices]))
+        except ValidationException as exce:
+            result.error = str(exce)
+        except csv.Error as exce:
+            result.error = "Line {}: {}".format(csvreader.line_num, exce)
+
+    result.keys = array("q", sorted(set(keys)))
+    return result
+
+
+def _find_dangling(source: Source, spec: TableSpec, missing: set[int]) -> list[str]:
+    """Line numbers and keys of the rows of a table whose key hash is in missing"""
+    examples = []
+    key_indices = _key_indices(spec)
+    with _open_text(source, spec.record_delim) as csvfile:
+        csvreader = csv.reader(
+            csvfile, delimiter=spec.column_delim, quotechar=spec.text_encaps, quoting=csv.QUOTE_MINIMAL
+        )
+        next(csvreader, None)
+        for i, row in enumerate(csvreader, start=2):
+            key = [row[k] for k in key_indices]
+            if _key_hash(key) in missing:
+                examples.append("line {} ({})".format(i, ", ".join(key)))
+                if len(examples) >= MAX_REFERENCE_EXAMPLES:
+                    break
+    return examples
+
+
+def _missing_keys(child: array, parent: array) -> list[int]:
+    """Keys of the sorted array child that are not in the sorted array parent"""
+    missing = []
+    j = 0
+    n = len(parent)
+    for key in child:
+        while j < n and parent[j] < key:
+            j += 1
+        if j == n or parent[j] != key:
+            missing.append(key)
+    return missing
+
+
+def validate_files(filemap, jobs: Optional[int] = None):
+    """
+    Validate an export given as mapping of file name -> path or ZipMember.
+
+    The tables are checked concurrently in up to jobs worker processes (default: one per cpu), every table is
+    read row by row. Afterwards all records referencing a bon are checked to belong to a record of transactions.csv.
+    Invalid values are printed as warnings, the returned list contains all errors.
+    """
     errors = []
     if "index.xml" not in filemap:
         errors.append("No index.xml found")
         return errors
 
-    tree = ET.parse(filemap["index.xml"])
+    index = filemap["index.xml"]
+    if isinstance(index, ZipMember):
+        with zipfile.ZipFile(index.zip_path) as zf, zf.open(index.name) as f:
+            tree = ET.parse(f)
+    else:
+        tree = ET.parse(index)
     root = tree.getroot()
 
     version_node = root.find("./Version")
@@ -26,6 +276,8 @@ def validate_files(filemap):
         errors.append("index.xml version is not 1.0")
         return errors
 
+    # url -> error or (source, spec), in the order of index.xml
+    checks: dict[str, Union[str, tuple[Source, TableSpec]]] = {}
     for media in root.findall("./Media"):
         for table in media.findall("./Table"):
             url_node = table.find("./URL")
@@ -42,99 +294,98 @@ def validate_files(filemap):
                 errors.append("{}: Validator does only support UTF8.".format(url))
                 continue
 
+            key_columns = BON_KEY if url == BON_TABLE or url in BON_REFERENCES else ()
             try:
-                validate_table(filemap[url], table)
+                checks[url] = (filemap[url], _table_spec(table, key_columns))
             except ValidationException as exce:
-                errors.append("{}: {}".format(url, str(exce)))
-    return errors
-
+                checks[url] = str(exce)
 
-def validate_table(f, table):
-    dec_symb = table.find("./DecimalSymbol").text
-    digit_group_symb = table.find("./DigitGroupingSymbol").text
-    if not table.findall("./Range"):
-        range_start = 1
+    to_check = {url: check for url, check in checks.items() if isinstance(check, tuple)}
+    if jobs == 1 or len(to_check) <= 1:
+        results = {url: _check_table(source, spec) for url, (source, spec) in to_check.items()}
     else:
-        range_start = int(table.find("./Range").find("./From").text)
-    record_delim = table.find("./VariableLength/RecordDelimiter").text
-    column_delim = table.find("./VariableLength/ColumnDelimiter").text
-    text_encaps = table.find("./VariableLength/TextEncapsulator").text
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {url: executor.submit(_check_table, source, spec) for url, (source, spec) in to_check.items()}
+            results = {url: future.result() for url, future in futures.items()}
 
-    regex_part_integer = r"-?([0-9]+|[0-9]{1,3}(%s[0-9]{3})*)" % digit_group_symb
+    for url, check in checks.items():
+        if isinstance(check, str):
+            errors.append("{}: {}".format(url, check))
+            continue
+        result = results[url]
+        for warning in result.warnings:
+            print("{}: {}".format(url, warning))
+        if result.n_warnings > len(result.warnings):
+            print("{}: ... and {} more warnings".format(url, result.n_warnings - len(result.warnings)))
+        if result.error is not None:
+            errors.append("{}: {}".format(url, result.error))
 
-    if range_start != 2:
-        raise ValidationException(
-            "Range is != [2, End], this is not technically invalid but prevents ' ' column header validation."
-        )
+    errors.extend(_check_bon_references(to_check, results))
+    return errors
 
-    if table.findall("./FixedLength"):
-        raise ValidationException("Fixed length validation is currently not supported.")
 
-    if table.findall("./VariableLength/VariablePrimaryKey"):
-        raise ValidationException("Primary key validation is currently not supported.")
+def _check_bon_references(to_check: dict[str, tuple[Source, TableSpec]], results: dict[str, TableResult]):
+    errors = []
+    bon_result = results.get(BON_TABLE)
+    if bon_result is None or bon_result.error is not None:
+        return errors
+    if not to_check[BON_TABLE][1].key_columns:
+        return errors
+    if bon_result.n_rows != len(bon_result.keys):
+        errors.append(
+            "{}: {} records have a duplicate bon key".format(BON_TABLE, bon_result.n_rows - len(bon_result.keys))
+        )
 
-    with open(f, newline=record_delim, encoding="utf-8") as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=column_delim, quotechar=text_encaps, quoting=csv.QUOTE_MINIMAL)
-        coldefs = table.findall("./VariableLength/VariableColumn")
-        for i, row in enumerate(csvreader):
-            ncol_csv = len(row)
-            if ncol_csv != len(coldefs):
-                raise ValidationException(
-                    "Line {}: Row has {} fields but index.xml defines {} fields.".format(i + 1, ncol_csv, len(coldefs))
+    for url in BON_REFERENCES:
+        result = results.get(url)
+        if result is None or result.error is not None:
+            continue
+        source, spec = to_check[url]
+        if not spec.key_columns:
+            continue
+        missing = _missing_keys(result.keys, bon_result.keys)
+        if missing:
+            examples = _find_dangling(source, spec, set(missing))
+            errors.append(
+                "{}: {} referenced bons are missing in {}, e.g. {}".format(
+                    url, len(missing), BON_TABLE, "; ".join(examples)
                 )
-            if i == 0:
-                for j, c in enumerate(coldefs):
-                    if c.find("./Name").text != row[j]:
-                        raise ValidationException(
-                            "Expected column {} to be {}, but headline is {}.".format(
-                                j + 1, c.find("./Name").text, row[j]
-                            )
-                        )
-            else:
-                for j, c in enumerate(coldefs):
-                    if c.findall("./Numeric"):
-                        regex = regex_part_integer
-                        dec_places = 0
-                        if c.findall("./Numeric/Accuracy"):
-                            dec_places = int(c.find("./Numeric/Accuracy").text)
-                            regex += r"[%s]{1}[0-9]{%s}" % (dec_symb, dec_places)
-                        if row[j] == "":
-                            # It's unclear if empty strings are allowed in numeric fields
-                            continue
-                        if not re.match("^" + regex + "$", row[j]):
-                            print("^" + regex + "$", row[j])
-                            print(
-                                "Line {}: Value {} in column {} is not a valid decimal with {} places".format(
-                                    i + 1, row[j], j + 1, dec_places
-                                )
-                            )
-                    elif c.findall("./AlphaNumeric"):
-                        if c.findall("./MaxLength"):
-                            ml = int(c.find("./MaxLength").text)
-                            if len(row[j]) > ml:
-                                print(
-                                    "Line {}: Value {} in column {} is not allowed to have more than {} "
-                                    "characters".format(i + 1, repr(row[j]), j + 1, ml)
-                                )
-                    elif c.findall("./Date"):
-                        raise ValidationException("Date validation currently not supported")
-                    else:
-                        j = j + 1
-                        raise ValidationException("Unsupported data type for column {}".format(j))
+            )
+    return errors
 
 
-def validate_dir(dirname):
+def validate_table(f, table):
+    """Validate a single csv file (path or ZipMember) against its table element in index.xml."""
+    result = _check_table(f, _table_spec(table))
+    for warning in result.warnings:
+        print(warning)
+    if result.error is not None:
+        raise ValidationException(result.error)
+
+
+def validate_dir(dirname, jobs: Optional[int] = None):
     fmap = {}
     for f in os.listdir(dirname):
         fmap[f] = os.path.join(dirname, f)
-    return validate_files(fmap)
+    return validate_files(fmap, jobs=jobs)
+
+
+def validate_zip(filename, jobs: Optional[int] = None):
+    """Validate an export zip in place, the csv files are streamed from the zip without unpacking it."""
+    with zipfile.ZipFile(filename) as zf:
+        fmap = {name: ZipMember(str(filename), name) for name in zf.namelist()}
+    return validate_files(fmap, jobs=jobs)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Call me with a directory name as the first argument.")
+    if len(sys.argv) not in (2, 3):
+        print("Call me with a directory or zip file name as the first argument and optionally the number of jobs.")
         sys.exit(1)
-    errs = validate_dir(sys.argv[1])
+    n_jobs = int(sys.argv[2]) if len(sys.argv) == 3 else None
+    if zipfile.is_zipfile(sys.argv[1]):
+        errs = validate_zip(sys.argv[1], jobs=n_jobs)
+    else:
+        errs = validate_dir(sys.argv[1], jobs=n_jobs)
     if errs:
         print("Validation failed. Errors:")
         for e in errs:
@@ -1,9 +1,18 @@
+import asyncio
 import contextlib
 import logging
+import multiprocessing
+import shutil
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from decimal import Decimal
+from pathlib import Path
+from typing import AsyncIterator, Optional
 
+from asyncpg import Record
 from dateutil import parser
 from sftkit.database import Connection
 
@@ -16,6 +25,7 @@ from stustapay.core.service.tree.common import (
 from stustapay.tse.wrapper import PAYMENT_METHOD_TO_ZAHLUNGSART
 
 from ..core.database import get_database
+from .cache import ExportCache, fingerprint
 from .dsfinvk.collection import Collection
 from .dsfinvk.models import (
     Bonkopf,
@@ -47,6 +57,163 @@ ORDERTYPE_TO_KUNDETYP = {
     "money_transfer_imbalance": "intern",
 }
 
+# number of orders fetched per round trip from the server side order cursor
+ORDER_CURSOR_PREFETCH = 1000
+# a parallel export splits the tills into this many chunks per worker process to even out their run time
+CHUNKS_PER_JOB = 4
+
+# alle Kassen mit einer order (und damit auch mit einer TSE und die deshalb ans Finanzamt gemeldet wurden), with the
+# number of their orders to split the work for a parallel export
+_KASSEN_QUERY = """
+select o.till_id, count(*) as n_orders
+from
+    ordr o
+    join till t on o.till_id = t.id
+    join node n on t.node_id = n.id
+where
+    n.id = $1 or $1 = any(n.parent_ids)
+group by o.till_id
+order by o.till_id
+"""
+
+# one row per Kassenabschluss (Z_KASSE_ID = KASSE_SERIENNR bei uns, Z_NR) of the given tills. The time of the last
+# order is the time of the Kassenabschluss. The number of orders, the state of their signatures and the products of
+# their line items identify the state of a Kassenabschluss for the export cache. The signature state is taken from
+# the exported columns themselves, last_update is the start of the updating transaction and might commit out of order.
+_KASSENABSCHLUESSE_QUERY = """
+select
+    a.till_id,
+    a.z_nr,
+    a.z_start_id,
+    a.z_ende_id,
+    a.n_orders,
+    a.n_signatures_unsigned,
+    a.n_signatures_done,
+    a.n_signatures_failure,
+    a.signature_hash,
+    o.booked_at as z_erstellung,
+    p.product_ids
+from (
+    select
+        o.till_id,
+        o.z_nr,
+        min(o.id) as z_start_id,
+        max(o.id) as z_ende_id,
+        count(*) as n_orders,
+        count(*) filter (where s.signature_status in ('new', 'pending')) as n_signatures_unsigned,
+        count(*) filter (where s.signature_status = 'done') as n_signatures_done,
+        count(*) filter (where s.signature_status = 'failure') as n_signatures_failure,
+        md5(
+            string_agg(
+                row(
+                    s.id,
+                    s.signature_status,
+                    s.result_message,
+                    s.tse_id,
+                    s.tse_start,
+                    s.tse_end,
+                    s.tse_transaction,
+                    s.tse_signaturenr,
+                    s.transaction_process_type,
+                    s.transaction_process_data,
+                    s.tse_signature
+                )::text,
+                ',' order by s.id
+            )
+        ) as signature_hash
+    from
+        ordr o
+        left join tse_signature s on o.id = s.id
+    where o.till_id = any($1)
+    group by o.till_id, o.z_nr
+) a
+    join ordr o on o.id = a.z_ende_id
+    cross join lateral (
+        select coalesce(array_agg(distinct li.product_id order by li.product_id), '{}') as product_ids
+        from
+            line_item li
+            join ordr lo on li.order_id = lo.id
+        where lo.till_id = a.till_id and lo.z_nr = a.z_nr
+    ) p
+order by a.till_id, a.z_nr
+"""
+
+# summe aller line items je Zahlart der gegebenen Kassenabschlüsse ($1: till ids, $2: z_nrs)
+_ZAHLARTEN_QUERY = """
+select o.till_id, o.z_nr, o.payment_method, sum(li.total_price) as total_price
+from
+    line_item li
+    join ordr o on li.order_id = o.id
+    join unnest($1::bigint[], $2::bigint[]) as k(till_id, z_nr) on o.till_id = k.till_id and o.z_nr = k.z_nr
+group by o.till_id, o.z_nr, o.payment_method
+order by o.till_id, o.z_nr, o.payment_method
+"""
+
+# all orders of the given Kassenabschluesse ($1: till ids, $2: z_nrs) with their signatures, line items and aggregated tax rates, in the order of the
+# Kassenabschluesse.
+# line_items is built exactly like in the order_value view
+_ORDERS_QUERY = """
+select
+    o.till_id,
+    o.z_nr,
+    o.id,
+    o.payment_method,
+    o.cash_register_id,
+    o.cancels_order,
+    s.tse_start,
+    s.tse_end,
+    s.tse_id,
+    s.tse_transaction,
+    s.transaction_process_type,
+    s.tse_signaturenr,
+    s.transaction_process_data,
+    s.tse_signature,
+    o.cashier_id,
+    o.customer_account_id,
+    o.order_type,
+    o.item_count,
+    s.signature_status,
+    s.result_message,
+    coalesce(li.total_price, 0) as total_price,
+    coalesce(li.line_items, json_build_array()) as line_items,
+    tr.tax_names,
+    tr.tax_total_prices,
+    tr.tax_total_taxes,
+    tr.tax_total_no_taxes
+from
+    ordr o
+    join unnest($1::bigint[], $2::bigint[]) as k(till_id, z_nr) on o.till_id = k.till_id and o.z_nr = k.z_nr
+    join tse_signature s on o.id = s.id
+    left join lateral (
+        select sum(l.total_price) as total_price, json_agg(l order by l.item_id) as line_items
+        from (
+            select line_item.*, row_to_json(p) as product
+            from line_item join product_with_tax_and_restrictions p on line_item.product_id = p.id
+            where line_item.order_id = o.id
+        ) l
+    ) li on true
+    left join lateral (
+        select
+            array_agg(r.tax_name order by r.tax_rate, r.tax_name) as tax_names,
+            array_agg(r.total_price order by r.tax_rate, r.tax_name) as tax_total_prices,
+            array_agg(r.total_tax order by r.tax_rate, r.tax_name) as tax_total_taxes,
+            array_agg(r.total_no_tax order by r.tax_rate, r.tax_name) as tax_total_no_taxes
+        from (
+            select
+                tax_name,
+                tax_rate,
+                sum(total_price) as total_price,
+                sum(total_tax) as total_tax,
+                sum(total_price - total_tax) as total_no_tax
+            from line_item
+            where order_id = o.id
+            group by tax_rate, tax_name
+        ) r
+    ) tr on true
+order by
+    o.till_id, o.z_nr, o.id
+"""
+
 
 class BNU:
     Brutto = Decimal(0)
@@ -54,8 +221,92 @@ class BNU:
     USt = Decimal(0)
 
 
+@dataclass
+class Kassenabschluss:
+    Z_KASSE_ID: int
+    Z_NR: int
+    Z_ERSTELLUNG: datetime
+    Z_START_ID: int  # erste BON_ID in diesem Abschluss
+    Z_ENDE_ID: int  # letzte BON_ID in diesem Abschluss
+    n_orders: int
+    # anzahl der Signaturen je Status und ein Hash über alle exportierten Signaturdaten in diesem Abschluss
+    n_signatures_unsigned: int
+    n_signatures_done: int
+    n_signatures_failure: int
+    signature_hash: str | None
+    # alle Produkte der line items in diesem Abschluss
+    product_ids: list[int] = field(default_factory=list)
+    # payment method -> summe der line items, nur Zahlarten mit line items
+    summe_je_zahlart: dict[str, Decimal] = field(default_factory=dict)
+
+
+def split_kassen(kassen: list[Record], n_chunks: int) -> list[list[int]]:
+    """
+    Split the ordered tills into at most n_chunks contiguous chunks with about the same number of orders.
+    """
+    total = sum(row["n_orders"] for row in kassen)
+    target = max(1, -(-total // n_chunks))
+    chunks: list[list[int]] = [[]]
+    n_orders = 0
+    for row in kassen:
+        if n_orders >= target:
+            chunks.append([])
+            n_orders = 0
+        chunks[-1].append(row["till_id"])
+        n_orders += row["n_orders"]
+    return chunks
+
+
+async def _export_chunk(generator: "Generator", till_ids: list[int], snapshot: str, directory: Path) -> list[str]:
+    async with contextlib.AsyncExitStack() as es:
+        db = get_database(generator.config.database)
+        db_pool = await db.create_pool(n_connections=1)
+        es.push_async_callback(db_pool.close)
+        conn: Connection = await es.enter_async_context(db_pool.acquire())
+        await es.enter_async_context(conn.transaction(isolation="repeatable_read", readonly=True))
+        await conn.execute(f"set transaction snapshot '{snapshot}'")
+        await generator.export_kassen(conn, till_ids=till_ids)
+        return generator.c.save(directory)
+
+
+def export_chunk(
+    config: Config,
+    event_node_id: int,
+    till_ids: list[int],
+    snapshot: str,
+    directory: str,
+    cache_dir: Optional[str],
+) -> list[str]:
+    """
+    Worker process entry point of a parallel export, writes the tables of the given tills into directory.
+    """
+    generator = Generator(
+        config=config,
+        event_node_id=event_node_id,
+        filename="",
+        xml="",
+        dtd="",
+        simulate=True,
+        cache_dir=cache_dir,
+    )
+    try:
+        return asyncio.run(_export_chunk(generator, till_ids=till_ids, snapshot=snapshot, directory=Path(directory)))
+    finally:
+        generator.c.close()
+
+
 class Generator:
-    def __init__(self, config: Config, event_node_id: int, filename: str, xml: str, dtd: str, simulate: bool):
+    def __init__(
+        self,
+        config: Config,
+        event_node_id: int,
+        filename: str,
+        xml: str,
+        dtd: str,
+        simulate: bool,
+        jobs: int = 1,
+        cache_dir: Optional[str] = None,
+    ):
         self.node_id = event_node_id
         self.config = config
         self.filename = filename
@@ -63,76 +314,250 @@ class Generator:
         self.dtd = dtd  # path to *.dtd file
         self.c = Collection()
         self.simulate = simulate
+        self.jobs = jobs  # number of worker processes
+        self.cache_dir = cache_dir
+        self.cache = ExportCache(Path(cache_dir), node_id=event_node_id) if cache_dir is not None else None
         self.starttime = time.monotonic()
         self.GV_SUMME: dict = dict()  # aufsummierte Geschäftsvorfalltypen
         self.PLZ = ""
         self.Street = ""
         self.City = ""
+        # stammdaten, which are loaded once for the whole export
+        self.tax_rates: list[Record] = []
+        self.tses: dict[int, Record] = {}
+        self.till_tse_ids: dict[int, int | None] = {}
+        self.till_tse_history: dict[str, list[Record]] = {}
+        self.products: dict[int, Record] = {}
 
     async def run(self):
         async with contextlib.AsyncExitStack() as es:
             db = get_database(self.config.database)
             db_pool = await db.create_pool(n_connections=2)
             es.push_async_callback(db_pool.close)
+            es.callback(self.c.close)
             conn: Connection = await es.enter_async_context(db_pool.acquire())
-            node = await fetch_node(conn=conn, node_id=self.node_id)
-            assert node is not None
-            event_settings = await fetch_restricted_event_settings_for_node(conn=conn, node_id=self.node_id)
-
-            # extract address information
-            bon_addr = event_settings.bon_address
-            if "\n" in bon_addr:
-                self.Street = bon_addr.split("\n")[0]
-                self.PLZ = bon_addr.split("\n")[1].split(" ")[0]
-                self.City = bon_addr.split("\n")[1].split(" ")[1]
-            else:
-                self.Street = bon_addr.split(" ")[0] + " " + bon_addr.split(" ")[1]
-                self.PLZ = bon_addr.split(" ")[2]
-                self.City = bon_addr.split(" ")[3]
+            # the server side order cursor needs a transaction, it also gives us a consistent snapshot of all tables
+            await es.enter_async_context(conn.transaction(isolation="repeatable_read", readonly=True))
 
             # iteriere über alle Kassen Z_KASSE_ID (= KASSE_SERIENNR bei uns)
-            # alle Kassen mit einer order (und damit auch mit einer TSE und die deshalb ans Finanzamt gemeldet wurden)
-            for row in await conn.fetch(
-                "select distinct o.till_id "
-                "from ordr o "
-                "   join till t on o.till_id = t.id "
-                "   join node n on t.node_id = n.id "
-                "where n.id = $1 or $1 = any(n.parent_ids) "
-                "order by o.till_id",
-                node.id,
-            ):
-                Z_KASSE_ID: int = row["till_id"]
+            kassen = await conn.fetch(_KASSEN_QUERY, self.node_id)
+            if self.jobs > 1 and len(kassen) > 1:
+                # the workers export from the very same snapshot as this transaction, which has to stay open until
+                # they are done
+                snapshot = await conn.fetchval("select pg_export_snapshot()")
+                await self.export_parallel(kassen, snapshot=snapshot)
+            else:
+                await self.export_kassen(conn, till_ids=[row["till_id"] for row in kassen])
 
-                # iteriere über Kassenabschlüsse Z_NR dieser Kassen
-                for row in await conn.fetch(
-                    "select z_nr from ordr where till_id = $1 group by z_nr order by z_nr", Z_KASSE_ID
-                ):  # alle Kassenabschlussids
-                    Z_NR: int = row["z_nr"]
+            self.finalize()  # schreibe die Datei
+            LOGGER.info(f"Duration: {time.monotonic() - self.starttime:.3f}s")
+            return
 
-                    # hole alle order dieser Kasse und Kassenabschluss und nimm den Zeitpunkt der letzten für den Kassenabschluss
-                    last_order_time = await conn.fetchval(
-                        "select booked_at from ordr where till_id = $1 and z_nr = $2 order by id desc", Z_KASSE_ID, Z_NR
-                    )
-                    Z_ERSTELLUNG: datetime = last_order_time
+    async def export_kassen(self, conn: Connection, till_ids: list[int]):
+        node = await fetch_node(conn=conn, node_id=self.node_id, with_translations=False)
+        assert node is not None
+        event_settings = await fetch_restricted_event_settings_for_node(conn=conn, node_id=self.node_id)
+
+        # extract address information
+        bon_addr = event_settings.bon_address
+        if "\n" in bon_addr:
+            self.Street = bon_addr.split("\n")[0]
+            self.PLZ = bon_addr.split("\n")[1].split(" ")[0]
+            self.City = bon_addr.split("\n")[1].split(" ")[1]
+        else:
+            self.Street = bon_addr.split(" ")[0] + " " + bon_addr.split(" ")[1]
+            self.PLZ = bon_addr.split(" ")[2]
+            self.City = bon_addr.split(" ")[3]
+
+        # alle Kassenabschlüsse Z_NR dieser Kassen Z_KASSE_ID, sortiert nach Kasse und Abschluss
+        kassenabschluesse = [
+            Kassenabschluss(
+                Z_KASSE_ID=row["till_id"],
+                Z_NR=row["z_nr"],
+                Z_ERSTELLUNG=row["z_erstellung"],
+                Z_START_ID=row["z_start_id"],
+                Z_ENDE_ID=row["z_ende_id"],
+                n_orders=row["n_orders"],
+                n_signatures_unsigned=row["n_signatures_unsigned"],
+                n_signatures_done=row["n_signatures_done"],
+                n_signatures_failure=row["n_signatures_failure"],
+                signature_hash=row["signature_hash"],
+                product_ids=row["product_ids"],
+            )
+            for row in await conn.fetch(_KASSENABSCHLUESSE_QUERY, till_ids)
+        ]
 
-                    # sammle Einzelaufzeichnungsmodul
-                    await self.einzelaufzeichnungsmodul(
-                        conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, event_settings=event_settings
-                    )
-                    # sammle Stammdatenmodul
-                    await self.stammdatenmodul(
-                        conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, node=node, event_settings=event_settings
-                    )
-                    # sammle Kassenabschlussmodul
-                    await self.kassenabschlussmodul(conn, Z_NR, Z_ERSTELLUNG, Z_KASSE_ID, event_settings=event_settings)
+        product_ids = {product_id for abschluss in kassenabschluesse for product_id in abschluss.product_ids}
+        await self.load_stammdaten(conn, node=node, till_ids=till_ids, product_ids=list(product_ids))
 
-            self.finalize()  # schreibe die Datei
-            LOGGER.info(f"Duration: {time.monotonic() - self.starttime:.3f}s")
+        if self.cache is None:
+            async for _ in self.abschluesse_exportieren(
+                conn, kassenabschluesse, node=node, event_settings=event_settings
+            ):
+                pass
             return
 
-    async def einzelaufzeichnungsmodul(
-        self, conn, Z_NR: int, Z_ERSTELLUNG: datetime, Z_KASSE_ID: int, event_settings: RestrictedEventSettings
-    ):
+        # nur neue oder veränderte Kassenabschlüsse werden neu berechnet, alle anderen kommen aus dem Cache
+        fingerprints: dict[tuple[int, int], str] = {}
+        tables: dict[tuple[int, int], list[str]] = {}
+        fehlend: list[Kassenabschluss] = []
+        for abschluss in kassenabschluesse:
+            key = (abschluss.Z_KASSE_ID, abschluss.Z_NR)
+            fingerprints[key] = self.abschluss_fingerprint(abschluss, event_settings=event_settings)
+            cached = self.cache.load(abschluss.Z_KASSE_ID, abschluss.Z_NR, fingerprints[key])
+            if cached is None:
+                fehlend.append(abschluss)
+            else:
+                tables[key] = cached
+        LOGGER.info(f"{len(tables)} of {len(kassenabschluesse)} Kassenabschlüsse taken from the export cache")
+
+        output = self.c
+        try:
+            # every Kassenabschluss is collected on its own and stored in the cache
+            self.c = Collection()
+            async for abschluss in self.abschluesse_exportieren(
+                conn, fehlend, node=node, event_settings=event_settings
+            ):
+                key = (abschluss.Z_KASSE_ID, abschluss.Z_NR)
+                tables[key] = self.cache.store(abschluss.Z_KASSE_ID, abschluss.Z_NR, fingerprints[key], self.c)
+                self.c.close()
+                self.c = Collection()
+        finally:
+            self.c.close()
+            self.c = output
+
+        for abschluss in kassenabschluesse:
+            self.c.extend(
+                self.cache.path(abschluss.Z_KASSE_ID, abschluss.Z_NR), tables[(abschluss.Z_KASSE_ID, abschluss.Z_NR)]
+            )
+
+    async def abschluesse_exportieren(
+        self,
+        conn: Connection,
+        kassenabschluesse: list[Kassenabschluss],
+        node: Node,
+        event_settings: RestrictedEventSettings,
+    ) -> AsyncIterator[Kassenabschluss]:
+        """
+        Collect all records of the given Kassenabschlüsse, yields every Kassenabschluss after all of its records were
+        added.
+        """
+        keys = [abschluss.Z_KASSE_ID for abschluss in kassenabschluesse], [
+            abschluss.Z_NR for abschluss in kassenabschluesse
+        ]
+        by_key = {(abschluss.Z_KASSE_ID, abschluss.Z_NR): abschluss for abschluss in kassenabschluesse}
+        for row in await conn.fetch(_ZAHLARTEN_QUERY, *keys):
+            by_key[(row["till_id"], row["z_nr"])].summe_je_zahlart[row["payment_method"]] = row["total_price"]
+
+        # die orders kommen in der Reihenfolge der Kassenabschlüsse, jeder Abschluss wird nach seiner letzten
+        # order abgeschlossen
+        remaining = iter(kassenabschluesse)
+        current: Kassenabschluss | None = None
+        async for row in conn.cursor(_ORDERS_QUERY, *keys, prefetch=ORDER_CURSOR_PREFETCH):
+            while current is None or (current.Z_KASSE_ID, current.Z_NR) != (row["till_id"], row["z_nr"]):
+                if current is not None:
+                    self.abschluss_beenden(current, node=node, event_settings=event_settings)
+                    yield current
+                current = next(remaining)
+                self.abschluss_beginnen()
+            # sammle Einzelaufzeichnungsmodul
+            self.einzelaufzeichnungsmodul(row, current, event_settings=event_settings)
+        if current is not None:
+            self.abschluss_beenden(current, node=node, event_settings=event_settings)
+            yield current
+        for abschluss in remaining:
+            self.abschluss_beginnen()
+            self.abschluss_beenden(abschluss, node=node, event_settings=event_settings)
+            yield abschluss
+
+    def abschluss_fingerprint(self, abschluss: Kassenabschluss, event_settings: RestrictedEventSettings) -> str:
+        """
+        Identifies everything the records of a Kassenabschluss are generated from.
+        """
+        history = self.till_tse_history.get(str(abschluss.Z_KASSE_ID), [])
+        tse_ids = sorted(
+            {entry["tse_id"] for entry in history}
+            | ({self.till_tse_ids[abschluss.Z_KASSE_ID]} if self.till_tse_ids.get(abschluss.Z_KASSE_ID) else set())
+        )
+        return fingerprint(
+            abschluss.Z_KASSE_ID,
+            abschluss.Z_NR,
+            abschluss.Z_ERSTELLUNG,
+            abschluss.Z_START_ID,
+            abschluss.Z_ENDE_ID,
+            abschluss.n_orders,
+            abschluss.n_signatures_unsigned,
+            abschluss.n_signatures_done,
+            abschluss.n_signatures_failure,
+            abschluss.signature_hash,
+            event_settings.bon_issuer,
+            event_settings.bon_address,
+            event_settings.ust_id,
+            event_settings.currency_identifier,
+            [list(row.values()) for row in self.tax_rates],
+            self.till_tse_ids.get(abschluss.Z_KASSE_ID),
+            [list(entry.values()) for entry in history],
+            [list(self.tses[tse_id].values()) for tse_id in tse_ids if tse_id in self.tses],
+            [list(self.products[product_id].values()) for product_id in abschluss.product_ids],
+        )
+
+    async def export_parallel(self, kassen: list[Record], snapshot: str):
+        """
+        Export contiguous ranges of tills in worker processes and append their tables in till order, which results
+        in exactly the same files as a sequential export.
+        """
+        chunks = split_kassen(kassen, n_chunks=self.jobs * CHUNKS_PER_JOB)
+        LOGGER.info(f"Exporting {len(kassen)} tills in {len(chunks)} chunks with {self.jobs} worker processes")
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory(prefix="dsfinvk-") as tmp_dir:
+            # don't fork the running event loop and its database connections into the workers
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = []
+                for i, till_ids in enumerate(chunks):
+                    chunk_dir = Path(tmp_dir) / str(i)
+                    chunk_dir.mkdir()
+                    futures.append(
+                        loop.run_in_executor(
+                            pool,
+                            export_chunk,
+                            self.config,
+                            self.node_id,
+                            till_ids,
+                            snapshot,
+                            str(chunk_dir),
+                            self.cache_dir,
+                        )
+                    )
+                for i, future in enumerate(futures):
+                    tables = await future
+                    self.c.extend(Path(tmp_dir) / str(i), tables)
+                    shutil.rmtree(Path(tmp_dir) / str(i))
+
+    async def load_stammdaten(self, conn: Connection, node: Node, till_ids: list[int], product_ids: list[int]):
+        self.tax_rates = await conn.fetch("select name, rate, description from tax_rate where node_id = $1", node.id)
+        for row in await conn.fetch("select id, tse_id from till where id = any($1)", till_ids):
+            self.till_tse_ids[row["id"]] = row["tse_id"]
+        self.till_tse_history = {}
+        for row in await conn.fetch(
+            "select till_id, what, tse_id, z_nr, date from till_tse_history where till_id = any($1) "
+            "order by till_id, z_nr",
+            [str(till_id) for till_id in till_ids],
+        ):
+            self.till_tse_history.setdefault(row["till_id"], []).append(row)
+        tse_ids = {row["tse_id"] for history in self.till_tse_history.values() for row in history}
+        tse_ids.update(tse_id for tse_id in self.till_tse_ids.values() if tse_id is not None)
+        for row in await conn.fetch(
+            "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
+            "   tse.public_key, tse.certificate "
+            "from tse where id = any($1)",
+            list(tse_ids),
+        ):
+            self.tses[row["id"]] = row
+        # only the product columns which end up in the exported lines
+        for row in await conn.fetch("select id, name, is_returnable from product where id = any($1)", product_ids):
+            self.products[row["id"]] = row
+
+    def abschluss_beginnen(self):
         self.GV_SUMME = {
             "MehrzweckgutscheinKauf": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
             "Geldtransit": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
@@ -143,236 +568,231 @@ class Generator:
             "Umsatz": {1: BNU(), 2: BNU(), 5: BNU(), 1337: BNU()},
         }  # leeren
 
+    def abschluss_beenden(self, abschluss: Kassenabschluss, node: Node, event_settings: RestrictedEventSettings):
+        # sammle Stammdatenmodul
+        self.stammdatenmodul(abschluss, node=node, event_settings=event_settings)
+        # sammle Kassenabschlussmodul
+        self.kassenabschlussmodul(abschluss, event_settings=event_settings)
+
+    def einzelaufzeichnungsmodul(
+        self, row: Record, abschluss: Kassenabschluss, event_settings: RestrictedEventSettings
+    ):
+        Z_KASSE_ID = abschluss.Z_KASSE_ID
+        Z_ERSTELLUNG = abschluss.Z_ERSTELLUNG
+        Z_NR = abschluss.Z_NR
+
         ### a transactions.csv ###
         ### b transactions_tse.csv ###
         ### c transactions_vat.csv ###
         ### d datapayment.csv ###
-        # alle orders für diese Kasse und Abschluss abfragen:
-        for row in await conn.fetch(
-            """
-            select
-                ordr.id,
-                ordr.payment_method,
-                ordr.cash_register_id,
-                ordr.cancels_order,
-                tse_signature.tse_start,
-                tse_signature.tse_end,
-                tse_signature.tse_id,
-                tse_signature.tse_transaction,
-                tse_signature.transaction_process_type,
-                tse_signature.tse_signaturenr,
-                tse_signature.transaction_process_data,
-                tse_signature.tse_signature,
-                ordr.cashier_id,
-                ordr.customer_account_id,
-                ordr.order_type,
-                ordr.item_count,
-                tse_signature.signature_status,
-                tse_signature.result_message,
-                order_value.total_price,
-                order_value.line_items
-            from
-                ordr
-            join
-                tse_signature on ordr.id=tse_signature.id
-            join
-                order_value on ordr.id=order_value.id
-            where
-                ordr.till_id = $1
-                and ordr.z_nr = $2
-            order by
-                ordr.id
-            """,
-            Z_KASSE_ID,
-            Z_NR,
-        ):
-            if row["signature_status"] == "new" or row["signature_status"] == "pending":
-                LOGGER.warning("Nicht Signierte Transaktion, wird nicht exportiert")
-                continue  # signatur noch nicht fertig
+        if row["signature_status"] == "new" or row["signature_status"] == "pending":
+            LOGGER.warning("Nicht Signierte Transaktion, wird nicht exportiert")
+            return  # signatur noch nicht fertig
 
-            a = Bonkopf()
-            b = TSE_Transaktionen()
+        bon_id = row["id"]
+        # per-order records are written as plain rows, see Model.row, creating a Model per record is too slow here
+        abschluss_felder = dict(Z_KASSE_ID=Z_KASSE_ID, Z_ERSTELLUNG=Z_ERSTELLUNG, Z_NR=Z_NR, BON_ID=bon_id)
 
-            a.Z_KASSE_ID = Z_KASSE_ID
-            a.Z_ERSTELLUNG = Z_ERSTELLUNG
-            a.Z_NR = Z_NR
-            b.Z_KASSE_ID = Z_KASSE_ID
-            b.Z_ERSTELLUNG = Z_ERSTELLUNG
-            b.Z_NR = Z_NR
+        a = dict(abschluss_felder, BON_NR=bon_id)  # bon_id und Bon_nr sind gleich
+        b = dict(abschluss_felder)
 
-            a.BON_ID = row["id"]  # bon_id und Bon_nr sind gleich
-            a.BON_NR = row["id"]
-            b.BON_ID = row["id"]
+        if row["signature_status"] == "failure":
+            b["TSE_TA_FEHLER"] = f'TSE Fehler: {row["result_message"]}'  # TODO Fehlerbehandlung
+        else:
+            tse_start = parser.isoparse(row["tse_start"].split(".")[0]).astimezone()
+            tse_end = parser.isoparse(row["tse_end"].split(".")[0]).astimezone()
+            b["TSE_ID"] = int(row["tse_id"])
+            b["TSE_TANR"] = int(row["tse_transaction"])
+            a["BON_START"] = tse_start  # TSE_start
+            a["BON_ENDE"] = tse_end
+            b["TSE_TA_START"] = tse_start
+            b["TSE_TA_ENDE"] = tse_end
+            b["TSE_TA_VORGANGSART"] = row["transaction_process_type"]
+            b["TSE_TA_SIGZ"] = int(row["tse_signaturenr"])
+            b["TSE_TA_SIG"] = row["tse_signature"]
+            b["TSE_TA_VORGANGSDATEN"] = row["transaction_process_data"]
+
+        a["BON_TYP"] = "Beleg"
+        a["BON_NAME"] = row["order_type"]
+
+        a["BEDIENER_ID"] = row["cashier_id"]  # Kassierer NR
+
+        a["UMS_BRUTTO"] = Decimal(row["total_price"])
+        a["KUNDE_ID"] = row["customer_account_id"]
+        a["KUNDE_TYP"] = ORDERTYPE_TO_KUNDETYP[row["order_type"]]
+
+        # Storno
+        if row["cancels_order"] is not None:
+            a["BON_NOTIZ"] = f"Storno von BON_ID {row['cancels_order']}"
+            a["BON_STORNO"] = True
+
+        # einmal über alle Umsatzsteuersätze je Order iterieren, die kommen aggregiert mit der order
+        if row["item_count"] != 0:
+            for tax_name, total_price, total_tax, total_no_tax in zip(
+                row["tax_names"] or [],
+                row["tax_total_prices"] or [],
+                row["tax_total_taxes"] or [],
+                row["tax_total_no_taxes"] or [],
+            ):
+                self.c.add_row(
+                    Bonkopf_USt,
+                    **abschluss_felder,
+                    UST_SCHLUESSEL=TAXNAME_TO_SCHLUESSELNUMMER[tax_name],
+                    BON_BRUTTO=Decimal(total_price),
+                    BON_NETTO=Decimal(total_no_tax),
+                    BON_UST=Decimal(total_tax),
+                )
+        else:
+            LOGGER.warning(f"Order {row['id']} has no line_items...")
+
+        # eigentlich nur eine Zahlart pro Order, AUßER es wird ein Gutschein eingesetzt
+        # TODO Gutscheinfall? vielleicht auch in die Datei Bonpos_Preisfindung, Zahlart ist eh immer 'tag'?
+        self.c.add_row(
+            Bonkopf_Zahlarten,
+            **abschluss_felder,
+            ZAHLART_TYP=PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]],  # 'Bar'/'Unbar'
+            ZAHLART_NAME=row["payment_method"],
+            ZAHLWAEH_CODE=event_settings.currency_identifier,
+            ZAHLWAEH_BETRAG=Decimal(0),  # Fremdwährung, bei uns immer 0
+            BASISWAEH_BETRAG=Decimal(row["total_price"]),  # Bezahlter betrag in Grundwährung
+            # Nummer der Kassenschublade (nur bei Kassen, die Bargeld annehmen), Eigenkreation in Anlehnung an FAQ vom Bundesfinanzministerium zum Kassengesetz
+            KASSENSCHUBLADENNR=row["cash_register_id"],
+        )
 
-            if row["signature_status"] == "failure":
-                b.TSE_TA_FEHLER = f'TSE Fehler: {row["result_message"]}'  # TODO Fehlerbehandlung
-            else:
-                b.TSE_ID = int(row["tse_id"])
-                b.TSE_TANR = int(row["tse_transaction"])
-                a.BON_START = parser.isoparse(row["tse_start"].split(".")[0]).astimezone()  # TSE_start
-                a.BON_ENDE = parser.isoparse(row["tse_end"].split(".")[0]).astimezone()
-                b.TSE_TA_START = parser.isoparse(row["tse_start"].split(".")[0]).astimezone()
-                b.TSE_TA_ENDE = parser.isoparse(row["tse_end"].split(".")[0]).astimezone()
-                b.TSE_TA_VORGANGSART = row["transaction_process_type"]
-                b.TSE_TA_SIGZ = int(row["tse_signaturenr"])
-                b.TSE_TA_SIG = row["tse_signature"]
-                b.TSE_TA_VORGANGSDATEN = row["transaction_process_data"]
-
-            a.BON_TYP = "Beleg"
-            a.BON_NAME = row["order_type"]
-
-            a.BEDIENER_ID = row["cashier_id"]  # Kassierer NR
-
-            a.UMS_BRUTTO = Decimal(row["total_price"])
-            a.KUNDE_ID = row["customer_account_id"]
-            a.KUNDE_TYP = ORDERTYPE_TO_KUNDETYP[row["order_type"]]
-
-            # Storno
-            if row["cancels_order"] is not None:
-                a.BON_NOTIZ = f"Storno von BON_ID {row['cancels_order']}"
-                a.BON_STORNO = True
-            else:
-                pass
+        self.c.add_row(Bonkopf, **a)
+        self.c.add_row(TSE_Transaktionen, **b)
+        ### /datapayment.csv ###
+        ### /transactions_vat.csv ###
+        ### /transactions_tse.csv ###
+        ### /transactions.csv ###
 
-            # einmal über alle Umsatzsteuersätze je Order iterieren
-            # leider müssen wir da wieder eine db abfrage machen....
-            if row["item_count"] != 0:
-                for line in await conn.fetch(
-                    "select tax_name, total_price, total_tax, total_no_tax from order_tax_rates where id = $1",
-                    row["id"],
-                ):
-                    c = Bonkopf_USt()
-                    c.Z_KASSE_ID = Z_KASSE_ID
-                    c.Z_ERSTELLUNG = Z_ERSTELLUNG
-                    c.Z_NR = Z_NR
-
-                    c.BON_ID = row["id"]
-                    c.UST_SCHLUESSEL = TAXNAME_TO_SCHLUESSELNUMMER[line["tax_name"]]
-                    c.BON_BRUTTO = Decimal(line["total_price"])
-                    c.BON_NETTO = Decimal(line["total_no_tax"])
-                    c.BON_UST = Decimal(line["total_tax"])
-
-                    self.c.add(c)
-            else:
-                LOGGER.warning(f"Order {row['id']} has no line_items...")
-
-            d = Bonkopf_Zahlarten()  # eigentlich nur eine Zahlart pro Order, AUßER es wird ein Gutschein eingesetzt
-            d.Z_KASSE_ID = Z_KASSE_ID
-            d.Z_ERSTELLUNG = Z_ERSTELLUNG
-            d.Z_NR = Z_NR
-            # TODO Gutscheinfall? vielleicht auch in die Datei Bonpos_Preisfindung, Zahlart ist eh immer 'tag'?
-            d.BON_ID = row["id"]
-            d.ZAHLART_TYP = PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]]  # 'Bar'/'Unbar'
-            d.ZAHLART_NAME = row["payment_method"]
-            d.ZAHLWAEH_CODE = event_settings.currency_identifier
-            d.ZAHLWAEH_BETRAG = Decimal(0)  # Fremdwährung, bei uns immer 0
-            d.BASISWAEH_BETRAG = Decimal(row["total_price"])  # Bezahlter betrag in Grundwährung
-            d.KASSENSCHUBLADENNR = row[
-                "cash_register_id"
-            ]  # Nummer der Kassenschublade (nur bei Kassen, die Bargeld annehmen), Eigenkreation in Anlehnung an FAQ vom Bundesfinanzministerium zum Kassengesetz
-            self.c.add(d)
+        # so, und jetzt noch für jede dieser Transaktionen noch die einzelnen Zeilen
+        ### lines.csv ###
+        for item in row["line_items"]:
+            # finde den Geschäftsvorfalltyp dieses "Artikels" heraus...
+            if row["order_type"] == "top_up" or row["order_type"] == "pay_out":
+                gvtyp = "MehrzweckgutscheinKauf"
+            elif row["order_type"] == "money_transfer":
+                gvtyp = "Geldtransit"
 
-            self.c.add(a)
-            self.c.add(b)
-            ### /datapayment.csv ###
-            ### /transactions_vat.csv ###
-            ### /transactions_tse.csv ###
-            ### /transactions.csv ###
-
-            # so, und jetzt noch für jede dieser Transaktionen noch die einzelnen Zeilen
-            ### lines.csv ###
-            for item in row["line_items"]:
-                e = Bonpos()
-                e.Z_KASSE_ID = Z_KASSE_ID
-                e.Z_ERSTELLUNG = Z_ERSTELLUNG
-                e.Z_NR = Z_NR
-                e.BON_ID = row["id"]
-                e.POS_ZEILE = item["item_id"] + 1  # weiß nicht, ob das Finanzamt bei 0 anfängt zu zählen
-                e.ARTIKELTEXT = item["product"]["name"]
-                e.ART_NR = item["product"]["id"]
-                e.MENGE = Decimal(item["quantity"])
-                e.INHAUS = False  # TODO nachgucken, ob wichtig. jetzt erstmal alles als Außerhausverkauf
-                e.P_STORNO = False  # nicht vorgesehen
-                e.AGENTUR_ID = 0  # Agenturen noch nicht implementiert
-
-                # finde den Geschäftsvorfalltyp dieses "Artikels" heraus...
-                if row["order_type"] == "top_up" or row["order_type"] == "pay_out":
-                    gvtyp = "MehrzweckgutscheinKauf"
-                elif row["order_type"] == "money_transfer":
-                    gvtyp = "Geldtransit"
-
-                elif row["order_type"] == "money_transfer_imbalance":
-                    gvtyp = "DifferenzSollIst"
-
-                elif row["order_type"] == "sale":
-                    if item["product"]["is_returnable"] and item["total_price"] > 0:
-                        gvtyp = "Pfand"
-
-                    elif item["product"]["is_returnable"] and item["total_price"] < 0:
-                        gvtyp = "PfandRueckzahlung"
-
-                    else:
-                        gvtyp = "MehrzweckgutscheinEinloesung"
-                elif row["order_type"] == "ticket":
-                    if item["product"]["name"].startswith(
-                        "Eintritt"
-                    ):  # TODO Eintritt kann nicht anders benannt werden, muss evtl noch spezielles Flag bekommen
-                        gvtyp = "Umsatz"  # Eintritt
-                    elif (
-                        item["product"]["name"] == "Aufladen"
-                    ):  # TODO besser noch, alle Aufladeoperationen bekommen ein bestimmtes Flag
-                        gvtyp = "MehrzweckgutscheinKauf"
+            elif row["order_type"] == "money_transfer_imbalance":
+                gvtyp = "DifferenzSollIst"
+
+            elif row["order_type"] == "sale":
+                if item["product"]["is_returnable"] and item["total_price"] > 0:
+                    gvtyp = "Pfand"
+
+                elif item["product"]["is_returnable"] and item["total_price"] < 0:
+                    gvtyp = "PfandRueckzahlung"
 
                 else:
-                    gvtyp = "Umsatz"  # alles andere
+                    gvtyp = "MehrzweckgutscheinEinloesung"
+            elif row["order_type"] == "ticket":
+                if item["product"]["name"].startswith(
+                    "Eintritt"
+                ):  # TODO Eintritt kann nicht anders benannt werden, muss evtl noch spezielles Flag bekommen
+                    gvtyp = "Umsatz"  # Eintritt
+                elif (
+                    item["product"]["name"] == "Aufladen"
+                ):  # TODO besser noch, alle Aufladeoperationen bekommen ein bestimmtes Flag
+                    gvtyp = "MehrzweckgutscheinKauf"
 
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Brutto += Decimal(
-                    item["total_price"]
-                )
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].USt += Decimal(
-                    item["total_tax"]
-                )
-                self.GV_SUMME[gvtyp][int(TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]])].Netto += Decimal(
-                    item["total_price"]
-                ) - Decimal(item["total_tax"])
-                e.GV_TYP = gvtyp
-
-                e.GV_NAME = ""
-
-                f = Bonpos_USt()
-                f.Z_KASSE_ID = Z_KASSE_ID
-                f.Z_ERSTELLUNG = Z_ERSTELLUNG
-                f.Z_NR = Z_NR
-                f.BON_ID = row["id"]
-                f.POS_ZEILE = int(item["item_id"]) + 1
-                f.UST_SCHLUESSEL = TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]]
-                f.POS_BRUTTO = Decimal(item["total_price"])
-                f.POS_UST = Decimal(item["total_tax"])
-                f.POS_NETTO = Decimal(item["total_price"]) - Decimal(item["total_tax"])
-
-                self.c.add(e)
-                self.c.add(f)
-
-            ### /lines.csv ###
-
-            ### itemamounts.csv ### ##brauchen wir nicht, weil Gutscheine in den Lineitems als Rabatprodukt auftauchen
-            # a=Bonpos_Preisfindung()
-            # a.Z_KASSE_ID = Z_KASSE_ID
-            # a.Z_ERSTELLUNG = Z_ERSTELLUNG
-            # a.Z_NR = Z_NR
-            ### /itemamounts.csv ###
+            else:
+                gvtyp = "Umsatz"  # alles andere
+
+            ust_schluessel = TAXNAME_TO_SCHLUESSELNUMMER[item["tax_name"]]
+            pos_brutto = Decimal(item["total_price"])
+            pos_ust = Decimal(item["total_tax"])
+            gv_summe = self.GV_SUMME[gvtyp][int(ust_schluessel)]
+            gv_summe.Brutto += pos_brutto
+            gv_summe.USt += pos_ust
+            gv_summe.Netto += pos_brutto - pos_ust
+
+            pos_zeile = int(item["item_id"]) + 1  # weiß nicht, ob das Finanzamt bei 0 anfängt zu zählen
+            self.c.add_row(
+                Bonpos,
+                **abschluss_felder,
+                POS_ZEILE=pos_zeile,
+                ARTIKELTEXT=item["product"]["name"],
+                ART_NR=item["product"]["id"],
+                MENGE=Decimal(item["quantity"]),
+                INHAUS=False,  # TODO nachgucken, ob wichtig. jetzt erstmal alles als Außerhausverkauf
+                P_STORNO=False,  # nicht vorgesehen
+                AGENTUR_ID=0,  # Agenturen noch nicht implementiert
+                GV_TYP=gvtyp,
+                GV_NAME="",
+            )
+            self.c.add_row(
+                Bonpos_USt,
+                **abschluss_felder,
+                POS_ZEILE=pos_zeile,
+                UST_SCHLUESSEL=ust_schluessel,
+                POS_BRUTTO=pos_brutto,
+                POS_UST=pos_ust,
+                POS_NETTO=pos_brutto - pos_ust,
+            )
+
+        ### /lines.csv ###
+
+        ### itemamounts.csv ### ##brauchen wir nicht, weil Gutscheine in den Lineitems als Rabatprodukt auftauchen
+        # a=Bonpos_Preisfindung()
+        # a.Z_KASSE_ID = Z_KASSE_ID
+        # a.Z_ERSTELLUNG = Z_ERSTELLUNG
+        # a.Z_NR = Z_NR
+        ### /itemamounts.csv ###
 
         return
 
-    async def stammdatenmodul(
+    def tse_fuer_abschluss(self, Z_KASSE_ID: int, Z_NR: int) -> Record:
+        # Prüfe, ob diese Kasse verschiedene TSEs hatte, wenn nicht, dann müssen wir nichts weiter tun. Das sollte der Normalfall sein:
+        registrierungen = [
+            entry for entry in self.till_tse_history.get(str(Z_KASSE_ID), []) if entry["what"] == "register"
+        ]
+        tses = [entry["tse_id"] for entry in registrierungen]
+        if len(tses) == 1 and self.till_tse_ids.get(Z_KASSE_ID) is not None:
+            # Fall, dass wir nur eine TSE für diese Kasse haben: Einfach
+            return self.tses[self.till_tse_ids[Z_KASSE_ID]]
+
+        if len(tses) == 0:
+            print(f"Kasse {Z_KASSE_ID} wurde bei keiner TSE registriert")
+            raise ValueError  # sollte nicht passieren
+
+        # oh gott, es gibt noch einen Fall: eine Kasse wird von der defekten TSE geschoben, aber hat noch keine Buchung gemacht und somit noch keine neue TSE erhalten -> das Feld tse_id in till ist Null
+        # jetze müssen wir in der history nachschauen, auf welcher TSE diese Kasse registriert war, kann natürlich auch wieder mehrere geben, ahrg
+        if len(tses) > 1:
+            print(f"KASSE {Z_KASSE_ID} wurde bei mehreren TSEs registriert, nämlich bei {tses}")
+        # Fall, dass bei dieser Kasse die TSE gewechselt wurde: Kompliziert :(
+        # Erstens: Herausfinden, welche TSE für diesen Kassenschluss zuständig war:
+        # ich habe mehrere Einträge, davon muss ich den mit dem kleinsten z_nr nehmen und vergleichen, ob der größer gleich dem aktuellen z_nr ist.
+        aeltereschluesse = list()
+        for schluss in registrierungen:
+            # ist der Kassenschluss bei dem die Kasse auf die TSE registriert wurde älter und damit kleiner gleich als der aktuel abgefragte Z_NR?
+            if Z_NR >= schluss["z_nr"]:
+                aeltereschluesse.append(schluss["z_nr"])
+        # nimm jetzt den größten weil ältesten Kassenschluss in der Liste und hole die TSE
+        aeltereschluesse.sort(reverse=True)
+        aktuelle_tse_id = next(entry["tse_id"] for entry in registrierungen if entry["z_nr"] == aeltereschluesse[0])
+        if len(tses) == 1:
+            print(
+                f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id} und wurde bisher noch nicht auf eine neue TSE registriert"
+            )
+        else:
+            print(f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id}")
+
+        # und jetzt die stammdaten dieser TSE
+        return self.tses[aktuelle_tse_id]
+
+    def stammdatenmodul(
         self,
-        conn: Connection,
-        Z_NR: int,
-        Z_ERSTELLUNG: datetime,
-        Z_KASSE_ID: int,
+        abschluss: Kassenabschluss,
         node: Node,
         event_settings: RestrictedEventSettings,
     ):
+        del node  # die Stammdaten des Knotens sind schon geladen
+        Z_KASSE_ID = abschluss.Z_KASSE_ID
+        Z_ERSTELLUNG = abschluss.Z_ERSTELLUNG
+        Z_NR = abschluss.Z_NR
+
         ### cashpointclosing.csv ###
         a = Stamm_Abschluss()
         # wir haben für jeden Kassenabschluss und Kasse immer die gleichen Stammdaten (pro Festival)
@@ -388,24 +808,15 @@ class Generator:
         a.STNR = ""
         a.USTID = event_settings.ust_id
 
-        a.Z_START_ID = await conn.fetchval(
-            "select id from ordr where ordr.till_id = $1 and ordr.z_nr = $2 order by ordr.id asc", Z_KASSE_ID, Z_NR
-        )  # erste BON_ID in diesem Abschluss
-        a.Z_ENDE_ID = await conn.fetchval(
-            "select id from ordr where ordr.till_id = $1 and ordr.z_nr = $2 order by ordr.id desc", Z_KASSE_ID, Z_NR
-        )  # letzte BON_ID in diesem Abschluss
+        a.Z_START_ID = abschluss.Z_START_ID  # erste BON_ID in diesem Abschluss
+        a.Z_ENDE_ID = abschluss.Z_ENDE_ID  # letzte BON_ID in diesem Abschluss
 
         Z_SE_ZAHLUNGEN = Decimal()
         Z_SE_BARZAHLUNGEN = Decimal()
-        for row in await conn.fetch(
-            "select total_price, payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2",
-            Z_KASSE_ID,
-            Z_NR,
-        ):
-            Z_SE_ZAHLUNGEN += Decimal(row["total_price"])
-            if PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]] == "Bar":
-                Z_SE_BARZAHLUNGEN += Decimal(row["total_price"])
+        for payment_method, total_price in abschluss.summe_je_zahlart.items():
+            Z_SE_ZAHLUNGEN += Decimal(total_price)
+            if PAYMENT_METHOD_TO_ZAHLUNGSART[payment_method] == "Bar":
+                Z_SE_BARZAHLUNGEN += Decimal(total_price)
 
         a.Z_SE_ZAHLUNGEN = Z_SE_ZAHLUNGEN  # Summe alle Zahlungen dieser Kasse für diesen Kassenabschluss
         a.Z_SE_BARZAHLUNGEN = Z_SE_BARZAHLUNGEN  # Summe alle Barzahlungen dieser Kasse für diesen Kassenabschluss
@@ -425,7 +836,7 @@ class Generator:
         a.LOC_PLZ = self.PLZ
         a.LOC_ORT = self.City
         a.LOC_LAND = "DEU"  # sorry, not in db -> hardcoded
-        a.USTID = event_settings.ust_id
+        a.LOC_USTID = event_settings.ust_id
 
         self.c.add(a)
         ### \locations.csv ###
@@ -441,13 +852,12 @@ class Generator:
         a.KASSE_SW_BRAND = "StuStaPay Enterprise Payment Solutions Festival Edition Pro"
         a.KASSE_SW_VERSION = "v0"  # TODO version?
         a.KASSE_BASISWAEH_CODE = event_settings.currency_identifier
-        a.KASSE_UST_ZUORDNUNG = ""  # puh?
 
         self.c.add(a)
         ### \cashregister.csv ###
 
         ### vat.csv ###
-        for row in await conn.fetch("select name, rate, description from tax_rate where node_id = $1", node.id):
+        for row in self.tax_rates:
             a = Stamm_USt()
             a.Z_KASSE_ID = Z_KASSE_ID
             a.Z_ERSTELLUNG = Z_ERSTELLUNG
@@ -466,93 +876,8 @@ class Generator:
         a.Z_ERSTELLUNG = Z_ERSTELLUNG
         a.Z_NR = Z_NR
 
-        # Prüfe, ob diese Kasse verschiedene TSEs hatte, wenn nicht, dann müssen wir nichts weiter tun. Das sollte der Normalfall sein:
-        till_history = await conn.fetch(
-            "select what, tse_id, z_nr, date from till_tse_history where till_id = $1 order by z_nr", str(Z_KASSE_ID)
-        )
-        tses = list()
-        for entry in till_history:
-            if entry["what"] == "register":
-                tses.append(entry["tse_id"])
-        if len(tses) == 1:
-            # Fall, dass wir nur eine TSE für diese Kasse haben: Einfach
-            row = await conn.fetchrow(
-                "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, tse.public_key, tse.certificate "
-                "from till join tse on till.tse_id = tse.id where till.id = $1",
-                Z_KASSE_ID,
-            )
-
-            # oh gott, es gibt noch einen Fall: eine Kasse wird von der defekten TSE geschoben, aber hat noch keine Buchung gemacht und somit noch keine neue TSE erhalten -> das Feld tse_id in till ist Null
-            # damit schlägt natürlich der join fehl und es kommt None zurück.
-            if row is None:
-                # jetze müssen wir in der history nachschauen, auf welcher TSE diese Kasse registriert war, kann natürlich auch wieder mehrere geben, ahrg
-                # dazu kopieren wir jetzt einfach den code von unten
-                kassenschlussgrenzen = await conn.fetch(
-                    "select z_nr from till_tse_history where till_id = $1 and what = 'register' order by z_nr",
-                    str(Z_KASSE_ID),
-                )
-                aeltereschluesse = list()
-
-                for schluss in kassenschlussgrenzen:
-                    # ist der Kassenschluss bei dem die Kasse auf die TSE registriert wurde älter und damit kleiner gleich als der aktuel abgefragte Z_NR?
-                    if Z_NR >= schluss["z_nr"]:
-                        aeltereschluesse.append(schluss["z_nr"])
-                # nimm jetzt den größten weil ältesten Kassenschluss in der Liste und hole die TSE
-                aeltereschluesse.sort(reverse=True)
-                aktuelle_tse_id = await conn.fetchval(
-                    "select tse_id from till_tse_history where till_id = $1 and what = 'register' and z_nr = $2",
-                    str(Z_KASSE_ID),
-                    aeltereschluesse[0],
-                )
-                print(
-                    f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id} und wurde bisher noch nicht auf eine neue TSE registriert"
-                )
-
-                # und jetzt die stammdaten dieser TSE
-                row = await conn.fetchrow(
-                    "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
-                    "   tse.public_key, tse.certificate "
-                    "from tse where id = $1",
-                    aktuelle_tse_id,
-                )
-
-        elif len(tses) == 0:
-            print(f"Kasse {Z_KASSE_ID} wurde bei keiner TSE registriert")
-            raise ValueError  # sollte nicht passieren
-        else:
-            print(f"KASSE {Z_KASSE_ID} wurde bei mehreren TSEs registriert, nämlich bei {tses}")
-            # Fall, dass bei dieser Kasse die TSE gewechselt wurde: Kompliziert :(
-            # Erstens: Herausfinden, welche TSE für diesen Kassenschluss zuständig war:
-            # ich habe mehrere Einträge, davon muss ich den mit dem kleinsten z_nr nehmen und vergleichen, ob der größer gleich dem aktuellen z_nr ist.
-            kassenschlussgrenzen = await conn.fetch(
-                "select z_nr from till_tse_history where till_id = $1 and what = 'register' order by z_nr",
-                str(Z_KASSE_ID),
-            )
-            aeltereschluesse = list()
-
-            for schluss in kassenschlussgrenzen:
-                # ist der Kassenschluss bei dem die Kasse auf die TSE registriert wurde älter und damit kleiner gleich als der aktuel abgefragte Z_NR?
-                if Z_NR >= schluss["z_nr"]:
-                    aeltereschluesse.append(schluss["z_nr"])
-            # nimm jetzt den größten weil ältesten Kassenschluss in der Liste und hole die TSE
-            aeltereschluesse.sort(reverse=True)
-            aktuelle_tse_id = await conn.fetchval(
-                "select tse_id from till_tse_history where till_id = $1 and what = 'register' and z_nr = $2",
-                str(Z_KASSE_ID),
-                aeltereschluesse[0],
-            )
-            print(f"Kasse {Z_KASSE_ID} hat beim Abschluss {Z_NR} die TSE: {aktuelle_tse_id}")
-
-            # und jetzt die stammdaten dieser TSE
-            row = await conn.fetchrow(
-                "select tse.id, tse.serial, tse.hashalgo, tse.time_format, tse.process_data_encoding, "
-                "   tse.public_key, tse.certificate "
-                "from tse where id = $1",
-                aktuelle_tse_id,
-            )
+        row = self.tse_fuer_abschluss(Z_KASSE_ID, Z_NR)
 
-        # LOGGER.info(row)
-        # LOGGER.info(f'Z_KASSE_ID: {Z_KASSE_ID}, Z_NR: {Z_NR}')
         a.TSE_ID = int(row["id"])
         a.TSE_SERIAL = row["serial"]
         a.TSE_SIG_ALGO = row["hashalgo"]
@@ -581,7 +906,7 @@ class Generator:
             a.TSE_ZERTIFIKAT_V = row["certificate"][4000:5001]
         else:
             LOGGER.error(
-                f"Zertifikat zu lang. Länge: {len(row['tse_certificate'])} Zeichen. Maximal unterstützt: 5000 Zeichen"
+                f"Zertifikat zu lang. Länge: {len(row['certificate'])} Zeichen. Maximal unterstützt: 5000 Zeichen"
             )
             raise NotImplementedError
 
@@ -590,34 +915,21 @@ class Generator:
 
         return
 
-    async def kassenabschlussmodul(
+    def kassenabschlussmodul(
         self,
-        conn: Connection,
-        Z_NR: int,
-        Z_ERSTELLUNG: datetime,
-        Z_KASSE_ID: int,
+        abschluss: Kassenabschluss,
         event_settings: RestrictedEventSettings,
     ):
-        paymentmethods = await conn.fetch(
-            "select payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2 group by payment_method",
-            Z_KASSE_ID,
-            Z_NR,
-        )
+        Z_KASSE_ID = abschluss.Z_KASSE_ID
+        Z_ERSTELLUNG = abschluss.Z_ERSTELLUNG
+        Z_NR = abschluss.Z_NR
+
         barzahlungen = Decimal(0)
         summe_je_zahlart = dict()
-        for method in paymentmethods:
-            summe_je_zahlart[str(method["payment_method"])] = Decimal(0)
-
-        for row in await conn.fetch(
-            "select total_price, payment_method from line_item join ordr on line_item.order_id = ordr.id "
-            "where ordr.till_id = $1 and ordr.z_nr = $2",
-            Z_KASSE_ID,
-            Z_NR,
-        ):
-            summe_je_zahlart[row["payment_method"]] += Decimal(row["total_price"])
-            if PAYMENT_METHOD_TO_ZAHLUNGSART[row["payment_method"]] == "Bar":
-                barzahlungen += Decimal(row["total_price"])
+        for payment_method, total_price in abschluss.summe_je_zahlart.items():
+            summe_je_zahlart[payment_method] = Decimal(total_price)
+            if PAYMENT_METHOD_TO_ZAHLUNGSART[payment_method] == "Bar":
+                barzahlungen += Decimal(total_price)
 
         ### businesscases.csv###
         # wir iterieren über die daten die wir in im einzelaufzeichnungsmodul aggregiert haben
@@ -639,14 +951,14 @@ class Generator:
         ### \businesscases.csv###
 
         ### payment.csv###
-        for typ in paymentmethods:
+        for payment_method in summe_je_zahlart:
             a = Z_Zahlart()
             a.Z_KASSE_ID = Z_KASSE_ID
             a.Z_ERSTELLUNG = Z_ERSTELLUNG
             a.Z_NR = Z_NR
-            a.ZAHLART_TYP = PAYMENT_METHOD_TO_ZAHLUNGSART[typ["payment_method"]]
-            a.ZAHLART_NAME = typ["payment_method"]
-            a.Z_ZAHLART_BETRAG = summe_je_zahlart[typ["payment_method"]]
+            a.ZAHLART_TYP = PAYMENT_METHOD_TO_ZAHLUNGSART[payment_method]
+            a.ZAHLART_NAME = payment_method
+            a.Z_ZAHLART_BETRAG = summe_je_zahlart[payment_method]
             self.c.add(a)
         ### \payment.csv###
 
@@ -45,6 +45,7 @@ from stustapay.core.service.tree.service import create_event, create_node
 from stustapay.core.service.tse import TseService
 from stustapay.core.service.user import UserService, associate_user_to_role
 from stustapay.core.service.user_tag import create_user_tag_secret, create_user_tags
+from stustapay.tse.diebold_nixdorf_usb.simulator import simulator_serial
 
 CASHIER_TAG_START = 1000
 CUSTOMER_TAG_START = 100000
@@ -546,8 +547,10 @@ class DatabaseSetup:
         n_topup_tills: int,
         n_beer_tills: int,
         n_cocktail_tills: int,
+        n_tses: int = 1,
     ):
         self.config = config
+        self.n_tses = n_tses
         self.n_cashiers = n_cashiers or int((n_topup_tills + n_beer_tills + n_cocktail_tills + n_entry_tills) * 1.5)
         self.n_tags = n_tags
         self.n_entry_tills = n_entry_tills
@@ -670,23 +673,26 @@ class DatabaseSetup:
                 role_id=cashier_role.id,
             )
 
-    async def _create_tse(self, conn: Connection, admin_token: str):
+    async def _create_tses(self, conn: Connection, admin_token: str):
         assert self.db_pool is not None
         auth_service = AuthService(db_pool=self.db_pool, config=self.config)
         tse_service = TseService(db_pool=self.db_pool, config=self.config, auth_service=auth_service)
-        await tse_service.create_tse(
-            conn=conn,
-            node_id=self.event_node_id,
-            token=admin_token,
-            new_tse=NewTse(
-                name="tse1",
-                serial="84ba2997f8fbf9d0feee48c7ba5812d6d1e37c33fdb11cdb06eb849b1336b1c7",
-                type=TseType.diebold_nixdorf,
-                ws_url="http://localhost:10001",
-                ws_timeout=5,
-                password="12345",
-            ),
-        )
+        logger.info(f"Creating {self.n_tses} TSEs")
+        for i in range(self.n_tses):
+            # matches the i-th virtual TSE of the TSE simulator
+            await tse_service.create_tse(
+                conn=conn,
+                node_id=self.event_node_id,
+                token=admin_token,
+                new_tse=NewTse(
+                    name=f"tse{i + 1}",
+                    serial=simulator_serial(i),
+                    type=TseType.diebold_nixdorf,
+                    ws_url="http://localhost:10001" if i == 0 else f"http://localhost:10001/{i}",
+                    ws_timeout=5,
+                    password="12345",
+                ),
+            )
 
     async def run(self):
         db = get_database(self.config.database)
@@ -819,4 +825,4 @@ class DatabaseSetup:
             await self._create_cashiers(
                 conn=conn, user_service=user_service, admin_user=admin, admin_token=admin_token, n_cashiers=n_cashiers
             )
-            await self._create_tse(conn=conn, admin_token=admin_token)
+            await self._create_tses(conn=conn, admin_token=admin_token)
@@ -1,6 +1,7 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
 import logging
 import time
+from typing import Optional
 
 from sftkit.async_thread import AsyncThread
 
@@ -9,15 +10,29 @@ from stustapay.bon.generator import GeneratorWorker
 from stustapay.core.config import Config
 from stustapay.customer_portal.server import Api as CustomerApi
 from stustapay.terminalserver.server import Api as TerminalApi
+from stustapay.tse.diebold_nixdorf_usb.simulator import LatencyDistribution
 from stustapay.tse.signature_processor import SignatureProcessor
 from stustapay.tse.simulator import Simulator as TseSimulator
 
 
 class FestivalSetup:
-    def __init__(self, config: Config, no_tse: bool, no_bon: bool):
+    def __init__(
+        self,
+        config: Config,
+        no_tse: bool,
+        no_bon: bool,
+        n_tses: int = 1,
+        tse_latency: Optional[LatencyDistribution] = None,
+        tse_failure_rate: float = 0.0,
+        tse_disconnect_rate: float = 0.0,
+    ):
         self.config = config
         self.no_tse = no_tse
         self.no_bon = no_bon
+        self.n_tses = n_tses
+        self.tse_latency = tse_latency
+        self.tse_failure_rate = tse_failure_rate
+        self.tse_disconnect_rate = tse_disconnect_rate
 
         self.logger = logging.getLogger(__name__)
 
@@ -38,7 +53,13 @@ class FestivalSetup:
         if not self.no_tse:
             processor = SignatureProcessor(config=self.config)
             threads.append(AsyncThread(processor.run))
-            simulator = TseSimulator(fast=True)
+            simulator = TseSimulator(
+                fast=self.tse_latency is None,
+                n_tses=self.n_tses,
+                latency=self.tse_latency,
+                failure_rate=self.tse_failure_rate,
+                disconnect_rate=self.tse_disconnect_rate,
+            )
             threads.append(AsyncThread(simulator.run))
 
         for thread in threads:
@@ -1,8 +1,10 @@
 import asyncio
+import contextlib
 import enum
 import logging
 import uuid
 from datetime import datetime, timedelta
+from typing import AsyncIterator
 
 import aiohttp
 from pydantic import BaseModel
@@ -18,6 +20,8 @@ SUMUP_AUTH_REFRESH_THRESHOLD = timedelta(seconds=180)
 SUMUP_CHECKOUT_POLL_INTERVAL = timedelta(seconds=5)
 SUMUP_INITIAL_CHECK_TIMEOUT = timedelta(seconds=20)
 SUMUP_OAUTH_VALIDITY_TOLERANCE = timedelta(minutes=10)
+SUMUP_REQUEST_TIMEOUT = 10  # seconds
+SUMUP_MAX_CONNECTIONS = 10  # per shared session
 
 
 class SumUpError(ServiceException):
@@ -148,7 +152,7 @@ async def fetch_new_oauth_token(client_id: str, client_secret: str, refresh_toke
 
     async with aiohttp.ClientSession(trust_env=True) as session:
         try:
-            async with session.post(url, data=payload, timeout=1) as response:
+            async with session.post(url, data=payload, timeout=SUMUP_REQUEST_TIMEOUT) as response:
                 if not response.ok:
                     try:
                         resp = await response.json()
@@ -175,11 +179,23 @@ async def fetch_new_oauth_token(client_id: str, client_secret: str, refresh_toke
             return None
 
 
+def create_sumup_session(max_connections: int = SUMUP_MAX_CONNECTIONS) -> aiohttp.ClientSession:
+    """
+    Create a long-lived http session whose connections to SumUp are kept alive and reused across requests.
+    The session has to be closed by its owner.
+    """
+    return aiohttp.ClientSession(trust_env=True, connector=aiohttp.TCPConnector(limit=max_connections))
+
+
 class SumUpApi:
 
-    def __init__(self, api_key: str, merchant_code: str):
+    def __init__(self, api_key: str, merchant_code: str, session: aiohttp.ClientSession | None = None):
+        """
+        If no session is given, every request is performed in a newly created http session.
+        """
         self.api_key = api_key
         self.merchant_code = merchant_code
+        self.session = session
 
     def _get_sumup_auth_headers(self) -> dict:
         return {
@@ -188,10 +204,20 @@ class SumUpApi:
             "Authorization": f"Bearer {self.api_key}",
         }
 
+    @contextlib.asynccontextmanager
+    async def _session(self) -> AsyncIterator[aiohttp.ClientSession]:
+        if self.session is not None:
+            yield self.session
+            return
+        async with aiohttp.ClientSession(trust_env=True) as session:
+            yield session
+
     async def _get(self, url: str, query: dict | None = None) -> dict:
-        async with aiohttp.ClientSession(trust_env=True, headers=self._get_sumup_auth_headers()) as session:
+        async with self._session() as session:
             try:
-                async with session.get(url, params=query, timeout=10) as response:
+                async with session.get(
+                    url, params=query, headers=self._get_sumup_auth_headers(), timeout=SUMUP_REQUEST_TIMEOUT
+                ) as response:
                     if not response.ok:
                         resp = await response.json()
                         err = _SumUpErrorFormat.model_validate(resp)
@@ -205,12 +231,15 @@ class SumUpApi:
                 raise SumUpError("SumUp API returned an unknown error") from e
 
     async def _post(self, url: str, data: BaseModel, query: dict | None = None) -> dict:
-        async with aiohttp.ClientSession(
-            trust_env=True,
-            headers=self._get_sumup_auth_headers(),
-        ) as session:
+        async with self._session() as session:
             try:
-                async with session.post(url, data=data.model_dump_json(), params=query, timeout=10) as response:
+                async with session.post(
+                    url,
+                    data=data.model_dump_json(),
+                    params=query,
+                    headers=self._get_sumup_auth_headers(),
+                    timeout=SUMUP_REQUEST_TIMEOUT,
+                ) as response:
                     if not response.ok:
                         try:
                             resp = await response.json()
@@ -6,6 +6,7 @@ from fastapi import APIRouter, HTTPException, status
 from pydantic import BaseModel
 
 from stustapay.core.http.auth_till import CurrentAuthToken
+from stustapay.core.http.caching import IfNoneMatch, json_response_with_etag
 from stustapay.core.http.context import ContextTerminalService, ContextTillService
 from stustapay.core.schema.terminal import TerminalConfig
 from stustapay.core.schema.till import CashRegister, CashRegisterStocking, UserInfo
@@ -26,15 +27,21 @@ async def health():
     return {"status": "healthy"}
 
 
-@router.get("/config", summary="obtain the current terminal config", response_model=TerminalConfig)
+@router.get(
+    "/config",
+    summary="obtain the current terminal config",
+    response_model=TerminalConfig,
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "the config did not change since it was last fetched"}},
+)
 async def config(
     token: CurrentAuthToken,
     terminal_service: ContextTerminalService,
+    if_none_match: IfNoneMatch = None,
 ):
-    terminal_config = await terminal_service.get_terminal_config(token=token)
+    terminal_config = await terminal_service.get_serialized_terminal_config(token=token)
     if terminal_config is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-    return terminal_config
+    return json_response_with_etag(body=terminal_config.body, etag=terminal_config.etag, if_none_match=if_none_match)
 
 
 @router.get(
@@ -75,16 +75,18 @@ class Api:
 
         auth_service = AuthService(db_pool=db_pool, config=self.cfg)
 
+        terminal_service = TerminalService(db_pool=db_pool, config=self.cfg, auth_service=auth_service)
         context = Context(
             config=self.cfg,
             order_service=OrderService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             user_service=UserService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             till_service=TillService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
             account_service=AccountService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
-            terminal_service=TerminalService(db_pool=db_pool, config=self.cfg, auth_service=auth_service),
+            terminal_service=terminal_service,
         )
         try:
             self.server.add_task(asyncio.create_task(run_healthcheck(db, service_name="terminalserver")))
             await self.server.run(context)
         finally:
+            await terminal_service.sumup_oauth_tokens.close()
             await db_pool.close()
@@ -63,6 +63,7 @@ from stustapay.core.service.tree.common import (
     fetch_restricted_event_settings_for_node,
 )
 from stustapay.core.service.tree.service import TreeService, create_event
+from stustapay.core.service.tse import TseService
 from stustapay.core.service.user import UserService, associate_user_to_role
 from stustapay.core.service.user_tag import UserTagService
 
@@ -294,13 +295,20 @@ async def tax_rate_service(
     return TaxRateService(db_pool=setup_test_db_pool, config=config, auth_service=auth_service)
 
 
+@pytest.fixture(scope="session")
+async def tse_service(setup_test_db_pool: asyncpg.Pool, config: Config, auth_service: AuthService) -> TseService:
+    return TseService(db_pool=setup_test_db_pool, config=config, auth_service=auth_service)
+
+
 @pytest.fixture(scope="session")
 async def customer_service(
     setup_test_db_pool: asyncpg.Pool, config: Config, auth_service: AuthService, config_service: ConfigService
-) -> CustomerService:
-    return CustomerService(
+) -> AsyncGenerator[CustomerService, None]:
+    customer_service = CustomerService(
         db_pool=setup_test_db_pool, config=config, auth_service=auth_service, config_service=config_service
     )
+    yield customer_service
+    await customer_service.close()
 
 
 @pytest.fixture(scope="session")
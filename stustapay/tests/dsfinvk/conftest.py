@@ -0,0 +1,265 @@
+# pylint: disable=redefined-outer-name
+import random
+import secrets
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Optional, Protocol
+
+import pytest
+from sftkit.database import Connection
+
+from stustapay.core.config import Config
+from stustapay.core.schema.till import TillProfile
+from stustapay.core.schema.tree import Node
+from stustapay.dsfinvk.generator import Generator
+
+from ..conftest import Cashier
+
+ASSETS_DIR = Path(__file__).parents[2] / "dsfinvk" / "assets"
+
+# name, price (None for a variable price), tax rate name, is_returnable
+PRODUCTS = [
+    ("Bier", 3.5, "ust", False),
+    ("Brezn", 2.7, "eust", False),
+    ("Pfand", 2, "none", True),
+    ("Cola", 0.1, "ust", False),
+    ("Eintritt", 12, "ust", False),
+    ("Aufladen", None, "none", False),
+]
+N_CLOSINGS = 3
+N_ORDERS_PER_CLOSING = 5
+
+
+@dataclass
+class DsfinvkEvent:
+    till_ids: list[int]
+    tse_ids: list[int]
+    product_ids: dict[str, int]
+    order_ids: list[int]
+    cashier_id: int
+    customer_account_id: int
+    cash_register_id: int
+
+
+class ExportDsfinvk(Protocol):
+    def __call__(self, name: str, jobs: int = 1, cache_dir: Optional[Path] = None) -> Awaitable[dict[str, bytes]]: ...
+
+
+async def _insert_order(
+    conn: Connection,
+    rng: random.Random,
+    event: DsfinvkEvent,
+    taxes: dict[str, dict],
+    till_id: int,
+    z_nr: int,
+    booked_at: datetime,
+    previous_sale: Optional[int],
+) -> tuple[int, str]:
+    order_type = rng.choice(["sale", "sale", "sale", "top_up", "pay_out", "ticket", "money_transfer", "cancel_sale"])
+    if order_type == "cancel_sale" and previous_sale is None:
+        order_type = "sale"
+    if order_type == "sale":
+        items = [rng.choice(PRODUCTS[:4]) for _ in range(rng.randint(1, 4))]
+    elif order_type == "ticket":
+        items = [PRODUCTS[4], PRODUCTS[5]]
+    elif order_type == "money_transfer":
+        items = [] if rng.random() < 0.5 else [PRODUCTS[5]]
+    elif order_type == "cancel_sale":
+        items = [PRODUCTS[0]]
+    else:
+        items = [PRODUCTS[5]]
+    payment_method = rng.choice(["cash", "tag", "sumup"])
+    order_id = await conn.fetchval(
+        "insert into ordr (item_count, booked_at, payment_method, z_nr, order_type, cancels_order, cashier_id, "
+        "   till_id, customer_account_id, cash_register_id) "
+        "values ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) returning id",
+        len(items),
+        booked_at,
+        payment_method,
+        z_nr,
+        order_type,
+        previous_sale if order_type == "cancel_sale" else None,
+        event.cashier_id,
+        till_id,
+        event.customer_account_id,
+        event.cash_register_id if payment_method == "cash" else None,
+    )
+    for item_id, (name, price, tax, is_returnable) in enumerate(items):
+        quantity = rng.randint(1, 3)
+        if order_type == "cancel_sale" or (is_returnable and rng.random() < 0.3):
+            quantity = -quantity
+        await conn.execute(
+            "insert into line_item (order_id, item_id, product_id, product_price, quantity, tax_name, tax_rate, "
+            "   tax_rate_id) "
+            "values ($1, $2, $3, $4, $5, $6, $7, $8)",
+            order_id,
+            item_id,
+            event.product_ids[name],
+            price if price is not None else rng.choice([5, 10.5, 20]),
+            quantity,
+            tax,
+            taxes[tax]["rate"],
+            taxes[tax]["id"],
+        )
+    return order_id, order_type
+
+
+@pytest.fixture
+async def dsfinvk_event(
+    db_connection: Connection, event_node: Node, till_profile: TillProfile, cashier: Cashier
+) -> DsfinvkEvent:
+    """
+    A small event with three tills, several tax rates and multi line orders whose ids interleave between the tills.
+    Everything which ends up in the export apart from the database ids is deterministic.
+    """
+    rng = random.Random(31)
+    await db_connection.execute(
+        "update event set bon_address = 'Musterstr. 1\n12345 Musterstadt', bon_issuer = 'Verein', ust_id = 'DE123' "
+        "where id = (select event_id from node where id = $1)",
+        event_node.id,
+    )
+    await db_connection.execute(
+        "insert into tax_rate (name, rate, description, node_id) "
+        "values ('ust', 0.19, 'Normal', $1), ('eust', 0.07, 'Ermaessigt', $1)",
+        event_node.id,
+    )
+    taxes = {
+        row["name"]: dict(row)
+        for row in await db_connection.fetch("select id, name, rate from tax_rate where node_id = $1", event_node.id)
+    }
+    # every event already has its top up product
+    product_ids = {
+        "Aufladen": await db_connection.fetchval(
+            "select id from product where name = 'Aufladen' and node_id = $1", event_node.id
+        )
+    }
+    for name, price, tax, is_returnable in PRODUCTS[:-1]:
+        product_ids[name] = await db_connection.fetchval(
+            "insert into product (type, name, price, fixed_price, is_locked, is_returnable, tax_rate_id, node_id) "
+            "values ('user_defined', $1, $2, $3, true, $4, $5, $6) returning id",
+            name,
+            price,
+            price is not None,
+            is_returnable,
+            taxes[tax]["id"],
+            event_node.id,
+        )
+    tse_ids = [
+        await db_connection.fetchval(
+            "insert into tse (node_id, name, serial, hashalgo, time_format, public_key, certificate, "
+            "   process_data_encoding) "
+            "values ($1, $2, $3, 'ecdsa', 'unix', $4, $5, 'UTF-8') returning id",
+            event_node.id,
+            f"dsfinvk-tse{i}-{secrets.token_hex(8)}",
+            f"serial{i}",
+            f"pk{i}",
+            certificate,
+        )
+        # the certificate of the second tse is split over several columns
+        for i, certificate in enumerate(["C" * 500, "D" * 1500])
+    ]
+    till_ids = [
+        await db_connection.fetchval(
+            "insert into till (name, active_profile_id, node_id, tse_id) values ($1, $2, $3, $4) returning id",
+            f"dsfinvk-till-{i}",
+            till_profile.id,
+            event_node.id,
+            tse_id,
+        )
+        for i, tse_id in enumerate([tse_ids[0], None, tse_ids[1]])
+    ]
+    # the last till switches its tse after the second Kassenabschluss
+    await db_connection.execute(
+        "insert into till_tse_history (till_id, tse_id, what, z_nr, date) "
+        "values ($1, $4, 'register', 1, $6), ($2, $4, 'register', 1, $6), ($3, $4, 'register', 1, $6), "
+        "   ($3, $4, 'deregister', 3, $6), ($3, $5, 'register', 3, $6)",
+        str(till_ids[0]),
+        str(till_ids[1]),
+        str(till_ids[2]),
+        tse_ids[0],
+        tse_ids[1],
+        datetime(2024, 6, 1, 10, 0, tzinfo=timezone.utc),
+    )
+    customer_account_id = await db_connection.fetchval(
+        "insert into account (node_id, type) values ($1, 'private') returning id", event_node.id
+    )
+    cash_register_id = await db_connection.fetchval(
+        "insert into cash_register (node_id, name, account_id) values ($1, 'dsfinvk-register', $2) returning id",
+        event_node.id,
+        customer_account_id,
+    )
+    event = DsfinvkEvent(
+        till_ids=till_ids,
+        tse_ids=tse_ids,
+        product_ids=product_ids,
+        order_ids=[],
+        cashier_id=cashier.id,
+        customer_account_id=customer_account_id,
+        cash_register_id=cash_register_id,
+    )
+
+    start = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+    previous_sales: dict[int, Optional[int]] = {}
+    for z_nr in range(1, N_CLOSINGS + 1):
+        for _ in range(N_ORDERS_PER_CLOSING):
+            # the orders of the tills are booked in turns, which interleaves their ids
+            for till_id in [till_ids[2], till_ids[0], till_ids[1]]:
+                n = len(event.order_ids)
+                booked_at = start + timedelta(seconds=7 * n)
+                order_id, order_type = await _insert_order(
+                    db_connection,
+                    rng,
+                    event,
+                    taxes,
+                    till_id=till_id,
+                    z_nr=z_nr,
+                    booked_at=booked_at,
+                    previous_sale=previous_sales.get(till_id),
+                )
+                event.order_ids.append(order_id)
+                previous_sales[till_id] = order_id if order_type == "sale" else None
+
+                r = rng.random()
+                status = "done" if r < 0.8 else "failure" if r < 0.9 else "new" if r < 0.95 else "pending"
+                done = status == "done"
+                await db_connection.execute(
+                    "update tse_signature set signature_status = $2, result_message = $3, tse_id = $4, "
+                    "   transaction_process_type = $5, transaction_process_data = $6, tse_transaction = $7, "
+                    "   tse_signaturenr = $8, tse_start = $9, tse_end = $10, tse_signature = $11 "
+                    "where id = $1",
+                    order_id,
+                    status,
+                    {"done": "ok", "failure": "tse unreachable"}.get(status),
+                    None if status == "new" else tse_ids[1] if till_id == till_ids[2] and z_nr >= 3 else tse_ids[0],
+                    "Kassenbeleg-V1" if done else None,
+                    f"Beleg^{n}" if done else None,
+                    str(n + 100) if done else None,
+                    str(n + 200) if done else None,
+                    booked_at.strftime("%Y-%m-%dT%H:%M:%S.123Z") if done else None,
+                    (booked_at + timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%S.456Z") if done else None,
+                    f"signature{n}" if done else None,
+                )
+    return event
+
+
+@pytest.fixture
+def export_dsfinvk(config: Config, event_node: Node, tmp_path: Path) -> ExportDsfinvk:
+    async def func(name: str, jobs: int = 1, cache_dir: Optional[Path] = None) -> dict[str, bytes]:
+        filename = tmp_path / name
+        generator = Generator(
+            config=config,
+            event_node_id=event_node.id,
+            filename=str(filename),
+            xml=str(ASSETS_DIR / "index.xml"),
+            dtd=str(ASSETS_DIR / "gdpdu-01-09-2004.dtd"),
+            simulate=False,
+            jobs=jobs,
+            cache_dir=str(cache_dir) if cache_dir is not None else None,
+        )
+        await generator.run()
+        with zipfile.ZipFile(filename) as archive:
+            return {info.filename: archive.read(info) for info in archive.infolist() if info.filename.endswith(".csv")}
+
+    return func
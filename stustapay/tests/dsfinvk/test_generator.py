@@ -0,0 +1,189 @@
+# pylint: disable=redefined-outer-name
+import csv
+import io
+import re
+from datetime import datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import asyncpg
+import pytest
+from sftkit.database import Connection
+
+from stustapay.dsfinvk.dsfinvk.models import Bonpos
+
+from .conftest import DsfinvkEvent, ExportDsfinvk
+
+# csv files of the dsfinvk_event export by the former exporter, which queried every Kassenabschluss and order on its
+# own, with the database ids replaced by the names in symbolic_ids
+REFERENCE_DIR = Path(__file__).parent / "data"
+# the order of the tables in the exported zip file
+REFERENCE_TABLES = [
+    "transactions_vat.csv",
+    "datapayment.csv",
+    "transactions.csv",
+    "transactions_tse.csv",
+    "lines.csv",
+    "lines_vat.csv",
+    "cashpointclosing.csv",
+    "location.csv",
+    "cashregister.csv",
+    "vat.csv",
+    "tse.csv",
+    "businesscases.csv",
+    "payment.csv",
+    "cash_per_currency.csv",
+]
+
+# csv columns containing database ids
+ID_COLUMNS = {
+    "Z_KASSE_ID": "till",
+    "KASSE_SERIENNR": "till",
+    "BON_ID": "order",
+    "BON_NR": "order",
+    "Z_START_ID": "order",
+    "Z_ENDE_ID": "order",
+    "TSE_ID": "tse",
+    "ART_NR": "product",
+    "BEDIENER_ID": "cashier",
+    "KUNDE_ID": "account",
+    "KASSENSCHUBLADENNR": "cash_register",
+}
+
+
+def symbolic_ids(event: DsfinvkEvent) -> dict[str, dict[str, str]]:
+    return {
+        "till": {str(till_id): f"till{i}" for i, till_id in enumerate(event.till_ids)},
+        "order": {str(order_id): f"order{i}" for i, order_id in enumerate(event.order_ids)},
+        "tse": {str(tse_id): f"tse{i}" for i, tse_id in enumerate(event.tse_ids)},
+        "product": {str(product_id): name for name, product_id in event.product_ids.items()},
+        "cashier": {str(event.cashier_id): "cashier"},
+        "account": {str(event.customer_account_id): "customer"},
+        "cash_register": {str(event.cash_register_id): "register"},
+    }
+
+
+def normalize_csv(content: bytes, ids: dict[str, dict[str, str]]) -> str:
+    rows = list(csv.reader(io.StringIO(content.decode("utf-8")), delimiter=";"))
+    id_columns = [(i, ID_COLUMNS[name]) for i, name in enumerate(rows[0]) if name in ID_COLUMNS]
+    notiz = rows[0].index("BON_NOTIZ") if "BON_NOTIZ" in rows[0] else None
+    for row in rows[1:]:
+        for i, kind in id_columns:
+            row[i] = ids[kind].get(row[i], row[i])
+        if notiz is not None:
+            # the note of a cancellation references the cancelled bon
+            row[notiz] = re.sub(r"(?<=BON_ID )\d+", lambda m: ids["order"].get(m.group(0), m.group(0)), row[notiz])
+    out = io.StringIO()
+    csv.writer(out, delimiter=";", lineterminator="\n").writerows(rows)
+    return out.getvalue()
+
+
+def normalize_export(tables: dict[str, bytes], event: DsfinvkEvent) -> dict[str, str]:
+    ids = symbolic_ids(event)
+    return {name: normalize_csv(content, ids) for name, content in tables.items()}
+
+
+@pytest.fixture
+def reference_export() -> dict[str, str]:
+    return {name: (REFERENCE_DIR / name).read_text(encoding="utf-8") for name in REFERENCE_TABLES}
+
+
+async def test_export_matches_reference(
+    dsfinvk_event: DsfinvkEvent, export_dsfinvk: ExportDsfinvk, reference_export: dict[str, str], tmp_path: Path
+):
+    sequential = await export_dsfinvk("sequential.zip")
+    assert list(sequential.keys()) == REFERENCE_TABLES
+    assert normalize_export(sequential, dsfinvk_event) == reference_export
+
+    # the workers of a parallel export read from the snapshot of the main transaction
+    parallel = await export_dsfinvk("parallel.zip", jobs=2)
+    assert list(parallel.keys()) == REFERENCE_TABLES
+    assert parallel == sequential
+
+    cache_dir = tmp_path / "cache"
+    assert await export_dsfinvk("cache_filled.zip", cache_dir=cache_dir) == sequential
+    assert await export_dsfinvk("from_cache.zip", cache_dir=cache_dir) == sequential
+    assert await export_dsfinvk("parallel_from_cache.zip", jobs=2, cache_dir=cache_dir) == sequential
+
+
+async def test_export_cache_picks_up_product_changes(
+    db_connection: Connection, dsfinvk_event: DsfinvkEvent, export_dsfinvk: ExportDsfinvk, tmp_path: Path
+):
+    cache_dir = tmp_path / "cache"
+    before = await export_dsfinvk("before.zip", cache_dir=cache_dir)
+    assert before == await export_dsfinvk("uncached_before.zip")
+    assert b";Bier;" in before["lines.csv"]
+
+    await db_connection.execute(
+        "update product set name = 'Helles', is_returnable = true where id = $1", dsfinvk_event.product_ids["Bier"]
+    )
+    after = await export_dsfinvk("after.zip", cache_dir=cache_dir)
+    assert after == await export_dsfinvk("uncached_after.zip")
+    assert b";Bier;" not in after["lines.csv"]
+    assert b";Helles;" in after["lines.csv"]
+    assert after["businesscases.csv"] != before["businesscases.csv"]
+
+
+async def test_export_cache_picks_up_signatures_committed_out_of_order(
+    setup_test_db_pool: asyncpg.Pool,
+    db_connection: Connection,
+    dsfinvk_event: DsfinvkEvent,
+    export_dsfinvk: ExportDsfinvk,
+    tmp_path: Path,
+):
+    # an unsigned order and another order of the same Kassenabschluss
+    row = await db_connection.fetchrow(
+        "select s.id as unsigned_order_id, ("
+        "   select min(other.id) from ordr other where other.till_id = o.till_id and other.z_nr = o.z_nr "
+        "       and other.id != o.id"
+        ") as other_order_id "
+        "from ordr o join tse_signature s on o.id = s.id "
+        "where o.id = any($1) and s.signature_status in ('new', 'pending') "
+        "order by o.id limit 1",
+        dsfinvk_event.order_ids,
+    )
+    assert row is not None
+
+    cache_dir = tmp_path / "cache"
+    async with setup_test_db_pool.acquire() as early_conn, setup_test_db_pool.acquire() as late_conn:
+        # the transaction started first commits last, its last_update is older than the one of the other transaction
+        early_transaction = early_conn.transaction()
+        await early_transaction.start()
+        await early_conn.execute("select now()")
+        async with late_conn.transaction():
+            await late_conn.execute(
+                "update tse_signature set result_message = 'checked' where id = $1", row["other_order_id"]
+            )
+        before = await export_dsfinvk("before.zip", cache_dir=cache_dir)
+
+        await early_conn.execute(
+            "update tse_signature set signature_status = 'failure', result_message = 'tse unreachable' "
+            "where id = $1",
+            row["unsigned_order_id"],
+        )
+        await early_transaction.commit()
+
+    after = await export_dsfinvk("after.zip", cache_dir=cache_dir)
+    assert after == await export_dsfinvk("uncached_after.zip")
+    assert after["transactions_tse.csv"] != before["transactions_tse.csv"]
+
+
+def test_model_row():
+    values = dict(
+        Z_KASSE_ID=1,
+        Z_ERSTELLUNG=datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc),
+        Z_NR=2,
+        BON_ID=3,
+        POS_ZEILE=1,
+        ARTIKELTEXT="Bier",
+        ART_NR=4,
+        MENGE=Decimal(2),
+        INHAUS=False,
+        P_STORNO=False,
+        AGENTUR_ID=0,
+        GV_TYP="Umsatz",
+        GV_NAME="",
+    )
+    assert Bonpos.row(**values) == list(Bonpos(**values).data.values())
+    with pytest.raises(AttributeError):
+        Bonpos.row(ARTIKEL="Bier")
@@ -0,0 +1,133 @@
+# pylint: disable=redefined-outer-name
+import csv
+import io
+import xml.etree.ElementTree as ET
+import zipfile
+from array import array
+from pathlib import Path
+from typing import Protocol
+
+import pytest
+
+from stustapay.dsfinvk.dsfinvk.validate import _missing_keys, _table_spec, validate_zip
+
+from .conftest import ASSETS_DIR
+
+Z_ERSTELLUNG = "2024-06-01T12:00:00"
+
+# the bons 1 to 3 of Kassenabschluss 1 of till 1 with their lines and payments
+TRANSACTIONS = [{"Z_KASSE_ID": "1", "Z_ERSTELLUNG": Z_ERSTELLUNG, "Z_NR": "1", "BON_ID": str(i)} for i in range(1, 4)]
+LINES = [
+    {"Z_KASSE_ID": "1", "Z_ERSTELLUNG": Z_ERSTELLUNG, "Z_NR": "1", "BON_ID": bon_id, "POS_ZEILE": pos, "MENGE": "1,000"}
+    for bon_id, pos in [("1", "1"), ("1", "2"), ("2", "1")]
+]
+DATAPAYMENT = [
+    {"Z_KASSE_ID": "1", "Z_ERSTELLUNG": Z_ERSTELLUNG, "Z_NR": "1", "BON_ID": str(i), "BASISWAEH_BETRAG": "1.234,50"}
+    for i in range(1, 4)
+]
+
+
+class FixtureZip(Protocol):
+    def __call__(self, tables: dict[str, list[dict[str, str]]], header: dict[str, list[str]] | None = None) -> Path: ...
+
+
+def _index_tables() -> dict[str, ET.Element]:
+    root = ET.parse(ASSETS_DIR / "index.xml").getroot()
+    return {table.find("./URL").text: table for table in root.iter("Table")}
+
+
+@pytest.fixture
+def fixture_zip(tmp_path: Path) -> FixtureZip:
+    """
+    Builds a small export zip of the given tables, whose index.xml only contains these tables.
+    Columns missing in the given rows are left empty.
+    """
+
+    def func(tables: dict[str, list[dict[str, str]]], header: dict[str, list[str]] | None = None) -> Path:
+        index = ET.parse(ASSETS_DIR / "index.xml")
+        media = index.getroot().find("./Media")
+        for table in media.findall("./Table"):
+            if table.find("./URL").text not in tables:
+                media.remove(table)
+
+        path = tmp_path / f"export{len(list(tmp_path.iterdir()))}.zip"
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("index.xml", ET.tostring(index.getroot(), encoding="unicode"))
+            for url, rows in tables.items():
+                columns = [column.find("./Name").text for column in _index_tables()[url].iter("VariableColumn")]
+                out = io.StringIO()
+                writer = csv.writer(out, delimiter=";", lineterminator="\r\n")
+                writer.writerow((header or {}).get(url, columns))
+                for row in rows:
+                    writer.writerow([row.get(column, "") for column in columns])
+                zf.writestr(url, out.getvalue())
+        return path
+
+    return func
+
+
+def test_missing_keys():
+    assert _missing_keys(array("q", [-5, 1, 3, 7]), array("q", [-5, 2, 3])) == [1, 7]
+    assert _missing_keys(array("q", [1, 2]), array("q")) == [1, 2]
+    assert _missing_keys(array("q"), array("q", [1])) == []
+    assert _missing_keys(array("q", [1, 2]), array("q", [0, 1, 2, 3])) == []
+
+
+def test_numeric_digit_grouping():
+    spec = _table_spec(_index_tables()["datapayment.csv"])
+    betrag = next(column for column in spec.columns if column.name == "BASISWAEH_BETRAG")
+    assert betrag.pattern.fullmatch("1234,50")
+    assert betrag.pattern.fullmatch("-1.234,50")
+    # the digit grouping symbol '.' only matches itself and not any character
+    assert not betrag.pattern.fullmatch("1x234,50")
+    assert not betrag.pattern.fullmatch("1.23,50")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_validate_zip(fixture_zip: FixtureZip, jobs: int, capsys):
+    # with more than one job the tables are checked in worker processes
+    path = fixture_zip({"transactions.csv": TRANSACTIONS, "lines.csv": LINES, "datapayment.csv": DATAPAYMENT})
+    assert validate_zip(path, jobs=jobs) == []
+    assert capsys.readouterr().out == ""
+
+    invalid_value = [dict(DATAPAYMENT[0], BASISWAEH_BETRAG="1x234,50")] + DATAPAYMENT[1:]
+    path = fixture_zip({"transactions.csv": TRANSACTIONS, "datapayment.csv": invalid_value})
+    assert validate_zip(path, jobs=jobs) == []
+    assert "datapayment.csv: Line 2: Value 1x234,50 in column 9 is not a valid decimal" in capsys.readouterr().out
+
+
+def test_validate_zip_duplicate_bon(fixture_zip: FixtureZip):
+    path = fixture_zip({"transactions.csv": TRANSACTIONS + TRANSACTIONS[:1], "lines.csv": LINES})
+    assert validate_zip(path, jobs=2) == ["transactions.csv: 1 records have a duplicate bon key"]
+
+
+def test_validate_zip_dangling_references(fixture_zip: FixtureZip):
+    dangling_lines = LINES + [dict(LINES[0], BON_ID="4"), dict(LINES[0], BON_ID="4", POS_ZEILE="2")]
+    path = fixture_zip({"transactions.csv": TRANSACTIONS, "lines.csv": dangling_lines, "datapayment.csv": DATAPAYMENT})
+    assert validate_zip(path, jobs=2) == [
+        "lines.csv: 1 referenced bons are missing in transactions.csv, "
+        f"e.g. line 5 (1, {Z_ERSTELLUNG}, 1, 4); line 6 (1, {Z_ERSTELLUNG}, 1, 4)"
+    ]
+
+
+def test_validate_zip_structural_errors(fixture_zip: FixtureZip):
+    columns = [column.find("./Name").text for column in _index_tables()["lines.csv"].iter("VariableColumn")]
+    path = fixture_zip(
+        {"transactions.csv": TRANSACTIONS, "lines.csv": LINES},
+        header={"lines.csv": [column if column != "MENGE" else "ANZAHL" for column in columns]},
+    )
+    assert validate_zip(path, jobs=2) == ["lines.csv: Expected column 18 to be MENGE, but headline is ANZAHL."]
+
+    path = fixture_zip({"transactions.csv": TRANSACTIONS}, header={"transactions.csv": ["Z_KASSE_ID"]})
+    assert validate_zip(path, jobs=2) == [
+        "transactions.csv: Line 1: Row has 1 fields but index.xml defines 23 fields.",
+    ]
+
+    # a table listed in index.xml has to be part of the export
+    path = fixture_zip({"transactions.csv": TRANSACTIONS, "lines.csv": LINES})
+    with zipfile.ZipFile(path) as zf:
+        index_xml = zf.read("index.xml")
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("index.xml", index_xml)
+        zf.writestr("transactions.csv", "")
+    assert validate_zip(path, jobs=1) == ['File "lines.csv" not found.']
@@ -1,7 +1,29 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
 
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from fastapi import HTTPException
+from sftkit.database import Connection
+
+from stustapay.core.schema.product import NewProduct
+from stustapay.core.schema.tax_rate import TaxRate
+from stustapay.core.schema.terminal import Terminal, TerminalConfig
+from stustapay.core.schema.till import (
+    NewTill,
+    NewTillButton,
+    NewTillLayout,
+    NewTillProfile,
+    Till,
+    TillLayout,
+    TillProfile,
+)
 from stustapay.core.schema.tree import Node
+from stustapay.core.service.common.error import Unauthorized
+from stustapay.core.service.product import ProductService
 from stustapay.core.service.terminal import TerminalService
+from stustapay.core.service.till import TillService
+from stustapay.terminalserver.router.base import config as config_route
 
 
 async def test_terminal_registration_flow(
@@ -21,3 +43,143 @@ async def test_terminal_registration_flow(
         token=event_admin_token, node_id=event_node.id, terminal_id=terminal_config.id
     )
     assert logged_out
+
+
+async def _config_version(db_connection: Connection, terminal_id: int) -> int:
+    return await db_connection.fetchval(
+        "select coalesce((select version from terminal_config_version where terminal_id = $1), 0)", terminal_id
+    )
+
+
+async def test_terminal_config_version_bumped_by_triggers(
+    db_connection: Connection,
+    terminal_service: TerminalService,
+    till_service: TillService,
+    product_service: ProductService,
+    tax_rate_ust: TaxRate,
+    event_node: Node,
+    event_admin_token: str,
+    terminal_token: str,
+    terminal: Terminal,
+    till: Till,
+    till_profile: TillProfile,
+    till_layout: TillLayout,
+):
+    version = await _config_version(db_connection, terminal.id)
+
+    async def assert_bumped():
+        nonlocal version
+        new_version = await _config_version(db_connection, terminal.id)
+        assert new_version > version
+        version = new_version
+
+    product = await product_service.create_product(
+        token=event_admin_token,
+        node_id=event_node.id,
+        product=NewProduct(name="Helles 0,5l", price=3, tax_rate_id=tax_rate_ust.id, is_locked=True),
+    )
+    button = await till_service.layout.create_button(
+        token=event_admin_token, node_id=event_node.id, button=NewTillButton(name="Helles", product_ids=[product.id])
+    )
+    # products and buttons which are not part of the layout of the terminal do not change its config
+    assert await _config_version(db_connection, terminal.id) == version
+
+    await till_service.layout.update_layout(
+        token=event_admin_token,
+        node_id=event_node.id,
+        layout_id=till_layout.id,
+        layout=NewTillLayout(name=till_layout.name, description="", button_ids=[button.id]),
+    )
+    await assert_bumped()
+
+    await product_service.update_product(
+        token=event_admin_token,
+        node_id=event_node.id,
+        product_id=product.id,
+        product=NewProduct(name="Helles 1,0l", price=3, tax_rate_id=tax_rate_ust.id, is_locked=True),
+    )
+    await assert_bumped()
+
+    await till_service.layout.update_button(
+        token=event_admin_token,
+        node_id=event_node.id,
+        button_id=button.id,
+        button=NewTillButton(name="Dunkles", product_ids=[product.id]),
+    )
+    await assert_bumped()
+
+    await till_service.profile.update_profile(
+        token=event_admin_token,
+        node_id=event_node.id,
+        profile_id=till_profile.id,
+        profile=NewTillProfile(
+            **till_profile.model_dump(exclude={"allow_top_up", "id", "node_id"}), allow_top_up=False
+        ),
+    )
+    await assert_bumped()
+
+    await terminal_service.logout_user(token=terminal_token)
+    await assert_bumped()
+
+    await db_connection.execute("update node set name = 'renamed event' where id = $1", event_node.id)
+    await assert_bumped()
+
+    await db_connection.execute("update event set max_account_balance = 200 where id = $1", event_node.event.id)
+    await assert_bumped()
+
+    await till_service.update_till(
+        token=event_admin_token,
+        node_id=event_node.id,
+        till_id=till.id,
+        till=NewTill(name=till.name, active_profile_id=till.active_profile_id, terminal_id=None),
+    )
+    await assert_bumped()
+
+
+async def test_terminal_config_etag(
+    db_connection: Connection,
+    terminal_service: TerminalService,
+    terminal_token: str,
+    terminal: Terminal,
+):
+    serialized = await terminal_service.get_serialized_terminal_config(token=terminal_token)
+    assert serialized is not None
+    config = TerminalConfig.model_validate_json(serialized.body)
+    assert config == await terminal_service.get_terminal_config(token=terminal_token)
+
+    # unchanged configs are served from the cache
+    assert await terminal_service.get_serialized_terminal_config(token=terminal_token) is serialized
+
+    response = await config_route(token=terminal_token, terminal_service=terminal_service, if_none_match=None)
+    assert response.status_code == 200
+    assert response.headers["ETag"] == serialized.etag
+    assert response.body == serialized.body
+
+    response = await config_route(
+        token=terminal_token, terminal_service=terminal_service, if_none_match=serialized.etag
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == serialized.etag
+    assert response.body == b""
+
+    response = await config_route(
+        token=terminal_token, terminal_service=terminal_service, if_none_match=f'"foo", W/{serialized.etag}'
+    )
+    assert response.status_code == 304
+
+    await db_connection.execute("update terminal set name = 'renamed terminal' where id = $1", terminal.id)
+    response = await config_route(
+        token=terminal_token, terminal_service=terminal_service, if_none_match=serialized.etag
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != serialized.etag
+    assert TerminalConfig.model_validate_json(response.body).name == "renamed terminal"
+
+    # the config route still reports a terminal without config as not found
+    with patch.object(terminal_service, "get_serialized_terminal_config", AsyncMock(return_value=None)):
+        with pytest.raises(HTTPException) as e:
+            await config_route(token=terminal_token, terminal_service=terminal_service, if_none_match=None)
+        assert e.value.status_code == 404
+
+    with pytest.raises(Unauthorized):
+        await terminal_service.get_serialized_terminal_config(token="invalid")
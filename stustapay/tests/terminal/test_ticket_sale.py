@@ -17,6 +17,7 @@ from stustapay.core.schema.tax_rate import TaxRate
 from stustapay.core.schema.ticket import NewTicket, Ticket
 from stustapay.core.schema.till import NewTillLayout, NewTillProfile, Till, TillLayout
 from stustapay.core.schema.tree import Node
+from stustapay.core.service.common.error import InvalidArgument
 from stustapay.core.service.order.order import OrderService, TillPermissionException
 from stustapay.core.service.ticket import TicketService
 from stustapay.core.service.till import TillService
@@ -293,6 +294,11 @@ async def test_ticket_flow_with_multiple_tags_invalid_booking(
         token=terminal_token, new_ticket_sale=new_ticket
     )
     assert completed_ticket is not None
+    # the first unrestricted customer in scan order is the one the order is booked for
+    assert (
+        completed_ticket.customer_account_id
+        == (await till_service.get_customer(token=terminal_token, customer_tag_uid=tag.uid)).id
+    )
     await assert_account_balance(
         account_id=cash_register_account_id,
         expected_balance=cash_drawer_start_balance + completed_ticket.total_price,
@@ -339,3 +345,71 @@ async def test_ticket_flow_with_multiple_tags_invalid_booking(
         + sale_tickets.ticket_u18.price
         + sale_tickets.ticket_u16.price,
     )
+
+
+async def test_ticket_scan_rejects_invalid_tags(
+    order_service: OrderService,
+    cashier: Cashier,
+    terminal_token: str,
+    sale_tickets: SaleTickets,
+    login_supervised_user: LoginSupervisedUser,
+    assign_cash_register: AssignCashRegister,
+    create_random_user_tag: CreateRandomUserTag,
+):
+    await assign_cash_register(cashier=cashier)
+    await login_supervised_user(user_tag_uid=cashier.user_tag_uid, user_role_id=cashier.cashier_role.id)
+    tag = await create_random_user_tag()
+    tag2 = await create_random_user_tag()
+
+    scan = await order_service.check_ticket_scan(
+        token=terminal_token,
+        new_ticket_scan=NewTicketScan(
+            customer_tags=[
+                UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin),
+                UserTagScan(tag_uid=tag2.uid, tag_pin=tag2.pin),
+            ]
+        ),
+    )
+    assert [tag.pin, tag2.pin] == [entry.customer_tag_pin for entry in scan.scanned_tickets]
+    assert all(entry.ticket.id == sale_tickets.ticket.id for entry in scan.scanned_tickets)
+
+    with pytest.raises(InvalidArgument, match="Unknown Ticket ID"):
+        await order_service.check_ticket_scan(
+            token=terminal_token,
+            new_ticket_scan=NewTicketScan(
+                customer_tags=[
+                    UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin),
+                    UserTagScan(tag_uid=1234, tag_pin="not-a-pin"),
+                ]
+            ),
+        )
+
+    with pytest.raises(InvalidArgument, match="Ticket scanned multiple times"):
+        await order_service.check_ticket_scan(
+            token=terminal_token,
+            new_ticket_scan=NewTicketScan(
+                customer_tags=[
+                    UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin),
+                    UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin),
+                ]
+            ),
+        )
+
+    await order_service.book_ticket_sale(
+        token=terminal_token,
+        new_ticket_sale=NewTicketSale(
+            uuid=uuid.uuid4(),
+            customer_tags=[UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin)],
+            payment_method=PaymentMethod.cash,
+        ),
+    )
+    with pytest.raises(InvalidArgument, match="Ticket already has account"):
+        await order_service.check_ticket_scan(
+            token=terminal_token,
+            new_ticket_scan=NewTicketScan(
+                customer_tags=[
+                    UserTagScan(tag_uid=tag.uid, tag_pin=tag.pin),
+                    UserTagScan(tag_uid=tag2.uid, tag_pin=tag2.pin),
+                ]
+            ),
+        )
@@ -32,3 +32,50 @@ async def test_account_comment_updates(
     acc = await account_service.get_account(token=event_admin_token, node_id=event_node.id, account_id=account_id)
     assert acc is not None
     assert "foobar" == acc.comment
+
+
+async def test_find_accounts_and_customers(
+    account_service: AccountService,
+    event_admin_token: str,
+    db_connection: Connection,
+    event_node: Node,
+    create_random_user_tag: CreateRandomUserTag,
+):
+    user_tag = await create_random_user_tag()
+    await db_connection.execute("update user_tag set uid = 3735928559 where id = $1", user_tag.id)
+    exact_id = await db_connection.fetchval(
+        "insert into account(node_id, user_tag_id, type, name) values ($1, $2, 'private', 'searchable') returning id",
+        event_node.id,
+        user_tag.id,
+    )
+    contains_id = await db_connection.fetchval(
+        "insert into account(node_id, type, name, comment) values ($1, 'private', 'not-searchable', '100%') "
+        "returning id",
+        event_node.id,
+    )
+    await db_connection.execute(
+        "update customer_info set email = 'Search.Me@example.com' where customer_account_id = $1", contains_id
+    )
+
+    accounts = await account_service.find_accounts(
+        token=event_admin_token, node_id=event_node.id, search_term="Searchable"
+    )
+    assert [exact_id, contains_id] == [a.id for a in accounts]
+
+    accounts = await account_service.find_accounts(token=event_admin_token, node_id=event_node.id, search_term="beef")
+    assert [exact_id] == [a.id for a in accounts]
+
+    accounts = await account_service.find_accounts(
+        token=event_admin_token, node_id=event_node.id, search_term=user_tag.pin.upper()
+    )
+    assert [exact_id] == [a.id for a in accounts]
+
+    # like wildcards in the search term are matched literally
+    accounts = await account_service.find_accounts(token=event_admin_token, node_id=event_node.id, search_term="0%")
+    assert [contains_id] == [a.id for a in accounts]
+
+    customers = await account_service.find_customers(
+        token=event_admin_token, node_id=event_node.id, search_term="search.me"
+    )
+    assert [contains_id] == [c.id for c in customers]
+    assert customers[0].email == "Search.Me@example.com"
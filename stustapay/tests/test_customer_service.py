@@ -4,6 +4,7 @@ import pytest
 from dateutil.parser import parse
 from sftkit.database import Connection
 
+from stustapay.core.http.caching import IMMUTABLE_CACHE_CONTROL
 from stustapay.core.schema.customer import Customer, OrderWithBon
 from stustapay.core.schema.order import Order, OrderType, PaymentMethod
 from stustapay.core.schema.product import NewProduct, Product
@@ -13,14 +14,16 @@ from stustapay.core.schema.tree import Node
 from stustapay.core.service.common.error import (
     AccessDenied,
     InvalidArgument,
+    NotFound,
     Unauthorized,
 )
 from stustapay.core.service.customer.common import fetch_customer
 from stustapay.core.service.customer.customer import CustomerBank, CustomerService
 from stustapay.core.service.mail import MailService
 from stustapay.core.service.order.booking import NewLineItem, book_order
-from stustapay.core.service.order.order import fetch_order
+from stustapay.core.service.order.order import OrderService, fetch_order
 from stustapay.core.service.product import ProductService
+from stustapay.customer_portal.routers.base import get_bon
 from stustapay.tests.conftest import Cashier, CreateRandomUserTag
 
 
@@ -165,6 +168,105 @@ async def test_get_orders_with_bon(customer_service: CustomerService, order_with
     assert resulting_order_with_bon.bon_generated
 
 
+async def test_get_orders_paginated(
+    db_connection: Connection,
+    customer_service: CustomerService,
+    order_with_bon: Order,
+    test_customer: Customer,
+    cashier: Cashier,
+    till: Till,
+):
+    async def book_another_order() -> int:
+        line_item = order_with_bon.line_items[0]
+        booking = await book_order(
+            conn=db_connection,
+            order_type=OrderType.sale,
+            payment_method=PaymentMethod.tag,
+            cashier_id=cashier.id,
+            till_id=till.id,
+            line_items=[
+                NewLineItem(
+                    quantity=2,
+                    product_id=line_item.product.id,
+                    product_price=line_item.product_price,
+                    tax_rate_id=line_item.tax_rate_id,
+                )
+            ],
+            bookings={},
+            customer_account_id=test_customer.id,
+        )
+        return booking.id
+
+    order_ids = [order_with_bon.id] + [await book_another_order() for _ in range(4)]
+
+    login_result = await customer_service.login_customer(pin=test_customer.user_tag_pin)
+    token = login_result.token
+
+    page = await customer_service.get_orders(token=token, limit=2)
+    assert [o.id for o in page.orders] == order_ids[::-1][:2]
+    assert page.next_cursor == order_ids[3]
+    page = await customer_service.get_orders(token=token, limit=2, cursor=page.next_cursor)
+    assert [o.id for o in page.orders] == order_ids[::-1][2:4]
+    page = await customer_service.get_orders(token=token, limit=2, cursor=page.next_cursor)
+    assert [o.id for o in page.orders] == [order_with_bon.id]
+    assert page.next_cursor is None
+
+    # the list only contains the totals, the line items are fetched per order
+    assert page.orders[0].total_price == order_with_bon.total_price
+    assert page.orders[0].total_tax == pytest.approx(order_with_bon.total_tax)
+    assert page.orders[0].bon_generated
+    order = await customer_service.get_order_with_bon(token=token, order_id=order_with_bon.id)
+    assert order.line_items == order_with_bon.line_items
+    assert order.bon_generated
+
+    with pytest.raises(InvalidArgument):
+        await customer_service.get_orders(token=token, cursor=-1)
+    with pytest.raises(InvalidArgument):
+        await customer_service.get_orders(token=token, limit=0)
+
+    # once notifications are received the history is cached until the customer gets a new order
+    await customer_service._on_order_notification(None)
+    page = await customer_service.get_orders(token=token)
+    assert len(page.orders) == 5
+    assert test_customer.id in customer_service.order_cache
+    new_order_id = await book_another_order()
+    assert len((await customer_service.get_orders(token=token)).orders) == 5
+    await customer_service._on_order_notification(
+        f'{{"order_id": {new_order_id}, "customer_account_id": {test_customer.id}}}'
+    )
+    page = await customer_service.get_orders(token=token)
+    assert page.orders[0].id == new_order_id
+    customer_service.order_cache_enabled = False
+    customer_service.order_cache.clear()
+
+
+async def test_get_serialized_bon(db_connection: Connection, order_service: OrderService, order_with_bon: Order):
+    stored_bon_json = await db_connection.fetchval("select bon_json::text from bon where id = $1", order_with_bon.id)
+    bon = await order_service.get_serialized_bon_by_uuid(order_uuid=str(order_with_bon.uuid))
+    assert bon.body == stored_bon_json.encode()
+    # generated bons are immutable and served from memory
+    assert await order_service.get_serialized_bon_by_uuid(order_uuid=str(order_with_bon.uuid)) is bon
+    assert await order_service.get_serialized_bon_by_id(order_id=order_with_bon.id) == bon
+
+    response = await get_bon(order_service=order_service, order_uuid=str(order_with_bon.uuid), if_none_match=None)
+    assert response.status_code == 200
+    assert response.body == bon.body
+    assert response.headers["ETag"] == bon.etag
+    assert response.headers["Cache-Control"] == IMMUTABLE_CACHE_CONTROL
+    response = await get_bon(order_service=order_service, order_uuid=str(order_with_bon.uuid), if_none_match=bon.etag)
+    assert response.status_code == 304
+    assert response.headers["Cache-Control"] == IMMUTABLE_CACHE_CONTROL
+
+    await db_connection.execute("update bon set generated_at = null, bon_json = null where id = $1", order_with_bon.id)
+    order_service.bon_cache.clear()
+    with pytest.raises(NotFound):
+        await order_service.get_serialized_bon_by_uuid(order_uuid=str(order_with_bon.uuid))
+    with pytest.raises(NotFound):
+        await order_service.get_serialized_bon_by_id(order_id=order_with_bon.id)
+    with pytest.raises(NotFound):
+        await order_service.get_serialized_bon_by_uuid(order_uuid="invalid")
+
+
 async def test_update_customer_info(
     test_customer: Customer, customer_service: CustomerService, mail_service: MailService
 ):
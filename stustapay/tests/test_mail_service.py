@@ -0,0 +1,119 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,protected-access
+from datetime import datetime, timedelta
+from typing import AsyncGenerator, Protocol
+
+import asyncpg
+import pytest
+from sftkit.database import Connection
+
+from stustapay.core.config import Config
+from stustapay.core.schema.mail import MailMetadata
+from stustapay.core.schema.tree import Node, RestrictedEventSettings
+from stustapay.core.service.mail import MailService
+
+CLAIM_BATCH_SIZE = 2
+# long overdue, the test mails are claimed before any other mails in the test database
+SCHEDULED_SEND_DATE = datetime(1990, 1, 1)
+
+
+class InsertMails(Protocol):
+    async def __call__(self, n_mails: int) -> list[int]: ...
+
+
+@pytest.fixture
+async def claiming_mail_service(setup_test_db_pool: asyncpg.Pool, config: Config) -> MailService:
+    mail_service = MailService(db_pool=setup_test_db_pool, config=config)
+    mail_service.MAIL_CLAIM_BATCH_SIZE = CLAIM_BATCH_SIZE
+    return mail_service
+
+
+@pytest.fixture
+async def insert_mails(db_connection: Connection, event_node: Node) -> AsyncGenerator[InsertMails, None]:
+    mail_ids: list[int] = []
+
+    async def func(n_mails: int) -> list[int]:
+        ids = []
+        for i in range(n_mails):
+            mail_id = await db_connection.fetchval(
+                "insert into mails (node_id, subject, message, to_addr, from_addr, scheduled_send_date) "
+                "values ($1, 'subject', 'message', $2, 'test@stustapay.de', $3) returning id",
+                event_node.id,
+                f"customer{i}@stustapay.de",
+                SCHEDULED_SEND_DATE + timedelta(seconds=i),
+            )
+            ids.append(mail_id)
+        mail_ids.extend(ids)
+        return ids
+
+    yield func
+    await db_connection.execute("delete from mails where id = any($1)", mail_ids)
+
+
+def _ids(mails: list[MailMetadata]) -> set[int]:
+    return {mail.id for mail in mails}
+
+
+async def test_concurrent_claims_are_disjoint(
+    setup_test_db_pool: asyncpg.Pool, claiming_mail_service: MailService, insert_mails: InsertMails
+):
+    mail_ids = await insert_mails(n_mails=2 * CLAIM_BATCH_SIZE)
+
+    async with setup_test_db_pool.acquire() as conn:
+        async with conn.transaction(isolation="serializable"):
+            first_claim, _ = await claiming_mail_service._claim_mails(conn=conn)
+            # the first claim is not yet committed, its mails are locked and skipped
+            second_claim, _ = await claiming_mail_service._claim_mails()
+
+    assert _ids(first_claim) == set(mail_ids[:CLAIM_BATCH_SIZE])
+    assert _ids(second_claim) == set(mail_ids[CLAIM_BATCH_SIZE:])
+
+    # both claims are committed, their mails are not claimed again until the claims expire
+    third_claim, _ = await claiming_mail_service._claim_mails()
+    assert _ids(third_claim).isdisjoint(mail_ids)
+
+
+async def test_expired_claims_are_claimed_again(
+    db_connection: Connection, claiming_mail_service: MailService, insert_mails: InsertMails
+):
+    mail_ids = await insert_mails(n_mails=CLAIM_BATCH_SIZE)
+
+    claim, _ = await claiming_mail_service._claim_mails()
+    assert _ids(claim) == set(mail_ids)
+    claim, _ = await claiming_mail_service._claim_mails()
+    assert _ids(claim).isdisjoint(mail_ids)
+
+    # the sender of the first claim did not finish in time
+    await db_connection.execute(
+        "update mails set send_claimed_until = $2 where id = $1", mail_ids[0], datetime.now() - timedelta(seconds=1)
+    )
+    claim, _ = await claiming_mail_service._claim_mails()
+    assert _ids(claim) & set(mail_ids) == {mail_ids[0]}
+
+
+async def test_sent_mails_are_not_claimed_again(
+    db_connection: Connection, claiming_mail_service: MailService, insert_mails: InsertMails
+):
+    mail_ids = await insert_mails(n_mails=CLAIM_BATCH_SIZE)
+    sent_id, unsent_id = mail_ids
+
+    async def send_mail(*, mail: MailMetadata, res_config: RestrictedEventSettings) -> bool:
+        del res_config
+        return mail.id == sent_id
+
+    claiming_mail_service._send_mail = send_mail  # type: ignore[method-assign]
+    n_claimed = await claiming_mail_service._send_pending_mails()
+    assert n_claimed == CLAIM_BATCH_SIZE
+
+    rows = await db_connection.fetch("select id, send_date, send_claimed_until from mails where id = any($1)", mail_ids)
+    mails = {row["id"]: row for row in rows}
+    assert mails[sent_id]["send_date"] is not None
+    assert mails[sent_id]["send_claimed_until"] is None
+    assert mails[unsent_id]["send_date"] is None
+    assert mails[unsent_id]["send_claimed_until"] is not None
+
+    # once all claims expired only the unsent mail is retried
+    await db_connection.execute(
+        "update mails set send_claimed_until = $2 where id = any($1)", mail_ids, datetime.now() - timedelta(seconds=1)
+    )
+    claim, _ = await claiming_mail_service._claim_mails()
+    assert _ids(claim) & set(mail_ids) == {unsent_id}
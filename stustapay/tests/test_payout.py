@@ -16,7 +16,11 @@ from stustapay.core.schema.tree import Node, RestrictedEventSettings
 from stustapay.core.schema.user import format_user_tag_uid
 from stustapay.core.service.common.error import InvalidArgument
 from stustapay.core.service.customer.customer import CustomerService
-from stustapay.core.service.customer.payout import Payout, dump_payout_run_as_sepa_xml
+from stustapay.core.service.customer.payout import (
+    Payout,
+    dump_payout_run_as_sepa_xml,
+    dump_payout_run_as_sepa_xml_files,
+)
 from stustapay.core.service.mail import MailService
 from stustapay.core.service.user_tag import get_or_assign_user_tag
 from stustapay.tests.conftest import CreateRandomUserTag
@@ -266,6 +270,95 @@ async def test_max_num_payouts(
     check_sepa_xml(xml_content, customers_to_transfer, event.sepa_config)
 
 
+async def test_sepa_xml_split_into_files(
+    customers: list[CustomerTestInfo],
+    event_node: Node,
+    event: RestrictedEventSettings,
+    event_admin_token: str,
+    customer_service: CustomerService,
+):
+    assert event.sepa_config is not None
+    num = 5
+    customers_to_transfer = filter_zero_payout(customers)[:num]
+
+    payout_run: PayoutRunWithStats = await customer_service.payout.create_payout_run(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_payout_run=NewPayoutRun(max_num_payouts=num, max_payout_sum=15000),
+    )
+
+    with pytest.raises(InvalidArgument):
+        await customer_service.payout.get_payout_run_sepa_xml_files(
+            token=event_admin_token,
+            node_id=event_node.id,
+            payout_run_id=payout_run.id,
+            execution_date=datetime.date.today(),
+            max_transactions_per_file=0,
+        )
+
+    sepa_xml_files = await customer_service.payout.get_payout_run_sepa_xml_files(
+        token=event_admin_token,
+        node_id=event_node.id,
+        payout_run_id=payout_run.id,
+        execution_date=datetime.date.today(),
+        max_transactions_per_file=2,
+    )
+    assert len(sepa_xml_files) == 3
+    for i, xml_content in enumerate(sepa_xml_files):
+        check_sepa_xml(xml_content, customers_to_transfer[i * 2 : (i + 1) * 2], event.sepa_config)
+
+    previous_files = await customer_service.payout.get_previous_payout_run_sepa_xml_files(
+        token=event_admin_token, node_id=event_node.id, payout_run_id=payout_run.id
+    )
+    assert previous_files == sepa_xml_files
+    with pytest.raises(InvalidArgument):
+        await customer_service.payout.get_previous_payout_run_sepa_xml(
+            token=event_admin_token, node_id=event_node.id, payout_run_id=payout_run.id
+        )
+
+
+async def test_sepa_xml_files_error(
+    db_connection: Connection,
+    customers: list[CustomerTestInfo],
+    event_node: Node,
+    event: RestrictedEventSettings,
+    event_admin_token: str,
+    customer_service: CustomerService,
+):
+    del customers  # only creates the payouts
+    assert event.sepa_config is not None
+    payout_run: PayoutRunWithStats = await customer_service.payout.create_payout_run(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_payout_run=NewPayoutRun(max_num_payouts=5, max_payout_sum=15000),
+    )
+    invalid_sepa_config = copy.deepcopy(event.sepa_config)
+    invalid_sepa_config.description = "{user_tag_uid} ä"
+    async with db_connection.transaction():
+        with pytest.raises(ValueError):
+            await dump_payout_run_as_sepa_xml_files(
+                conn=db_connection,
+                executor=customer_service.payout.sepa_executor,
+                payout_run_id=payout_run.id,
+                currency_ident=event.currency_identifier,
+                sepa_config=invalid_sepa_config,
+                execution_date=datetime.date.today(),
+                max_transactions_per_file=1,
+            )
+
+        # the executor is kept for the next export
+        sepa_xml_files = await dump_payout_run_as_sepa_xml_files(
+            conn=db_connection,
+            executor=customer_service.payout.sepa_executor,
+            payout_run_id=payout_run.id,
+            currency_ident=event.currency_identifier,
+            sepa_config=event.sepa_config,
+            execution_date=datetime.date.today(),
+            max_transactions_per_file=1,
+        )
+    assert len(sepa_xml_files) == payout_run.n_payouts
+
+
 async def test_revoke_payout(
     event_node: Node,
     customers: list[CustomerTestInfo],
@@ -310,6 +403,7 @@ async def test_set_payout_to_done(
     db_connection: Connection,
     customers: list[CustomerTestInfo],
     event_node: Node,
+    event: RestrictedEventSettings,
     event_admin_token: str,
     customer_service: CustomerService,
     mail_service: MailService,
@@ -319,6 +413,11 @@ async def test_set_payout_to_done(
         node_id=event_node.id,
         new_payout_run=NewPayoutRun(max_num_payouts=15, max_payout_sum=15000),
     )
+    await db_connection.execute(
+        "update event set email_enabled = true, email_default_sender = 'payout@stustapay.de' "
+        "where id = (select event_id from node where id = $1)",
+        event_node.event_node_id,
+    )
     await customer_service.payout.set_payout_run_as_done(
         token=event_admin_token,
         node_id=event_node.id,
@@ -326,6 +425,18 @@ async def test_set_payout_to_done(
         mail_service=mail_service,
     )
 
+    payout_emails = await db_connection.fetch(
+        "select email from payout where payout_run_id = $1 and email is not null order by customer_account_id",
+        payout_run.id,
+    )
+    assert len(payout_emails) > 0
+    mails = await db_connection.fetch(
+        "select to_addr, subject, message from mails where node_id = $1 order by id", event_node.id
+    )
+    assert [m["to_addr"] for m in mails] == [p["email"] for p in payout_emails]
+    assert all(m["subject"] == event.payout_done_subject for m in mails)
+    assert all(m["message"] == event.payout_done_message for m in mails)
+
     for customer in customers:
         balance = await db_connection.fetchval("select round(balance, 2) from account where id = $1", customer.id)
         assert balance == 0
@@ -344,6 +455,43 @@ async def test_set_payout_to_done(
         )
 
 
+async def test_set_payout_to_done_without_mail_template(
+    db_connection: Connection,
+    customers: list[CustomerTestInfo],
+    event_node: Node,
+    event_admin_token: str,
+    customer_service: CustomerService,
+    mail_service: MailService,
+):
+    payout_run: PayoutRunWithStats = await customer_service.payout.create_payout_run(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_payout_run=NewPayoutRun(max_num_payouts=15, max_payout_sum=15000),
+    )
+    await db_connection.execute(
+        "update event set email_enabled = true, email_default_sender = 'payout@stustapay.de', "
+        "payout_done_message = '' "
+        "where id = (select event_id from node where id = $1)",
+        event_node.event_node_id,
+    )
+    await customer_service.payout.set_payout_run_as_done(
+        token=event_admin_token,
+        node_id=event_node.id,
+        payout_run_id=payout_run.id,
+        mail_service=mail_service,
+    )
+
+    n_mails = await db_connection.fetchval("select count(*) from mails where node_id = $1", event_node.id)
+    assert n_mails == 0
+    payout_run = await customer_service.payout.get_payout_run(
+        token=event_admin_token, node_id=event_node.id, payout_run_id=payout_run.id
+    )
+    assert payout_run.done
+    for customer in customers:
+        balance = await db_connection.fetchval("select round(balance, 2) from account where id = $1", customer.id)
+        assert balance == 0
+
+
 async def test_csv_export(
     db_connection: Connection,
     event_node: Node,
@@ -0,0 +1,85 @@
+# pylint: disable=unexpected-keyword-arg,missing-kwoa,protected-access
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+
+import asyncpg
+from sftkit.database import Connection
+
+from stustapay.core.schema.tree import Node, RestrictedEventSettings
+from stustapay.core.service.sumup import (
+    SumUpOAuthTokenCache,
+    fetch_stored_sumup_oauth_token,
+)
+from stustapay.payment.sumup.api import SumUpOAuthToken
+
+
+def _token(access_token: str, expires_in: timedelta) -> SumUpOAuthToken:
+    return SumUpOAuthToken(
+        access_token=access_token,
+        refresh_token="refresh",
+        expires_in=int(expires_in.total_seconds()),
+        token_type="Bearer",
+        expires_at=datetime.now().astimezone() + expires_in,
+    )
+
+
+async def _wait_for_refreshes(cache: SumUpOAuthTokenCache):
+    await asyncio.gather(*cache.refreshes.values())
+
+
+async def test_sumup_oauth_token_cache(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, event_node: Node, event: RestrictedEventSettings
+):
+    del event_node
+    cache = SumUpOAuthTokenCache(db_pool=setup_test_db_pool)
+    fetch = AsyncMock(return_value=_token("token1", timedelta(hours=1)))
+    with patch("stustapay.core.service.sumup.fetch_new_oauth_token", fetch):
+        # callers never wait for sumup, requests during a running refresh do not trigger another one
+        for _ in range(5):
+            assert await cache.get_token(conn=db_connection, event_settings=event) is None
+        await _wait_for_refreshes(cache)
+        assert fetch.await_count == 1
+
+        token = await cache.get_token(conn=db_connection, event_settings=event)
+        assert token is not None and token.access_token == "token1"
+        stored = await fetch_stored_sumup_oauth_token(conn=db_connection, event_id=event.id)
+        assert stored is not None and stored.access_token == "token1"
+
+        # other processes share the stored token
+        other_cache = SumUpOAuthTokenCache(db_pool=setup_test_db_pool)
+        token = await other_cache.get_token(conn=db_connection, event_settings=event)
+        assert token is not None and token.access_token == "token1"
+        assert not other_cache.refreshes
+        assert fetch.await_count == 1
+
+    # tokens about to expire are still handed out while they are refreshed in the background
+    cache.tokens[event.id] = _token("token1", timedelta(minutes=5))
+    await db_connection.execute(
+        "update sumup_oauth_token set expires_at = $2 where event_id = $1",
+        event.id,
+        cache.tokens[event.id].expires_at,
+    )
+    cache.last_refresh.clear()
+    fetch = AsyncMock(return_value=_token("token2", timedelta(hours=1)))
+    with patch("stustapay.core.service.sumup.fetch_new_oauth_token", fetch):
+        token = await cache.get_token(conn=db_connection, event_settings=event)
+        assert token is not None and token.access_token == "token1"
+        await _wait_for_refreshes(cache)
+        assert fetch.await_count == 1
+        token = await cache.get_token(conn=db_connection, event_settings=event)
+        assert token is not None and token.access_token == "token2"
+
+
+async def test_sumup_oauth_token_refresh_is_locked_across_processes(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, event: RestrictedEventSettings
+):
+    cache = SumUpOAuthTokenCache(db_pool=setup_test_db_pool)
+    fetch = AsyncMock(return_value=_token("token", timedelta(hours=1)))
+    with patch("stustapay.core.service.sumup.fetch_new_oauth_token", fetch):
+        async with setup_test_db_pool.acquire() as conn, conn.transaction():
+            # another process is currently refreshing the token
+            await conn.execute("select pg_advisory_xact_lock($1, $2)", 7319, event.id)
+            assert await cache.get_token(conn=db_connection, event_settings=event) is None
+            await _wait_for_refreshes(cache)
+        assert fetch.await_count == 0
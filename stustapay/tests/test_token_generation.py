@@ -0,0 +1,49 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+import pytest
+from sftkit.database import Connection
+
+from stustapay import token_generation
+from stustapay.core.config import Config
+from stustapay.core.schema.tree import Node
+
+
+def test_generate_pins():
+    pins = token_generation.generate_pins(25000, exclude={"AAAAAAAAAAAA"})
+    assert len(pins) == 25000
+    assert len(set(pins)) == 25000
+    for pin in pins:
+        assert len(pin) == token_generation.PIN_LENGTH
+        assert set(pin) <= set(token_generation.PIN_ALPHABET)
+
+
+async def test_generate_pins_unique_in_database(
+    config: Config,
+    db_connection: Connection,
+    event_node: Node,
+    user_tag_secret: int,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    await db_connection.execute(
+        "insert into user_tag (node_id, secret_id, pin) values ($1, $2, 'CCCCCCCCCCCC')", event_node.id, user_tag_secret
+    )
+    generate_pin_chunk = token_generation.generate_pin_chunk
+    chunks = [["CCCCCCCCCCCC", "DDDDDDDDDDDD", "DDDDDDDDDDDD", "EEEEEEEEEEEE"]]
+
+    def fake_generate_pin_chunk(count: int) -> list[str]:
+        if chunks:
+            return chunks.pop()
+        return generate_pin_chunk(count)
+
+    monkeypatch.setattr(token_generation, "generate_pin_chunk", fake_generate_pin_chunk)
+    pins = await token_generation._generate_unique_pins_for_node(  # pylint: disable=protected-access
+        config=config, node_id=event_node.id, count=3, secret_id=user_tag_secret
+    )
+    assert len(pins) == 3
+    assert len(set(pins)) == 3
+    assert "CCCCCCCCCCCC" not in pins
+    assert {"DDDDDDDDDDDD", "EEEEEEEEEEEE"} <= set(pins)
+
+    n_created = await db_connection.fetchval(
+        "select count(*) from user_tag where pin = any($1) and node_id = $2", pins, event_node.id
+    )
+    assert n_created == 3
@@ -1,9 +1,19 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa,no-value-for-parameter
+import asyncio
+
 import pytest
 from asyncpg import RaiseError
 from sftkit.database import Connection
 
-from stustapay.core.schema.tree import ROOT_NODE_ID, NewEvent, NewNode, Node, ObjectType
+from stustapay.core.schema.tree import (
+    ROOT_NODE_ID,
+    Language,
+    NewEvent,
+    NewNode,
+    Node,
+    NodeSeenByUser,
+    ObjectType,
+)
 from stustapay.core.service.tree.common import fetch_node
 from stustapay.core.service.tree.service import TreeService
 from stustapay.tests.common import list_equals
@@ -246,3 +256,75 @@ async def test_object_rules(tree_service: TreeService, global_admin_token: str):
         ],
         sub_node.computed_forbidden_objects_in_subtree,
     )
+
+
+async def test_tree_cache(db_connection: Connection, tree_service: TreeService, global_admin_token: str):
+    notifications: list[str] = []
+
+    def on_notification(*args):
+        notifications.append(args[-1])
+
+    await db_connection.add_listener("tree", on_notification)
+
+    # once notifications are received trees are cached until nodes or roles change
+    await tree_service._on_tree_notification(None)  # pylint: disable=protected-access
+    try:
+        tree = await tree_service.get_serialized_tree_for_current_user(token=global_admin_token)
+        assert tree is await tree_service.get_serialized_tree_for_current_user(token=global_admin_token)
+        assert NodeSeenByUser.model_validate_json(tree.body).id == ROOT_NODE_ID
+
+        await tree_service.create_node(
+            token=global_admin_token,
+            node_id=ROOT_NODE_ID,
+            new_node=NewNode(name="Cached tree node", description=""),
+        )
+        for _ in range(50):
+            if notifications:
+                break
+            await asyncio.sleep(0.02)
+        assert len(notifications) > 0
+
+        await tree_service._on_tree_notification(notifications[0])  # pylint: disable=protected-access
+        assert len(tree_service.tree_cache) == 0
+        updated_tree = await tree_service.get_serialized_tree_for_current_user(token=global_admin_token)
+        assert updated_tree.etag != tree.etag
+        assert any(
+            child.name == "Cached tree node" for child in NodeSeenByUser.model_validate_json(updated_tree.body).children
+        )
+    finally:
+        await db_connection.remove_listener("tree", on_notification)
+        tree_service.tree_cache_enabled = False
+        tree_service.tree_cache.clear()
+
+
+async def test_fetch_node_translations(db_connection: Connection, event_node: Node):
+    assert event_node.event is not None
+    await db_connection.execute(
+        "insert into translation_text (event_id, lang_code, type, content) values "
+        "($1, 'de-DE', 'greeting', 'Hallo'), ($1, 'en-US', 'greeting', 'Hello')",
+        event_node.event.id,
+    )
+
+    def find_event_node(node: Node) -> Node | None:
+        if node.id == event_node.id:
+            return node
+        for child in node.children:
+            found = find_event_node(child)
+            if found is not None:
+                return found
+        return None
+
+    root_node = await fetch_node(conn=db_connection, node_id=ROOT_NODE_ID)
+    assert root_node is not None
+    node = find_event_node(root_node)
+    assert node is not None and node.event is not None
+    assert {
+        Language.de_DE: {"greeting": "Hallo"},
+        Language.en_US: {"greeting": "Hello"},
+    } == node.event.translation_texts
+
+    root_node = await fetch_node(conn=db_connection, node_id=ROOT_NODE_ID, with_translations=False)
+    assert root_node is not None
+    node = find_event_node(root_node)
+    assert node is not None and node.event is not None
+    assert {} == node.event.translation_texts
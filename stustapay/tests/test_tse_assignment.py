@@ -0,0 +1,46 @@
+import pytest
+
+from stustapay.tse.signature_processor import TseLoad, plan_tse_assignment
+
+
+def _load(tse_id: int, n_tills: int = 0, queue_depth: int = 0, latency: float | None = None) -> TseLoad:
+    return TseLoad(tse_id=tse_id, name=f"tse{tse_id}", n_tills=n_tills, queue_depth=queue_depth, latency=latency)
+
+
+def _assigned_tse_ids(assignment: dict[int, TseLoad]) -> dict[int, int]:
+    return {till_id: load.tse_id for till_id, load in assignment.items()}
+
+
+def test_plan_tse_assignment_without_tses():
+    assert plan_tse_assignment([], [1, 2, 3]) == {}
+
+
+def test_plan_tse_assignment_greedy_cost():
+    # expected delay of the next signature: 0.25 * 1 on the fast tse versus 0.75 * 1 on the slow one
+    fast, slow = _load(1, latency=0.25), _load(2, latency=0.75)
+    assignment = plan_tse_assignment([fast, slow], [10, 11, 12, 13])
+    # the fast tse gets tills until 0.25 * (n_tills + 1) exceeds the cost of the slow one
+    assert _assigned_tse_ids(assignment) == {10: 1, 11: 1, 12: 1, 13: 2}
+    assert fast.n_tills == 3
+    assert slow.n_tills == 1
+
+
+def test_plan_tse_assignment_weights_queue_depth():
+    busy, idle = _load(1, n_tills=1, queue_depth=5, latency=0.1), _load(2, n_tills=3, latency=0.1)
+    assignment = plan_tse_assignment([busy, idle], [10, 11])
+    assert _assigned_tse_ids(assignment) == {10: 2, 11: 2}
+    # the queue depth counts once per waiting request, just like an assigned till
+    assignment = plan_tse_assignment([_load(1, queue_depth=2, latency=1.0), _load(2, n_tills=2, latency=0.5)], [10])
+    assert _assigned_tse_ids(assignment) == {10: 2}
+
+
+def test_plan_tse_assignment_unmeasured_tses():
+    # without any measurements tills are balanced on till count and queue depth, ties go to the first tse
+    assignment = plan_tse_assignment([_load(1, n_tills=1), _load(2), _load(3, queue_depth=1)], [10, 11, 12])
+    assert _assigned_tse_ids(assignment) == {10: 2, 11: 1, 12: 2}
+    # a tse without measurements is assumed to sign as fast as the average of the measured ones
+    unmeasured = _load(2)
+    plan_tse_assignment([_load(1, latency=0.2), unmeasured, _load(3, latency=0.4)], [])
+    assignment = plan_tse_assignment([_load(1, n_tills=1, latency=0.2), unmeasured, _load(3, latency=0.4)], [10])
+    assert _assigned_tse_ids(assignment) == {10: 2}
+    assert unmeasured.n_tills == pytest.approx(1)
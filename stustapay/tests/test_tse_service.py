@@ -0,0 +1,36 @@
+# pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
+from stustapay.core.schema.tree import Node
+from stustapay.core.schema.tse import NewTse, TseType, UpdateTse
+from stustapay.core.service.tse import TseService
+
+
+async def test_update_tse_keeps_max_concurrent_signatures(
+    tse_service: TseService, event_node: Node, event_admin_token: str
+):
+    tse = await tse_service.create_tse(
+        token=event_admin_token,
+        node_id=event_node.id,
+        new_tse=NewTse(
+            name="tse",
+            ws_url="ws://localhost:10001",
+            ws_timeout=5,
+            password="123456",
+            type=TseType.diebold_nixdorf,
+            serial="tse-serial",
+            max_concurrent_signatures=4,
+        ),
+    )
+    assert tse.max_concurrent_signatures == 4
+
+    update = UpdateTse(name="renamed tse", ws_url=tse.ws_url, ws_timeout=tse.ws_timeout, password=tse.password)
+    tse = await tse_service.update_tse(
+        token=event_admin_token, node_id=event_node.id, tse_id=tse.id, updated_tse=update
+    )
+    assert tse.name == "renamed tse"
+    assert tse.max_concurrent_signatures == 4
+
+    update.max_concurrent_signatures = 2
+    tse = await tse_service.update_tse(
+        token=event_admin_token, node_id=event_node.id, tse_id=tse.id, updated_tse=update
+    )
+    assert tse.max_concurrent_signatures == 2
@@ -1,6 +1,15 @@
 # pylint: disable=attribute-defined-outside-init,unexpected-keyword-arg,missing-kwoa
 
-from stustapay.core.service.user_tag import UserTagService
+import pytest
+from sftkit.database import Connection
+
+from stustapay.core.schema.user_tag import NewUserTag
+from stustapay.core.service.common.error import InvalidArgument
+from stustapay.core.service.user_tag import (
+    UserTagService,
+    create_user_tags,
+    parse_user_tag_csv,
+)
 
 from ..core.schema.tree import Node
 from .conftest import CreateRandomUserTag
@@ -28,3 +37,86 @@ async def test_user_tag_comment_updates(
     )
     assert user_tag_detail is not None
     assert "foobar" == user_tag_detail.comment
+
+
+async def _chunked(data: bytes, chunk_size: int = 7):
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+async def test_import_user_tags(
+    user_tag_service: UserTagService,
+    event_node: Node,
+    event_admin_token: str,
+    user_tag_secret: int,
+    db_connection: Connection,
+):
+    csv_data = (
+        f"pin,restriction,secret_id\r\nimport-pin-1,,{user_tag_secret}\r\n"
+        f"import-pin-2,under_18,{user_tag_secret}\r\n\r\nimport-pin-3,,{user_tag_secret}"
+    ).encode()
+    result = await user_tag_service.import_user_tags(
+        token=event_admin_token, node_id=event_node.id, records=parse_user_tag_csv(_chunked(csv_data))
+    )
+    assert result.n_imported == 3
+    rows = await db_connection.fetch(
+        "select pin, restriction from user_tag where pin like 'import-pin-%' and node_id = $1 order by pin",
+        event_node.id,
+    )
+    assert [("import-pin-1", None), ("import-pin-2", "under_18"), ("import-pin-3", None)] == [
+        (r["pin"], r["restriction"]) for r in rows
+    ]
+
+    invalid_imports = [
+        (f"pin,secret_id\nimport-pin-4,{user_tag_secret}\nimport-pin-4,{user_tag_secret}", "Duplicate pins"),
+        (f"pin,secret_id\nimport-pin-1,{user_tag_secret}", "Pins already exist"),
+        (f"pin,secret_id\nimport-pin-5,{user_tag_secret + 1000}", "Unknown user tag secrets"),
+        (f"pin,restriction,secret_id\nimport-pin-6,under_3,{user_tag_secret}", "Unknown restrictions"),
+        (f"pin,secret_id\nimport-pin-7,foo", "Invalid user tag in line 2"),
+        ("pin\nimport-pin-8", "needs a header"),
+    ]
+    for csv_text, error in invalid_imports:
+        with pytest.raises(InvalidArgument, match=error):
+            await user_tag_service.import_user_tags(
+                token=event_admin_token, node_id=event_node.id, records=parse_user_tag_csv(_chunked(csv_text.encode()))
+            )
+
+    n_tags = await db_connection.fetchval("select count(*) from user_tag where pin like 'import-pin-%'")
+    assert n_tags == 3
+
+
+async def test_create_user_tags_bulk(
+    event_node: Node,
+    user_tag_secret: int,
+    db_connection: Connection,
+):
+    tags = [NewUserTag(pin=f"bulk-pin-{i}", secret_id=user_tag_secret) for i in range(100)]
+    await create_user_tags(conn=db_connection, node_id=event_node.id, tags=tags)
+    n_tags = await db_connection.fetchval(
+        "select count(*) from user_tag where pin like 'bulk-pin-%' and node_id = $1", event_node.id
+    )
+    assert n_tags == 100
+
+    with pytest.raises(InvalidArgument, match="Pins already exist"):
+        await create_user_tags(conn=db_connection, node_id=event_node.id, tags=tags)
+
+
+async def test_create_user_tags_validates_small_lists(
+    event_node: Node,
+    user_tag_secret: int,
+    db_connection: Connection,
+):
+    duplicate_tags = [
+        NewUserTag(pin="small-pin-1", secret_id=user_tag_secret),
+        NewUserTag(pin="small-pin-1", secret_id=user_tag_secret),
+    ]
+    with pytest.raises(InvalidArgument, match="Duplicate pins"):
+        await create_user_tags(conn=db_connection, node_id=event_node.id, tags=duplicate_tags)
+    with pytest.raises(InvalidArgument, match="Unknown user tag secrets"):
+        await create_user_tags(
+            conn=db_connection, node_id=event_node.id, tags=[NewUserTag(pin="small-pin-2", secret_id=-1)]
+        )
+
+    await create_user_tags(conn=db_connection, node_id=event_node.id, tags=duplicate_tags[:1])
+    with pytest.raises(InvalidArgument, match="Pins already exist"):
+        await create_user_tags(conn=db_connection, node_id=event_node.id, tags=duplicate_tags[:1])
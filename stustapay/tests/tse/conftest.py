@@ -0,0 +1,89 @@
+# pylint: disable=redefined-outer-name
+import secrets
+from dataclasses import dataclass
+from typing import Awaitable, Protocol
+
+import pytest
+from sftkit.database import Connection
+
+from stustapay.core.schema.till import TillProfile
+from stustapay.core.schema.tree import Node
+
+from ..conftest import Cashier
+
+N_TILLS = 4
+
+
+@dataclass
+class TseTills:
+    tse_id: int
+    # the tills assigned to the tse
+    till_ids: list[int]
+
+
+class InsertOrders(Protocol):
+    def __call__(self, n_orders_per_till: int) -> Awaitable[list[int]]: ...
+
+
+@pytest.fixture
+async def tse_tills(db_connection: Connection, event_node: Node, till_profile: TillProfile) -> TseTills:
+    """A new tse which has not been connected yet, with N_TILLS tills assigned to it"""
+    tse_id = await db_connection.fetchval(
+        "insert into tse (node_id, name, serial, ws_url, password) values ($1, $2, 'serial', '', '') returning id",
+        event_node.id,
+        f"test-tse-{secrets.token_hex(8)}",
+    )
+    till_ids = [
+        await db_connection.fetchval(
+            "insert into till (name, active_profile_id, node_id, tse_id) values ($1, $2, $3, $4) returning id",
+            f"test-tse-till-{secrets.token_hex(8)}",
+            till_profile.id,
+            event_node.id,
+            tse_id,
+        )
+        for _ in range(N_TILLS)
+    ]
+    return TseTills(tse_id=tse_id, till_ids=till_ids)
+
+
+@pytest.fixture
+async def insert_orders(
+    db_connection: Connection, event_node: Node, cashier: Cashier, tse_tills: TseTills
+) -> InsertOrders:
+    """Books top ups on all tills of the tse, the order ids interleave between the tills"""
+    account_id = await db_connection.fetchval(
+        "insert into account (node_id, type) values ($1, 'private') returning id", event_node.id
+    )
+    top_up = await db_connection.fetchrow(
+        "select p.id, t.name as tax_name, t.rate as tax_rate, t.id as tax_rate_id "
+        "from product p join tax_rate t on p.tax_rate_id = t.id "
+        "where p.name = 'Aufladen' and p.node_id = $1",
+        event_node.id,
+    )
+
+    async def func(n_orders_per_till: int) -> list[int]:
+        order_ids = []
+        for _ in range(n_orders_per_till):
+            for till_id in tse_tills.till_ids:
+                order_id = await db_connection.fetchval(
+                    "insert into ordr (item_count, payment_method, z_nr, order_type, cashier_id, till_id, "
+                    "   customer_account_id) "
+                    "values (1, 'sumup', 1, 'top_up', $1, $2, $3) returning id",
+                    cashier.id,
+                    till_id,
+                    account_id,
+                )
+                await db_connection.execute(
+                    "insert into line_item (order_id, item_id, product_id, product_price, quantity, tax_name, "
+                    "   tax_rate, tax_rate_id) "
+                    "values ($1, 0, $2, 10, 1, $3, $4, $5)",
+                    order_id,
+                    top_up["id"],
+                    top_up["tax_name"],
+                    top_up["tax_rate"],
+                    top_up["tax_rate_id"],
+                )
+                order_ids.append(order_id)
+        return order_ids
+
+    return func
@@ -0,0 +1,77 @@
+import asyncio
+import socket
+import time
+
+import asyncpg
+import uvicorn
+from sftkit.database import Connection
+
+from stustapay.tse.diebold_nixdorf_usb.config import DieboldNixdorfUSBTSEConfig
+from stustapay.tse.diebold_nixdorf_usb.handler import DieboldNixdorfUSBTSE
+from stustapay.tse.diebold_nixdorf_usb.simulator import (
+    LatencyDistribution,
+    WebsocketInterface,
+    simulator_serial,
+)
+from stustapay.tse.wrapper import TSEWrapper
+
+from .conftest import InsertOrders, TseTills
+
+SIGNING_DELAY = 0.2
+# StartTransaction and FinishTransaction take SIGNING_DELAY each
+SIGNING_COMMANDS_PER_SIGNATURE = 2
+
+
+async def test_simulated_tse_signs_tills_concurrently(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    simulator = WebsocketInterface(latency=LatencyDistribution(mean=SIGNING_DELAY), fast_sign=True)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(simulator.make_app(), log_level="warning"))
+    server_task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    tse = DieboldNixdorfUSBTSE(
+        "simulator",
+        DieboldNixdorfUSBTSEConfig(
+            serial_number=simulator_serial(0), password="12345", ws_url=f"ws://127.0.0.1:{port}"
+        ),
+    )
+    n_tills = len(tse_tills.till_ids)
+    wrapper = TSEWrapper(tse_tills.tse_id, lambda: tse, prefetch_size=n_tills, max_concurrent_signatures=n_tills)
+    order_ids = await insert_orders(n_orders_per_till=2)
+
+    start = time.monotonic()
+    wrapper.start(setup_test_db_pool)
+    wrapper.notify_maybe_orders_available()
+    try:
+        for _ in range(200):
+            n_done = await db_connection.fetchval(
+                "select count(*) from tse_signature where signature_status = 'done' and id = any($1)", order_ids
+            )
+            if n_done == len(order_ids):
+                break
+            await asyncio.sleep(0.05)
+        duration = time.monotonic() - start
+    finally:
+        await wrapper.stop()
+        server.should_exit = True
+        await server_task
+
+    assert n_done == len(order_ids)
+    # the simulator answers the requests of one connection concurrently, one after another would take at least
+    # this long
+    assert duration < len(order_ids) * SIGNING_COMMANDS_PER_SIGNATURE * SIGNING_DELAY
+
+    # the signature counter of the tse still follows the order of the orders of each till
+    rows = await db_connection.fetch(
+        "select o.till_id, s.tse_signaturenr from tse_signature s join ordr o on s.id = o.id "
+        "where s.id = any($1) order by s.id",
+        order_ids,
+    )
+    for till_id in tse_tills.till_ids:
+        counters = [int(row["tse_signaturenr"]) for row in rows if row["till_id"] == till_id]
+        assert counters == sorted(counters)
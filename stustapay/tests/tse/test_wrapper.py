@@ -0,0 +1,344 @@
+# pylint: disable=protected-access
+import asyncio
+import typing
+
+import asyncpg
+import pytest
+from sftkit.database import Connection
+
+from stustapay.tse.handler import (
+    TSEHandler,
+    TSEMasterData,
+    TSEOperationError,
+    TSESignature,
+    TSESignatureRequest,
+)
+from stustapay.tse.wrapper import SignatureFailure, SignatureResult, TSEWrapper
+
+from .conftest import InsertOrders, TseTills
+
+
+class FakeTSE(TSEHandler):
+    """
+    Signs requests after sign_delay, unless release is cleared, then it waits until it is set.
+    Requests of one ClientID must never be signed concurrently.
+    """
+
+    def __init__(self, sign_delay: float = 0.01):
+        self.sign_delay = sign_delay
+        self.release = asyncio.Event()
+        self.release.set()
+        # order id -> error the TSE reports for it
+        self.errors: dict[int, Exception] = {}
+        # raised for all requests once the connection broke down
+        self.connection_error: typing.Optional[Exception] = None
+        self.client_ids: list[str] = []
+        # order ids in the order their signature was started
+        self.signing_started: list[int] = []
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+        self._signing_clients = set[str]()
+        self._stop = False
+
+    async def start(self) -> bool:
+        return True
+
+    async def stop(self):
+        self._stop = True
+
+    async def register_client_id(self, client_id: str):
+        self.client_ids.append(client_id)
+
+    async def deregister_client_id(self, client_id: str):
+        self.client_ids.remove(client_id)
+
+    async def sign(self, request: TSESignatureRequest) -> TSESignature:
+        assert request.till_id not in self._signing_clients
+        self._signing_clients.add(request.till_id)
+        self.signing_started.append(request.order_id)
+        self.n_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        try:
+            await self.release.wait()
+            await asyncio.sleep(self.sign_delay)
+            if self.connection_error is not None:
+                raise self.connection_error
+            if request.order_id in self.errors:
+                raise self.errors[request.order_id]
+            return TSESignature(
+                tse_transaction=str(request.order_id),
+                tse_signaturenr=str(len(self.signing_started)),
+                tse_start="2024-06-01T12:00:00.000Z",
+                tse_end="2024-06-01T12:00:01.000Z",
+                tse_signature=f"signature{request.order_id}",
+            )
+        finally:
+            self.n_in_flight -= 1
+            self._signing_clients.remove(request.till_id)
+
+    async def get_client_ids(self) -> list[str]:
+        return list(self.client_ids)
+
+    def get_master_data(self) -> TSEMasterData:
+        return TSEMasterData(
+            tse_serial="serial",
+            tse_hashalgo="ecdsa-plain-SHA384",
+            tse_time_format="unixTime",
+            tse_public_key="public key",
+            tse_certificate="certificate",
+            tse_process_data_encoding="UTF-8",
+        )
+
+    def is_stop_set(self) -> bool:
+        return self._stop
+
+    def __str__(self):
+        return "fake-tse"
+
+
+class RecordingTSEWrapper(TSEWrapper):
+    """Records the order ids of every batch the writer stores"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.done_batches: list[list[int]] = []
+        self.failed_batches: list[list[int]] = []
+
+    async def _requests_done(self, conn: Connection, requests: list[tuple[TSESignatureRequest, TSESignature]]):
+        if requests:
+            self.done_batches.append([request.order_id for request, _ in requests])
+        await super()._requests_done(conn, requests)
+
+    async def _fail_requests(self, conn: Connection, requests: list[tuple[TSESignatureRequest, str]]):
+        if requests:
+            self.failed_batches.append([request.order_id for request, _ in requests])
+        await super()._fail_requests(conn, requests)
+
+
+async def _signature_states(conn: Connection, order_ids: list[int]) -> dict[int, tuple[str, typing.Optional[int]]]:
+    rows = await conn.fetch("select id, signature_status, tse_id from tse_signature where id = any($1)", order_ids)
+    return {row["id"]: (row["signature_status"], row["tse_id"]) for row in rows}
+
+
+async def _wait_for(condition: typing.Callable[[], typing.Awaitable[bool]], timeout: float = 10):
+    for _ in range(int(timeout / 0.05)):
+        if await condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("condition was not met in time")
+
+
+async def _run_wrapper(
+    db_pool: asyncpg.Pool, wrapper: TSEWrapper, tse: FakeTSE
+) -> typing.Callable[[], typing.Awaitable[None]]:
+    """Runs the signing pipeline of the wrapper on a connected tse, returns a function which stops and awaits it"""
+    conn = await db_pool.acquire()
+    wrapper.name = "test-tse"
+    wrapper._tse_handler = tse
+    task = asyncio.create_task(wrapper._run_signing_pipeline(conn))
+    wrapper.notify_maybe_orders_available()
+
+    async def stop():
+        wrapper._stop = True
+        wrapper.notify_maybe_orders_available()
+        try:
+            await task
+        finally:
+            await db_pool.release(conn)
+
+    return stop
+
+
+async def test_signing_pipeline_writes_results_in_order(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    order_ids = await insert_orders(n_orders_per_till=3)
+    tse = FakeTSE()
+    wrapper = RecordingTSEWrapper(tse_tills.tse_id, lambda: tse, prefetch_size=4)
+    stop = await _run_wrapper(setup_test_db_pool, wrapper, tse)
+
+    async def all_done() -> bool:
+        states = await _signature_states(db_connection, order_ids)
+        return all(status == "done" for status, _ in states.values())
+
+    try:
+        await _wait_for(all_done)
+    finally:
+        await stop()
+
+    # one signature at a time, in the order of the orders, and the results are stored in the same order
+    assert tse.signing_started == order_ids
+    assert tse.max_in_flight == 1
+    assert [order_id for batch in wrapper.done_batches for order_id in batch] == order_ids
+    assert wrapper.failed_batches == []
+    assert set(tse.client_ids) == {str(till_id) for till_id in tse_tills.till_ids}
+    rows = await db_connection.fetch(
+        "select id, tse_id, tse_signature, transaction_process_data from tse_signature where id = any($1)", order_ids
+    )
+    for row in rows:
+        assert row["tse_id"] == tse_tills.tse_id
+        assert row["tse_signature"] == f"signature{row['id']}"
+        assert row["transaction_process_data"] is not None
+
+
+async def test_signing_pipeline_returns_prefetched_requests_on_shutdown(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    # one order per till, a till only ever has a single claimed request
+    order_ids = await insert_orders(n_orders_per_till=1)
+    tse = FakeTSE()
+    tse.release.clear()
+    wrapper = TSEWrapper(tse_tills.tse_id, lambda: tse, prefetch_size=2)
+    stop = await _run_wrapper(setup_test_db_pool, wrapper, tse)
+
+    async def all_claimed() -> bool:
+        states = await _signature_states(db_connection, order_ids)
+        return all(status == "pending" for status, _ in states.values())
+
+    stopping = None
+    try:
+        # one request is being signed, two are queued and the prefetcher holds the last one
+        await _wait_for(all_claimed)
+        assert tse.signing_started == order_ids[:1]
+        # shut down while the first signature is still running
+        stopping = asyncio.create_task(stop())
+        await asyncio.sleep(0.1)
+    finally:
+        tse.release.set()
+        await (stopping if stopping is not None else stop())
+
+    states = await _signature_states(db_connection, order_ids)
+    assert states[order_ids[0]] == ("done", tse_tills.tse_id)
+    for order_id in order_ids[1:]:
+        assert states[order_id] == ("new", None)
+
+
+async def test_signing_pipeline_writer_batches_results(
+    db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    order_ids = await insert_orders(n_orders_per_till=2)
+    await db_connection.execute(
+        "update tse_signature set signature_status = 'pending', tse_id = $2 where id = any($1)",
+        order_ids,
+        tse_tills.tse_id,
+    )
+    wrapper = RecordingTSEWrapper(tse_tills.tse_id, FakeTSE)
+    results = asyncio.Queue[typing.Optional[tuple[TSESignatureRequest, SignatureResult]]]()
+    for order_id in order_ids:
+        request = TSESignatureRequest(order_id=order_id, till_id="", process_type="type", process_data="data")
+        result: SignatureResult
+        if order_id == order_ids[1]:
+            result = SignatureFailure("timeout", "TSE operation failed, timeout")
+        else:
+            result = TSESignature(
+                tse_transaction="1",
+                tse_signaturenr="1",
+                tse_start="2024-06-01T12:00:00.000Z",
+                tse_end="2024-06-01T12:00:01.000Z",
+                tse_signature="signature",
+            )
+        results.put_nowait((request, result))
+    results.put_nowait(None)
+
+    # everything that accumulated is written in one transaction, with one statement each for done and failed requests
+    await wrapper._write_loop(db_connection, results, max_batch_size=len(order_ids) + 1)
+    assert wrapper.done_batches == [order_ids[:1] + order_ids[2:]]
+    assert wrapper.failed_batches == [order_ids[1:2]]
+    states = await _signature_states(db_connection, order_ids)
+    assert states.pop(order_ids[1]) == ("failure", tse_tills.tse_id)
+    assert all(status == "done" for status, _ in states.values())
+
+    # larger backlogs are split into batches of at most max_batch_size results
+    order_ids = await insert_orders(n_orders_per_till=2)
+    await db_connection.execute(
+        "update tse_signature set signature_status = 'pending', tse_id = $2 where id = any($1)",
+        order_ids,
+        tse_tills.tse_id,
+    )
+    wrapper.failed_batches.clear()
+    for order_id in order_ids:
+        request = TSESignatureRequest(order_id=order_id, till_id="", process_type="type", process_data="data")
+        results.put_nowait((request, SignatureFailure("error", "failed")))
+    results.put_nowait(None)
+    await wrapper._write_loop(db_connection, results, max_batch_size=3)
+    assert wrapper.failed_batches == [order_ids[0:3], order_ids[3:6], order_ids[6:8]]
+
+
+async def test_signing_pipeline_signs_tills_concurrently(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    order_ids = await insert_orders(n_orders_per_till=3)
+    tse = FakeTSE(sign_delay=0.05)
+    wrapper = TSEWrapper(tse_tills.tse_id, lambda: tse, prefetch_size=4, max_concurrent_signatures=3)
+    stop = await _run_wrapper(setup_test_db_pool, wrapper, tse)
+
+    async def all_done() -> bool:
+        states = await _signature_states(db_connection, order_ids)
+        return all(status == "done" for status, _ in states.values())
+
+    try:
+        await _wait_for(all_done)
+    finally:
+        await stop()
+
+    assert tse.max_in_flight == 3
+    # the requests of every till are still signed in the order of their orders
+    n_tills = len(tse_tills.till_ids)
+    for till_idx in range(n_tills):
+        till_order_ids = order_ids[till_idx::n_tills]
+        assert [order_id for order_id in tse.signing_started if order_id in till_order_ids] == till_order_ids
+
+
+async def test_signing_pipeline_fails_requests_refused_by_the_tse(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    order_ids = await insert_orders(n_orders_per_till=2)
+    tse = FakeTSE()
+    tse.errors[order_ids[1]] = TSEOperationError("transaction refused")
+    wrapper = TSEWrapper(tse_tills.tse_id, lambda: tse, max_concurrent_signatures=2)
+    stop = await _run_wrapper(setup_test_db_pool, wrapper, tse)
+
+    async def all_finished() -> bool:
+        states = await _signature_states(db_connection, order_ids)
+        return all(status in ("done", "failure") for status, _ in states.values())
+
+    try:
+        await _wait_for(all_finished)
+    finally:
+        await stop()
+
+    states = await _signature_states(db_connection, order_ids)
+    assert states.pop(order_ids[1]) == ("failure", tse_tills.tse_id)
+    assert all(status == "done" for status, _ in states.values())
+    result_message = await db_connection.fetchval(
+        "select result_message from tse_signature where id = $1", order_ids[1]
+    )
+    assert "transaction refused" in result_message
+
+
+async def test_signing_pipeline_returns_requests_on_connection_errors(
+    setup_test_db_pool: asyncpg.Pool, db_connection: Connection, tse_tills: TseTills, insert_orders: InsertOrders
+):
+    order_ids = await insert_orders(n_orders_per_till=1)
+    tse = FakeTSE()
+    tse.release.clear()
+    wrapper = TSEWrapper(tse_tills.tse_id, lambda: tse, prefetch_size=1, max_concurrent_signatures=3)
+    stop = await _run_wrapper(setup_test_db_pool, wrapper, tse)
+
+    async def all_returned() -> bool:
+        states = await _signature_states(db_connection, order_ids)
+        return all(state == ("new", None) for state in states.values())
+
+    try:
+        await _wait_for(lambda: asyncio.sleep(0, result=tse.n_in_flight == 3))
+        # the connection drops while three signatures are in flight, the pipeline stops by itself
+        tse.connection_error = ConnectionResetError("websocket connection closed")
+        tse.release.set()
+        await _wait_for(all_returned)
+    finally:
+        tse.release.set()
+        with pytest.raises(ConnectionResetError):
+            await stop()
+
+    # none of the requests was failed, they are signed once the tse is reconnected
+    assert await _signature_states(db_connection, order_ids) == {order_id: ("new", None) for order_id in order_ids}
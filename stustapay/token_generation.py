@@ -1,14 +1,137 @@
+import asyncio
+import logging
 import secrets
+import sys
+from pathlib import Path
 from textwrap import wrap
+from typing import Optional, TextIO
 
+from stustapay.core.config import Config
+from stustapay.core.database import get_database
+from stustapay.core.service.user_tag import (
+    fetch_existing_user_tag_pins,
+    import_user_tags,
+)
 
-def generate_nfc(count: int):
-    print("index,pin")
-    for i in range(count):
-        # so we have 36520347436056576 pins
-        pin = "".join((secrets.choice("ACDEFHJKLMNPQRTUVWXY3479") for _ in range(12)))
+logger = logging.getLogger(__name__)
 
-        print(f"{i},{pin}")
+# so we have 24^12 = 36520347436056576 pins
+PIN_ALPHABET = "ACDEFHJKLMNPQRTUVWXY3479"
+PIN_LENGTH = 12
+# random bytes >= this are rejected to keep the distribution over the alphabet uniform
+_PIN_BYTE_LIMIT = 256 - 256 % len(PIN_ALPHABET)
+_PIN_TRANSLATION = b"".join(
+    PIN_ALPHABET[b % len(PIN_ALPHABET)].encode() if b < _PIN_BYTE_LIMIT else b"?" for b in range(256)
+)
+_PIN_REJECTED_BYTES = bytes(range(_PIN_BYTE_LIMIT, 256))
+
+# number of pins generated per batch of random bytes
+PIN_CHUNK_SIZE = 10000
+# number of pins checked against the database per query
+PIN_DB_CHECK_BATCH_SIZE = 10000
+
+
+def generate_pin_chunk(count: int) -> list[str]:
+    """generate count random pins, duplicates are possible but have to be filtered by the caller"""
+    pin_chars = b""
+    n_chars = count * PIN_LENGTH
+    while len(pin_chars) < n_chars:
+        # rejection sampling over bulk random bytes instead of one secrets.choice per character
+        raw = secrets.token_bytes(int((n_chars - len(pin_chars)) * 1.1) + 16)
+        pin_chars += raw.translate(_PIN_TRANSLATION, _PIN_REJECTED_BYTES)
+    text = pin_chars[:n_chars].decode()
+    return [text[i : i + PIN_LENGTH] for i in range(0, n_chars, PIN_LENGTH)]
+
+
+def generate_pins(count: int, exclude: Optional[set[str]] = None) -> list[str]:
+    """generate count unique pins, pins in exclude are never returned"""
+    exclude = exclude or set()
+    seen: set[str] = set()
+    pins: list[str] = []
+
+    def add_pins(chunk: list[str]):
+        for pin in chunk:
+            if len(pins) >= count:
+                return
+            if pin not in seen and pin not in exclude:
+                seen.add(pin)
+                pins.append(pin)
+
+    for i in range(0, count, PIN_CHUNK_SIZE):
+        add_pins(generate_pin_chunk(min(PIN_CHUNK_SIZE, count - i)))
+
+    # refill the few pins lost to duplicates
+    while len(pins) < count:
+        add_pins(generate_pin_chunk(count - len(pins)))
+
+    return pins
+
+
+async def _generate_unique_pins_for_node(
+    config: Config, node_id: int, count: int, secret_id: Optional[int]
+) -> list[str]:
+    db = get_database(config.database)
+    db_pool = await db.create_pool(n_connections=1)
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction(isolation="serializable"):
+                pins = generate_pins(count)
+                existing: set[str] = set()
+                while True:
+                    collisions: set[str] = set()
+                    for i in range(0, len(pins), PIN_DB_CHECK_BATCH_SIZE):
+                        collisions |= await fetch_existing_user_tag_pins(
+                            conn=conn, node_id=node_id, pins=pins[i : i + PIN_DB_CHECK_BATCH_SIZE]
+                        )
+                    if len(collisions) == 0:
+                        break
+                    logger.info(f"Replacing {len(collisions)} pins which already exist in the database")
+                    existing |= collisions
+                    pins = [pin for pin in pins if pin not in collisions]
+                    pins += generate_pins(count - len(pins), exclude=existing | set(pins))
+
+                if secret_id is not None:
+                    await import_user_tags(
+                        conn=conn,
+                        node_id=node_id,
+                        records=[(idx, pin, None, secret_id) for idx, pin in enumerate(pins, start=1)],
+                    )
+                    logger.info(f"Created {len(pins)} user tags at node {node_id}")
+                return pins
+    finally:
+        await db_pool.close()
+
+
+def write_pins_csv(pins: list[str], out: TextIO):
+    out.write("index,pin\n")
+    out.writelines(f"{i},{pin}\n" for i, pin in enumerate(pins))
+
+
+def generate_nfc(
+    count: int,
+    out: Optional[Path] = None,
+    config: Optional[Config] = None,
+    node_id: Optional[int] = None,
+    secret_id: Optional[int] = None,
+):
+    """
+    Generate count unique pins and write them as csv to out (or stdout).
+    If a node is given the pins are also guaranteed to not collide with existing user tags in its tree and, if
+    additionally a user tag secret is given, directly created as user tags at that node.
+    """
+    if node_id is not None:
+        assert config is not None
+        pins = asyncio.run(
+            _generate_unique_pins_for_node(config=config, node_id=node_id, count=count, secret_id=secret_id)
+        )
+    else:
+        pins = generate_pins(count)
+
+    if out is None:
+        write_pins_csv(pins, sys.stdout)
+    else:
+        with out.open("w") as f:
+            write_pins_csv(pins, f)
 
 
 def generate_key():
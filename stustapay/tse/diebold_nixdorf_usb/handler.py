@@ -4,6 +4,7 @@ import binascii
 import contextlib
 import json
 import logging
+import time
 import typing
 
 import aiohttp
@@ -11,18 +12,25 @@ import pytz
 from dateutil import parser
 from sftkit.util import create_task_protected
 
+from stustapay.core.metrics import METRICS
 from stustapay.tse.diebold_nixdorf_usb.config import DieboldNixdorfUSBTSEConfig
 from stustapay.tse.handler import (
     TSEHandler,
     TSEMasterData,
+    TSEOperationError,
     TSESignature,
     TSESignatureRequest,
 )
 
 LOGGER = logging.getLogger(__name__)
 
+REQUEST_DURATION = METRICS.histogram(
+    "dn_tse_request_duration_seconds", "Round trip time of requests to the Diebold Nixdorf TSE by command"
+)
+REQUEST_ERRORS = METRICS.counter("dn_tse_request_errors_total", "Failed requests to the Diebold Nixdorf TSE by reason")
+
 
-class RequestError(RuntimeError):
+class RequestError(TSEOperationError):
     def __init__(self, name: str, request: dict, response: dict):
         self.name = name
         try:
@@ -130,23 +138,31 @@ class DieboldNixdorfUSBTSE(TSEHandler):
 
         LOGGER.info(f"{self}: >> {request}")
 
-        await self._ws.send_str(f"\x02{json.dumps(request)}\x03\n")
+        # register the future before sending, the response to concurrent requests might arrive while we send
         future: asyncio.Future[dict] = asyncio.Future()
         self.pending_requests[request_id] = future
+        start = time.monotonic()
+        await self._ws.send_str(f"\x02{json.dumps(request)}\x03\n")
         try:
             response = await asyncio.wait_for(future, timeout=timeout)
+            REQUEST_DURATION.observe(time.monotonic() - start, tse=self._name, command=command)
             LOGGER.info(f"{self}: << {response}")
             command_back = response.pop("Command")
             if command_back != command:
                 raise RuntimeError(f"{self}: wrong command returned while processing {request}: {response}")
             status = response.pop("Status")
             if status != "ok":
-                raise RequestError(self._name, request, response)
+                error = RequestError(self._name, request, response)
+                REQUEST_ERRORS.inc(tse=self._name, command=command, reason=f"code {error.code}")
+                raise error
             return response
         except asyncio.TimeoutError:
             error_message = f"{self}: timeout while waiting for response to {request}"
             LOGGER.error(error_message)
+            REQUEST_ERRORS.inc(tse=self._name, command=command, reason="timeout")
             raise asyncio.TimeoutError(error_message) from None
+        finally:
+            self.pending_requests.pop(request_id, None)
 
     async def request_with_password(self, *args, **kwargs):
         kwargs["Password"] = base64.b64encode(self.password.encode("utf-8")).decode("ascii")
@@ -174,39 +190,45 @@ class DieboldNixdorfUSBTSE(TSEHandler):
         create_task_protected(receive_internal(), f"receive_internal {self}", self._stop.set)
         create_task_protected(wait_for_stop(), f"wait_for_stop {self}", self._stop.set)
 
-        while True:
-            msg = await msg_queue.get()
-            if msg is None:
-                break
-
-            if msg.type != aiohttp.WSMsgType.TEXT:
-                if msg.type == aiohttp.WSMsgType.CLOSED:
-                    LOGGER.info(f"{self}: Websocket closed")
+        try:
+            while True:
+                msg = await msg_queue.get()
+                if msg is None:
                     break
-                msg_type = aiohttp.WSMsgType(msg.type).name
-                raise TypeError(f"{self}: Unexpected WS message {msg_type!r}")
-            msg_data: str = msg.data
 
-            if not msg_data.startswith("\x02") or not msg_data.endswith("\x03\n"):
-                LOGGER.error(f"{self}: Badly-formatted message: {msg!r}")
-                continue
-            try:
-                data = json.loads(msg_data[1:-2])
-            except json.decoder.JSONDecodeError:
-                LOGGER.error(f"{self}: Invalid JSON: {msg!r}")
-                continue
-            if not isinstance(data, dict):
-                LOGGER.error(f"{self}: JSON data is not a dict: {data!r}")
-                continue
-            message_id = data.pop("PingPong")
-            if not isinstance(message_id, int):
-                LOGGER.error(f"{self}: JSON data has no int PingPong field: {msg!r}")
-                continue
-            future = self.pending_requests.pop(message_id)
-            if future is None:
-                LOGGER.error(f"{self}: Response does not match any pending request: {msg!r}")
-                continue
-            future.set_result(data)
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    if msg.type == aiohttp.WSMsgType.CLOSED:
+                        LOGGER.info(f"{self}: Websocket closed")
+                        break
+                    msg_type = aiohttp.WSMsgType(msg.type).name
+                    raise TypeError(f"{self}: Unexpected WS message {msg_type!r}")
+                msg_data: str = msg.data
+
+                if not msg_data.startswith("\x02") or not msg_data.endswith("\x03\n"):
+                    LOGGER.error(f"{self}: Badly-formatted message: {msg!r}")
+                    continue
+                try:
+                    data = json.loads(msg_data[1:-2])
+                except json.decoder.JSONDecodeError:
+                    LOGGER.error(f"{self}: Invalid JSON: {msg!r}")
+                    continue
+                if not isinstance(data, dict):
+                    LOGGER.error(f"{self}: JSON data is not a dict: {data!r}")
+                    continue
+                message_id = data.pop("PingPong")
+                if not isinstance(message_id, int):
+                    LOGGER.error(f"{self}: JSON data has no int PingPong field: {msg!r}")
+                    continue
+                future = self.pending_requests.pop(message_id, None)
+                if future is None or future.done():
+                    LOGGER.error(f"{self}: Response does not match any pending request: {msg!r}")
+                    continue
+                future.set_result(data)
+        finally:
+            # the connection is gone, requests still waiting for their response will never get one
+            for future in self.pending_requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError(f"{self}: websocket connection closed"))
 
     async def register_client_id(self, client_id: str):
         await self.request_with_password("RegisterClientID", ClientID=client_id)
@@ -215,6 +237,8 @@ class DieboldNixdorfUSBTSE(TSEHandler):
         await self.request_with_password("DeregisterClientID", ClientID=client_id)
 
     async def sign(self, request: TSESignatureRequest) -> TSESignature:
+        # Transactions are opened per ClientID and matched to their responses by the PingPong id,
+        # so signatures for different ClientIDs can be in flight at the same time.
         LOGGER.info(f"{self}: signing {request}")
         start_result = await self.request_with_password("StartTransaction", ClientID=request.till_id)
         transaction_number = start_result["TransactionNumber"]
@@ -4,15 +4,19 @@ this code will simulate the dn TSE webservice (more or less)
 
 # TODO should we rename Transaction to Order here as well?
 
+import asyncio
 import base64
 import binascii
+import enum
 import json
 import logging
+import math
+import random
 import re
 import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256, sha384
-from inspect import stack
 from random import randbytes, randrange
 from typing import Optional
 
@@ -26,10 +30,15 @@ from asn1crypto.core import (
     PrintableString,
     Sequence,
 )
-from fastapi import FastAPI, WebSocket
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 
 from stustapay.tse.diebold_nixdorf_usb.protocol import TseResponse, TseSuccess, dnerror
 
+LOGGER = logging.getLogger(__name__)
+
 
 class SignatureAlgorithm_seq(Sequence):
     _fields = [
@@ -64,15 +73,93 @@ class TransactionData(Sequence):
 
 MAGIC_PRODUCTION_CLIENT = "DN TSEProduction ef82abcedf"
 
+DEFAULT_PRIVATE_KEY_HEX = (
+    "65a194772ded349bf0bf915a4f47f0a33fdc3078399c83530c2e91548119c9705f242056ad91f41ada94bf4954d08228"
+)
+
+# commands for which a real TSE needs to compute a signature
+SIGNING_COMMANDS = {"StartTransaction", "UpdateTransaction", "FinishTransaction"}
+
+
+def simulator_signing_key(index: int) -> ecdsa.SigningKey:
+    """
+    Deterministic key of the index-th virtual TSE, index 0 is the well-known default simulator key.
+    This way the serial numbers of many simulated TSEs are known in advance without generating keys.
+    """
+    if index == 0:
+        secret = bytes.fromhex(DEFAULT_PRIVATE_KEY_HEX)
+        return ecdsa.SigningKey.from_string(secret, curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384)
+    secret_exponent = int.from_bytes(sha384(f"stustapay-tse-simulator-{index}".encode()).digest(), "big")
+    secret_exponent = secret_exponent % (ecdsa.BRAINPOOLP384r1.order - 1) + 1
+    return ecdsa.SigningKey.from_secret_exponent(secret_exponent, curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384)
+
+
+def public_key_from_signing_key(sk: ecdsa.SigningKey) -> bytes:
+    return Sequence.load(sk.get_verifying_key().to_der())[1].dump()[3:]
+
+
+def simulator_serial(index: int) -> str:
+    """Serial number of the index-th virtual TSE of the simulator"""
+    return sha256(public_key_from_signing_key(simulator_signing_key(index))).hexdigest()
+
+
+class LatencyDistributionType(enum.Enum):
+    fixed = "fixed"
+    uniform = "uniform"
+    normal = "normal"
+    lognormal = "lognormal"
+
+
+@dataclass
+class LatencyDistribution:
+    """
+    Artificial signing latency of a virtual TSE in seconds.
+    mean is the average latency, spread its standard deviation (normal, lognormal) or half width (uniform).
+    """
+
+    type: LatencyDistributionType = LatencyDistributionType.fixed
+    mean: float = 0.25
+    spread: float = 0.0
+
+    def sample(self) -> float:
+        if self.type == LatencyDistributionType.uniform:
+            value = random.uniform(self.mean - self.spread, self.mean + self.spread)
+        elif self.type == LatencyDistributionType.normal:
+            value = random.gauss(self.mean, self.spread)
+        elif self.type == LatencyDistributionType.lognormal:
+            if self.mean <= 0:
+                return 0.0
+            # parameters of the underlying normal distribution for the requested mean and standard deviation
+            sigma_squared = math.log(1 + (self.spread / self.mean) ** 2)
+            value = random.lognormvariate(math.log(self.mean) - sigma_squared / 2, math.sqrt(sigma_squared))
+        else:
+            value = self.mean
+        return max(value, 0.0)
+
 
 class VirtualTSE:
     def __init__(
-        self, delay: float, fast: bool, real: bool, private_key_hex: Optional[str], gen_key: bool, broken: bool
+        self,
+        delay: float,
+        fast: bool,
+        real: bool,
+        private_key_hex: Optional[str],
+        gen_key: bool,
+        broken: bool,
+        index: int = 0,
+        latency: Optional[LatencyDistribution] = None,
+        failure_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        fast_sign: bool = False,
     ):
         self._fast: bool = fast
         self._real: bool = real
-        self._delay: float = delay
         self._broken: bool = broken
+        self._latency = latency if latency is not None else LatencyDistribution(mean=delay)
+        # probability that a signing command fails with an error response
+        self._failure_rate = failure_rate
+        # probability that the websocket connection is dropped after a signing command
+        self.disconnect_rate = disconnect_rate
 
         self.password_block_counter = 0
         self.puk_block_counter = 0
@@ -95,19 +182,17 @@ class VirtualTSE:
                 self.sk = ecdsa.SigningKey.generate(curve=ecdsa.BRAINPOOLP384r1, hashfunc=sha384)
                 print(f"new generated secret key: {self.sk.to_string().hex()}")
             else:
-                self.sk = ecdsa.SigningKey.from_string(
-                    bytes.fromhex(
-                        "65a194772ded349bf0bf915a4f47f0a33fdc3078399c83530c2e91548119c9705f242056ad91f41ada94bf4954d08228"
-                    ),
-                    curve=ecdsa.BRAINPOOLP384r1,
-                    hashfunc=sha384,
-                )
+                self.sk = simulator_signing_key(index)
+
+        # signing with the OpenSSL backend of cryptography instead of the pure python ecdsa implementation
+        self._fast_sk = None
+        if fast_sign:
+            self._fast_sk = ec.derive_private_key(self.sk.privkey.secret_multiplier, ec.BrainpoolP384R1())
 
-        vk = self.sk.get_verifying_key()
-        self.public_key = Sequence.load(vk.to_der())[1].dump()[3:]
+        self.public_key = public_key_from_signing_key(self.sk)
         self.serial = sha256(self.public_key).hexdigest()
 
-        print(f"Serial Number: {self.serial}")
+        print(f"Serial Number of TSE {index}: {self.serial}")
         self.certificate = b"THIS IS A VERY LONG CERTIFICATE!!!!"
         self.password_admin = "12345"
         self.password_timeadmin = self.password_admin
@@ -143,8 +228,18 @@ class VirtualTSE:
 
         return f"\x02{json.dumps(response)}\x03\n"
 
+    def signing_delay(self) -> float:
+        """Artificial time the last command took on a real TSE"""
+        if self._fast:
+            return 0.0
+        return self._latency.sample()
+
     def act_on_command(self, msg):
         response = {"Command": msg["Command"]}
+        if msg["Command"] in SIGNING_COMMANDS and self._failure_rate > 0 and random.random() < self._failure_rate:
+            response.update(dnerror(5))  # injected failure, command cannot be processed
+            return response
+
         if msg["Command"] == "PingPong":
             response["Status"] = "ok"
 
@@ -222,7 +317,7 @@ class VirtualTSE:
             "TransactionNumber": self.transnr,
             "SerialNumber": self.serial,
             "SignatureCounter": self.signctr,
-            "Signature": self.generate_signature(msg, str(self.transnr), log_time),
+            "Signature": self.generate_signature(msg, str(self.transnr), log_time, "starttrans"),
             "LogTime": log_time.isoformat(timespec="seconds"),
         }
 
@@ -263,7 +358,7 @@ class VirtualTSE:
         self.signctr += 1
         response["SignatureCounter"] = self.signctr
         log_time = datetime.now(timezone(timedelta(hours=1)))
-        response["Signature"] = self.generate_signature(msg, str(self.transnr), log_time)
+        response["Signature"] = self.generate_signature(msg, str(self.transnr), log_time, "updatetrans")
         response["LogTime"] = log_time.isoformat(timespec="seconds")
 
         return response
@@ -308,7 +403,7 @@ class VirtualTSE:
         response: TseResponse = {
             "Status": "ok",
             "SignatureCounter": self.signctr,
-            "Signature": self.generate_signature(msg, msg["TransactionNumber"], log_time),
+            "Signature": self.generate_signature(msg, msg["TransactionNumber"], log_time, "finishtrans"),
             "LogTime": log_time.isoformat(timespec="seconds"),
         }
 
@@ -497,14 +592,10 @@ class VirtualTSE:
 
         return {"Status": "ok", "Name": name, "Value": value_enc, "Length": len(value)}
 
-    def generate_signature(self, msg, transaction_nr, log_time):
+    def generate_signature(self, msg, transaction_nr, log_time, transaction_type: str):
         del transaction_nr
         signature: str = ""
 
-        # simulate time required for signing process
-        if not self._fast:
-            time.sleep(self._delay)
-
         # generate bs signature
         if not self._real:
             if randrange(5) == 0:
@@ -517,8 +608,6 @@ class VirtualTSE:
 
         # now for the real deal
 
-        # check from where we are called
-        transaction_type = stack()[1].function
         if transaction_type == "updatetrans":
             signature = "1c82c513e64e2cbfbefa189eafe8629ed7abce27a1b7e8de99a9ddf92b5eb9eae7fbefbe" + randbytes(60).hex()
             return signature
@@ -572,6 +661,10 @@ class VirtualTSE:
             + data["LogTime"].dump()
         )
 
+        if self._fast_sk is not None:
+            r, s = decode_dss_signature(self._fast_sk.sign(message, ec.ECDSA(hashes.SHA384())))
+            return (r.to_bytes(48, "big") + s.to_bytes(48, "big")).hex()
+
         signature = self.sk.sign(message).hex()
         return signature
 
@@ -587,40 +680,99 @@ class WebsocketInterface:
         private_key_hex: Optional[str] = None,
         gen_key: bool = False,
         broken: bool = False,
+        n_tses: int = 1,
+        latency: Optional[LatencyDistribution] = None,
+        failure_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        fast_sign: bool = False,
     ):
         self.host: str = host
         self.port: int = port
 
-        self.tse = VirtualTSE(delay, fast, real, private_key_hex, gen_key, broken)
+        # virtual TSE i is served at ws://host:port/i, the first one also at ws://host:port/
+        self.tses = [
+            VirtualTSE(
+                delay,
+                fast,
+                real,
+                private_key_hex if i == 0 else None,
+                gen_key,
+                broken,
+                index=i,
+                latency=latency,
+                failure_rate=failure_rate,
+                disconnect_rate=disconnect_rate,
+                fast_sign=fast_sign,
+            )
+            for i in range(n_tses)
+        ]
+        self.tse = self.tses[0]
 
     async def websocket_handler(self, websocket: WebSocket):
-        print("Websocket connection starting")
-        await websocket.accept()
-        print("Websocket connection ready")
+        tse_index = int(websocket.path_params.get("tse_index", 0))
+        if not 0 <= tse_index < len(self.tses):
+            await websocket.close()
+            return
+        tse = self.tses[tse_index]
 
-        while True:
-            data = await websocket.receive_text()
-            print(f" >>: {str(data).strip()}")
-            # check for STX ETX
-            if data[:1] == "\x02" and data[-2:] == "\x03\n":
-                resp = self.tse.parse_input(data)
-
-                print(f"<< : {str(resp).strip()}")
+        LOGGER.info(f"TSE {tse_index}: Websocket connection starting")
+        await websocket.accept()
+        LOGGER.info(f"TSE {tse_index}: Websocket connection ready")
+
+        # commands are answered as soon as they are done, so commands of different clients are signed concurrently
+        send_lock = asyncio.Lock()
+        closed = False
+        handlers = set[asyncio.Task]()
+
+        async def handle_command(data: str):
+            nonlocal closed
+            resp = tse.parse_input(data)
+            is_signing_command = json.loads(data.strip("\x02\x03\n")).get("Command") in SIGNING_COMMANDS
+            if is_signing_command:
+                # simulate time required for signing process without blocking other commands
+                await asyncio.sleep(tse.signing_delay())
+
+            async with send_lock:
+                if closed:
+                    return
+                LOGGER.debug(f"TSE {tse_index} << : {str(resp).strip()}")
                 await websocket.send_text(resp)
-            else:
-                print("ERROR: missing STX and/or ETX framing")
+                if is_signing_command and tse.disconnect_rate > 0 and random.random() < tse.disconnect_rate:
+                    LOGGER.warning(f"TSE {tse_index}: injecting disconnect")
+                    closed = True
+                    await websocket.close()
 
-        print("Websocket connection closed")
+        try:
+            while not closed:
+                data = await websocket.receive_text()
+                LOGGER.debug(f"TSE {tse_index} >>: {str(data).strip()}")
+                # check for STX ETX
+                if data[:1] == "\x02" and data[-2:] == "\x03\n":
+                    handler = asyncio.create_task(handle_command(data))
+                    handlers.add(handler)
+                    handler.add_done_callback(handlers.discard)
+                else:
+                    LOGGER.error(f"TSE {tse_index}: missing STX and/or ETX framing")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for handler in list(handlers):
+                handler.cancel()
 
-    async def run(self):
+        LOGGER.info(f"TSE {tse_index}: Websocket connection closed")
+
+    def make_app(self) -> FastAPI:
         app = FastAPI(
             title="TSE Simulator",
             license_info={"name": "AGPL-3.0"},
         )
-        app.add_websocket_route("/", self.websocket_handler)
+        app.add_api_websocket_route("/", self.websocket_handler)
+        app.add_api_websocket_route("/{tse_index}", self.websocket_handler)
+        return app
 
+    async def run(self):
         uvicorn_config = uvicorn.Config(
-            app,
+            self.make_app(),
             host=self.host,
             port=self.port,
             log_level=logging.root.level,
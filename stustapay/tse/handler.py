@@ -4,15 +4,23 @@ Defines the interface for the handlers for the various TSEs
 
 import abc
 import dataclasses
+import datetime
 import typing
 
 
+class TSEOperationError(RuntimeError):
+    """
+    The TSE reported an error for a single request, the TSE itself is still operational.
+    """
+
+
 @dataclasses.dataclass
 class TSESignatureRequest:
     order_id: int
     till_id: str
     process_type: str
     process_data: str
+    booked_at: typing.Optional[datetime.datetime] = None
 
 
 @dataclasses.dataclass
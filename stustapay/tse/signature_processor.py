@@ -1,12 +1,15 @@
 import asyncio
 import contextlib
 import logging
+import time
+from dataclasses import dataclass
 
 import asyncpg
 from sftkit.database import Connection, DatabaseHook
 
 from stustapay.core.config import Config
 from stustapay.core.healthcheck import run_healthcheck
+from stustapay.core.metrics import METRICS, run_metrics_snapshots
 from stustapay.core.schema.tse import Tse
 
 from ..core.database import get_database
@@ -15,10 +18,92 @@ from .wrapper import TSEWrapper
 
 LOGGER = logging.getLogger(__name__)
 
+# number of most recent signatures the rolling signing latency of a TSE is computed from
+LATENCY_WINDOW = 100
+# minimum number of seconds between two checks for tills to move away from slow TSEs
+REBALANCE_INTERVAL = 60
+
+QUEUE_DEPTH = METRICS.gauge("tse_signature_queue_depth", "Number of new and pending signature requests per TSE")
+FERAL_TILL_ASSIGNMENTS = METRICS.counter(
+    "tse_feral_till_assignments_total", "Number of tills without a TSE which were assigned to a TSE"
+)
+
+
+@dataclass
+class TseLoad:
+    tse_id: int
+    name: str
+    n_tills: int
+    queue_depth: int
+    # rolling average signing duration in seconds, None if the TSE has not signed anything yet
+    latency: float | None
+
+
+async def fetch_tse_loads(conn: Connection) -> list[TseLoad]:
+    """
+    Returns the number of assigned tills, the number of waiting signature requests
+    and the rolling signing latency of every active TSE.
+    """
+    rows = await conn.fetch(
+        """
+        select
+            tse.id as tse_id,
+            tse.name,
+            (select count(*) from till where till.tse_id = tse.id) as n_tills,
+            (
+                select count(*)
+                from tse_signature s join ordr o on o.id = s.id join till t on o.till_id = t.id
+                where t.tse_id = tse.id and s.signature_status in ('new', 'pending')
+            ) as queue_depth,
+            (
+                select avg(recent.tse_duration)
+                from (
+                    select s.tse_duration
+                    from tse_signature s
+                    where s.tse_id = tse.id and s.signature_status = 'done' and s.tse_duration is not null
+                    order by s.id desc
+                    limit $1
+                ) recent
+            ) as latency
+        from tse
+        where tse.status = 'active'
+        order by tse.id
+        """,
+        LATENCY_WINDOW,
+    )
+    return [TseLoad(**row) for row in rows]
+
+
+def plan_tse_assignment(tse_loads: list[TseLoad], till_ids: list[int]) -> dict[int, TseLoad]:
+    """
+    Greedily assigns each till to the TSE with the lowest expected signing delay,
+    estimated as the rolling latency times the number of assigned tills and waiting requests.
+    TSEs without latency measurements are assumed to be as fast as the average TSE,
+    so without any measurements this balances on till count and queue depth only.
+    """
+    if not tse_loads:
+        return {}
+    latencies = [load.latency for load in tse_loads if load.latency is not None]
+    default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+
+    def cost(load: TseLoad) -> float:
+        latency = load.latency if load.latency is not None else default_latency
+        return latency * (load.n_tills + load.queue_depth + 1)
+
+    assignment = {}
+    for till_id in till_ids:
+        best = min(tse_loads, key=cost)
+        best.n_tills += 1
+        assignment[till_id] = best
+    return assignment
+
 
 class SignatureProcessor:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, rebalance_latency_factor: float | None = None):
         self.config = config
+        # if set, idle tills are moved away from TSEs that sign slower than this factor times the median latency
+        self.rebalance_latency_factor = rebalance_latency_factor
+        self._last_rebalance = 0.0
         self.tses: dict[int, TSEWrapper] = {}  # tse_id -> Tse
         self.db_pool: asyncpg.Pool | None = None
         # contains event objects for each object that is waiting for new events.
@@ -58,12 +143,15 @@ class SignatureProcessor:
                 )
                 for tse_in_db in tses_in_db:
                     factory = get_tse_handler(tse_in_db)
-                    tse = TSEWrapper(tse_id=tse_in_db.id, factory_function=factory)
+                    tse = TSEWrapper(
+                        tse_id=tse_in_db.id,
+                        factory_function=factory,
+                        max_concurrent_signatures=tse_in_db.max_concurrent_signatures,
+                    )
                     tse.start(self.db_pool)
                     aes.push_async_callback(tse.stop)
                     self.tses[tse_in_db.id] = tse
 
-            # TODO Task to assign feral tills to a TSE
             LOGGER.info(f"Configured TSEs: {self.tses}")
 
             db_hook = DatabaseHook(self.db_pool, "tse_signature", self.handle_hook, initial_run=True)
@@ -71,6 +159,7 @@ class SignatureProcessor:
             await asyncio.gather(
                 db_hook.run(),
                 run_healthcheck(db, service_name="tses"),
+                run_metrics_snapshots(service_name="tses", collect=self.collect_metrics),
                 return_exceptions=True,
             )
 
@@ -81,60 +170,129 @@ class SignatureProcessor:
         del payload  # unused
         LOGGER.info("tse_signature hook")
 
-        # check if it is from a till without an assigned TSE
-        async with contextlib.AsyncExitStack() as aes:
-            psql: Connection = await aes.enter_async_context(self.db_pool.acquire())
+        released_from_tse_ids: set[int] = set()
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                if (
+                    self.rebalance_latency_factor is not None
+                    and time.monotonic() - self._last_rebalance > REBALANCE_INTERVAL
+                ):
+                    self._last_rebalance = time.monotonic()
+                    released_from_tse_ids = await self._release_tills_of_slow_tses(conn)
+                await self._assign_feral_tills(conn)
 
-            feral_till_id_rows = await psql.fetch(
-                """
-                    select
-                        till.id as till_id
-                    from
-                        tse_signature
-                        join ordr on ordr.id=tse_signature.id
-                        join till on ordr.till_id=till.id
-                    where
-                        tse_signature.signature_status='new' and
-                        till.tse_id is Null
-                    """
-            )
-            if feral_till_id_rows is None:
-                pass  # all fine
-            else:
-                LOGGER.info(f"till(s) without TSE but an order {feral_till_id_rows}")
-                LOGGER.info(f"{len(feral_till_id_rows)} till(s) need a TSE")
-                # assign TSEs
-                for till in feral_till_id_rows:
-                    # get number of assigned tills per tse, but only of active TSEs
-                    tse_stats = dict()
-                    active_tses = await psql.fetch("select name from tse where status='active'")
-                    for tse in active_tses:
-                        # TODO optimize this statement for really really large installations...
-                        tse_stats[tse["name"]] = await psql.fetchval(
-                            "select count(*) from till join tse on till.tse_id = tse.id where tse.name=$1 and tse.status='active'",
-                            tse["name"],
-                        )
-                    tse_ranked = sorted(tse_stats.items(), key=lambda x: x[1])
-                    # assign this till to tse with the lowest number
-                    till_id_to_assign_to_tse = till["till_id"]
-                    try:
-                        tse_name_to_assign_to_till = tse_ranked[0][0]
-
-                        tse_id = await psql.fetchval("select id from tse where name = $1 ", tse_name_to_assign_to_till)
-                        assert tse_id is not None
-                        await psql.execute(
-                            "update till set tse_id = $1 where id = $2", tse_id, till_id_to_assign_to_tse
-                        )
-                        LOGGER.info(
-                            f"Till with ID={till_id_to_assign_to_tse} is assigned to TSE: {tse_name_to_assign_to_till}"
-                        )
-                    except IndexError:
-                        LOGGER.error("ERROR: no more active TSEs available")
-                        LOGGER.warning("will set all signature requests to 'failure'")
-                        await psql.execute(
-                            "update tse_signature set signature_status='failure',result_message='TSE failure, no active TSE available', tse_id=1 where signature_status='new'"
-                        )
+        # the wrappers deregister the released tills on their TSE once the release is committed
+        for tse_id in released_from_tse_ids:
+            if tse_id in self.tses:
+                self.tses[tse_id].notify_tills_released()
 
         # notify all TSEs
         for tse in self.tses.values():
             tse.notify_maybe_orders_available()
+
+    async def collect_metrics(self):
+        assert self.db_pool is not None
+        rows = await self.db_pool.fetch(
+            """
+            select coalesce(tse.name, 'none') as tse, s.signature_status::text as status, count(*) as depth
+            from
+                tse_signature s
+                join ordr o on o.id = s.id
+                join till t on o.till_id = t.id
+                left join tse on tse.id = t.tse_id
+            where s.signature_status in ('new', 'pending')
+            group by tse.name, s.signature_status
+            """
+        )
+        QUEUE_DEPTH.clear()
+        for row in rows:
+            QUEUE_DEPTH.set(row["depth"], tse=row["tse"], status=row["status"])
+
+    async def _assign_feral_tills(self, conn: Connection):
+        """
+        Assigns all tills without a TSE that have signature requests waiting in a single step.
+        """
+        feral_till_ids = await conn.fetchval(
+            """
+            select coalesce(array_agg(distinct ordr.till_id order by ordr.till_id), '{}')
+            from
+                tse_signature
+                join ordr on ordr.id = tse_signature.id
+                join till on ordr.till_id = till.id
+            where
+                tse_signature.signature_status = 'new' and
+                till.tse_id is null
+            """
+        )
+        if not feral_till_ids:
+            return
+
+        LOGGER.info(f"{len(feral_till_ids)} till(s) without TSE but an order need a TSE: {feral_till_ids}")
+        assignment = plan_tse_assignment(await fetch_tse_loads(conn), feral_till_ids)
+        if not assignment:
+            LOGGER.error("ERROR: no more active TSEs available")
+            LOGGER.warning("will set all signature requests to 'failure'")
+            await conn.execute(
+                "update tse_signature set signature_status='failure',result_message='TSE failure, no active TSE available', tse_id=1 where signature_status='new'"
+            )
+            return
+
+        await conn.execute(
+            """
+            update till set tse_id = a.tse_id
+            from unnest($1::bigint[], $2::bigint[]) as a(till_id, tse_id)
+            where till.id = a.till_id and till.tse_id is null
+            """,
+            list(assignment.keys()),
+            [load.tse_id for load in assignment.values()],
+        )
+        for till_id, load in assignment.items():
+            LOGGER.info(f"Till with ID={till_id} is assigned to TSE: {load.name}")
+            FERAL_TILL_ASSIGNMENTS.inc(tse=load.name)
+
+    async def _release_tills_of_slow_tses(self, conn: Connection) -> set[int]:
+        """
+        Unassigns idle tills from TSEs whose rolling latency exceeds the median latency of all active TSEs
+        by self.rebalance_latency_factor, so they get assigned to a faster TSE with their next order.
+        Only tills without a logged-in user and without waiting signature requests are moved,
+        as a till must keep its TSE for the duration of a cashier shift.
+        Returns the ids of the TSEs tills were released from, their wrappers have to deregister the tills.
+        """
+        assert self.rebalance_latency_factor is not None
+        tse_loads = await fetch_tse_loads(conn)
+        latencies = sorted(load.latency for load in tse_loads if load.latency is not None)
+        if len(latencies) < 2:
+            return set()
+        max_latency = latencies[len(latencies) // 2] * self.rebalance_latency_factor
+        slow_tse_ids = [load.tse_id for load in tse_loads if load.latency is not None and load.latency > max_latency]
+        if not slow_tse_ids:
+            return set()
+        released_tills = await conn.fetch(
+            """
+            with released as (
+                select till.id, till.tse_id
+                from till
+                where
+                    till.tse_id = any($1) and
+                    not exists (
+                        select from terminal
+                        where terminal.id = till.terminal_id and terminal.active_user_id is not null
+                    ) and
+                    not exists (
+                        select from ordr o join tse_signature s on o.id = s.id
+                        where o.till_id = till.id and s.signature_status in ('new', 'pending')
+                    )
+                for update of till
+            )
+            update till set tse_id = null
+            from released
+            where till.id = released.id
+            returning till.id, released.tse_id
+            """,
+            slow_tse_ids,
+        )
+        if released_tills:
+            LOGGER.warning(
+                f"Tills with IDs={[till['id'] for till in released_tills]} were released from slow TSEs {slow_tse_ids}"
+            )
+        return {till["tse_id"] for till in released_tills}
@@ -11,16 +11,44 @@ import asyncpg
 from sftkit.database import Connection
 from sftkit.util import create_task_protected
 
-from .handler import TSEHandler, TSESignature, TSESignatureRequest
+from stustapay.core.metrics import METRICS
+
+from .handler import TSEHandler, TSEOperationError, TSESignature, TSESignatureRequest
 from .kassenbeleg_v1 import Kassenbeleg_V1
 
 LOGGER = logging.getLogger(__name__)
 
 PAYMENT_METHOD_TO_ZAHLUNGSART = {"cash": "Bar", "sumup": "Unbar", "tag": "Unbar", "sumup_online": "Unbar"}
 
+CLAIM_LATENCY = METRICS.histogram(
+    "tse_claim_latency_seconds", "Time to claim and prepare the next signature request from the database"
+)
+SIGN_DURATION = METRICS.histogram("tse_sign_duration_seconds", "Time the TSE took to sign a request")
+TIME_TO_SIGNATURE = METRICS.histogram(
+    "tse_time_to_signature_seconds", "Time from booking an order until its signature was stored"
+)
+SIGNATURES_DONE = METRICS.counter("tse_signatures_done_total", "Number of successfully stored signatures")
+SIGNATURE_FAILURES = METRICS.counter("tse_signature_failures_total", "Number of failed signature requests by reason")
+
+
+class SignatureFailure(typing.NamedTuple):
+    # label of the failure metric
+    reason: str
+    # stored as result message of the failed request
+    message: str
+
+
+SignatureResult = typing.Union[TSESignature, SignatureFailure]
+
 
 class TSEWrapper:
-    def __init__(self, tse_id: int, factory_function: Callable[[], TSEHandler]):
+    def __init__(
+        self,
+        tse_id: int,
+        factory_function: Callable[[], TSEHandler],
+        prefetch_size: int = 4,
+        max_concurrent_signatures: int = 1,
+    ):
         # most of these members will be set in run().
         # The TSE_id (database tse_id), references to tills and transactions
         self.tse_id = tse_id
@@ -37,6 +65,14 @@ class TSEWrapper:
         self._stop = False
         # Set this event to notify that new orders are available in the DB
         self._orders_available_event = asyncio.Event()
+        # Set to True to deregister the tills that were unassigned from this TSE in the DB
+        self._tills_released = False
+        # Maximum number of claimed and prepared signature requests waiting for the TSE
+        self._prefetch_size = prefetch_size
+        # Maximum number of signature requests (for different tills) in flight on the TSE at the same time
+        self._max_concurrent_signatures = max_concurrent_signatures
+        # Serializes the pipeline stages' accesses to the shared database connection
+        self._db_lock = asyncio.Lock()
 
     def start(self, db_pool: asyncpg.Pool):
         self._task = create_task_protected(self.run(db_pool), f"tse_wrapper_task {self.name}")
@@ -49,6 +85,10 @@ class TSEWrapper:
     def notify_maybe_orders_available(self):
         self._orders_available_event.set()
 
+    def notify_tills_released(self):
+        self._tills_released = True
+        self._orders_available_event.set()
+
     async def run(self, db_pool: asyncpg.Pool):
         """
         Connects to the wrapped TSE and calls _tse_handler_loop.
@@ -112,6 +152,7 @@ class TSEWrapper:
                     delta = datetime.datetime.now().astimezone() - request["booked_at"]
                     if delta > datetime.timedelta(seconds=10):
                         LOGGER.warning(f"new signing request for ordr {request['order_id']} is to old -> failing")
+                        SIGNATURE_FAILURES.inc(tse=self.name or self.tse_id, reason="tse_unreachable")
                         await conn.execute(
                             """ 
                             update
@@ -226,23 +267,181 @@ class TSEWrapper:
         # The TSE is now ready to be used.
         # Ready to execute signatures from the database.
 
-        while not self._stop and not self._tse_handler.is_stop_set():
-            LOGGER.info(f"TSE {self.name!r}: getting next request")
-            next_request = await self._grab_next_request(conn)
-            LOGGER.info(f"TSE {self.name!r}: {next_request=!r}")
+        await self._run_signing_pipeline(conn)
+
+    async def _run_signing_pipeline(self, conn: Connection):
+        """
+        Signs requests from the database in three pipelined stages until the connection breaks down
+        or self._stop is set, so the TSE does not sit idle during database round trips:
+
+        * the prefetcher claims and prepares the next requests into a bounded queue while the TSE is busy
+        * the signer passes the queued requests to the TSE, keeping up to self._max_concurrent_signatures
+          requests in flight at the same time
+        * the writer stores signature results and failures in batches
 
-            if next_request is not None:
-                # TODO handle unclean failures (reported via exception)
-                result = await self._sign(conn, next_request)
+        A till never has more than one claimed request, so concurrent signatures always belong to different tills
+        and the per-till order is kept.
+
+        Errors reported by the TSE and timeouts only fail their own request. Any other error while signing,
+        e.g. a broken connection, stops the pipeline and the request is signed again after reconnecting.
+
+        All stages share conn, accesses to it are serialized by self._db_lock.
+        Claimed requests which were not signed when the pipeline stops are returned to the database.
+        """
+        assert self._tse_handler is not None
+        pipeline_stop = asyncio.Event()
+        requests = asyncio.Queue[TSESignatureRequest](maxsize=max(self._prefetch_size, self._max_concurrent_signatures))
+        results = asyncio.Queue[typing.Optional[tuple[TSESignatureRequest, SignatureResult]]]()
+        signing = dict[asyncio.Task, TSESignatureRequest]()
+        unsigned_requests: list[TSESignatureRequest] = []
+        # first error which was not reported by the TSE, e.g. a broken connection, it stops the pipeline
+        pipeline_error: typing.Optional[BaseException] = None
+
+        def collect_signed():
+            nonlocal pipeline_error
+            for task in [task for task in signing if task.done()]:
+                request = signing.pop(task)
+                if task.cancelled():
+                    unsigned_requests.append(request)
+                    continue
+                error = task.exception()
+                if isinstance(error, TSEOperationError):
+                    # the TSE refused only this request, the pipeline keeps running
+                    LOGGER.error(f"TSE {self.name!r}: signing {request!r} failed", exc_info=error)
+                    results.put_nowait((request, SignatureFailure("error", f"TSE operation failed: {error!r}")))
+                    continue
+                if error is not None:
+                    # the request is returned and signed again once the TSE is reconnected
+                    LOGGER.error(f"TSE {self.name!r}: signing {request!r} was aborted", exc_info=error)
+                    unsigned_requests.append(request)
+                    if pipeline_error is None:
+                        pipeline_error = error
+                    continue
+                result = task.result()
                 LOGGER.info(f"signature result: {result!r}")
-                if result is None:
+                results.put_nowait((request, result))
+
+        prefetcher = asyncio.create_task(
+            self._prefetch_loop(conn, requests, pipeline_stop), name=f"tse_prefetcher {self.name}"
+        )
+        writer = asyncio.create_task(self._write_loop(conn, results), name=f"tse_writer {self.name}")
+        next_request_task: typing.Optional[asyncio.Task[TSESignatureRequest]] = None
+        try:
+            while not self._stop and not self._tse_handler.is_stop_set():
+                collect_signed()
+                if pipeline_error is not None or prefetcher.done() or writer.done():
+                    break
+                if next_request_task is None and len(signing) < self._max_concurrent_signatures:
+                    next_request_task = asyncio.create_task(requests.get())
+                waiting_for = set(signing)
+                if next_request_task is not None:
+                    waiting_for.add(next_request_task)
+                await asyncio.wait(waiting_for, timeout=2, return_when=asyncio.FIRST_COMPLETED)
+                if next_request_task is None or not next_request_task.done():
+                    continue
+                next_request = next_request_task.result()
+                next_request_task = None
+                LOGGER.info(f"TSE {self.name!r}: {next_request=!r}")
+
+                signing[asyncio.create_task(self._sign(conn, next_request))] = next_request
+
+                # TODO break out of while loop if the TSE connection has failed somehow
+        finally:
+            pipeline_stop.set()
+            self._orders_available_event.set()
+            if next_request_task is not None:
+                next_request_task.cancel()
+                try:
+                    unsigned_requests.append(await next_request_task)
+                except asyncio.CancelledError:
+                    pass
+            if signing:
+                await asyncio.wait(signing)
+            try:
+                collect_signed()
+            finally:
+                results.put_nowait(None)
+                stage_results = await asyncio.gather(prefetcher, writer, return_exceptions=True)
+                while not requests.empty():
+                    unsigned_requests.append(requests.get_nowait())
+                await self._return_requests(conn, unsigned_requests)
+                for stage_result in stage_results:
+                    if isinstance(stage_result, BaseException):
+                        raise stage_result
+        if pipeline_error is not None:
+            raise pipeline_error
+
+    async def _prefetch_loop(
+        self, conn: Connection, requests: asyncio.Queue[TSESignatureRequest], pipeline_stop: asyncio.Event
+    ):
+        """
+        Claims and prepares the next signature requests for this TSE until pipeline_stop is set.
+        """
+        while not pipeline_stop.is_set():
+            if self._tills_released:
+                self._tills_released = False
+                async with self._db_lock:
+                    await self._deregister_released_tills(conn)
+            LOGGER.info(f"TSE {self.name!r}: getting next request")
+            next_request = await self._grab_next_request(conn)
+            if next_request is None:
+                continue
+            while True:
+                if pipeline_stop.is_set():
+                    await self._return_requests(conn, [next_request])
+                    return
+                try:
+                    await asyncio.wait_for(requests.put(next_request), timeout=1)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _write_loop(
+        self,
+        conn: Connection,
+        results: asyncio.Queue[typing.Optional[tuple[TSESignatureRequest, SignatureResult]]],
+        max_batch_size: int = 100,
+    ):
+        """
+        Writes signature results to the database, batching all results that accumulated
+        while the previous batch was written.
+        Runs until it receives None.
+        """
+        stop = False
+        while not stop:
+            batch = [await results.get()]
+            while not results.empty() and len(batch) < max_batch_size:
+                batch.append(results.get_nowait())
+
+            done = []
+            failed = []
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                request, result = item
+                if isinstance(result, SignatureFailure):
                     # fail this request
-                    await self._fail_request(conn, next_request, "TSE operation failed, timeout")
+                    failed.append((request, result.message))
+                    SIGNATURE_FAILURES.inc(tse=self.name or self.tse_id, reason=result.reason)
                 else:
                     # the signature was completed successfully
-                    await self._request_done(conn, next_request, result)
-
-            # TODO break out of while loop if the TSE connection has failed somehow
+                    done.append((request, result))
+
+            if done or failed:
+                async with self._db_lock:
+                    async with conn.transaction():
+                        await self._requests_done(conn, done)
+                        await self._fail_requests(conn, failed)
+                now = datetime.datetime.now().astimezone()
+                for request, _ in done:
+                    SIGNATURES_DONE.inc(tse=self.name or self.tse_id)
+                    if request.booked_at is not None:
+                        TIME_TO_SIGNATURE.observe(
+                            (now - request.booked_at).total_seconds(), tse=self.name or self.tse_id
+                        )
+                # the tills of the written requests can have their next request claimed
+                self._orders_available_event.set()
 
     async def _grab_next_request(self, conn: Connection, timeout: float = 2) -> typing.Optional[TSESignatureRequest]:
         """
@@ -264,6 +463,14 @@ class TSEWrapper:
         if self._stop:
             return None
 
+        start = time.monotonic()
+        async with self._db_lock:
+            request = await self._claim_next_request(conn)
+        if request is not None:
+            CLAIM_LATENCY.observe(time.monotonic() - start, tse=self.name or self.tse_id)
+        return request
+
+    async def _claim_next_request(self, conn: Connection) -> typing.Optional[TSESignatureRequest]:
         async with conn.transaction(isolation="serializable"):
             next_sig = await conn.fetchrow(
                 """
@@ -334,9 +541,10 @@ class TSEWrapper:
         Collects all required information for signing the order,
         and passes the signing request to the TSE.
         """
-        payment_method = await conn.fetchval("select payment_method from ordr where ordr.id=$1", order_id)
-        if payment_method is None:
+        order = await conn.fetchrow("select payment_method, booked_at from ordr where ordr.id=$1", order_id)
+        if order is None or order["payment_method"] is None:
             raise RuntimeError(f"invalid order {order_id!r}")
+        payment_method = order["payment_method"]
         beleg = Kassenbeleg_V1()
         total = 0
         try:
@@ -355,39 +563,47 @@ class TSEWrapper:
             till_id=till_id,
             process_type=beleg.get_process_type(),
             process_data=beleg.get_process_data(),
+            booked_at=order["booked_at"],
         )
 
-    async def _return_request(self, conn: Connection, request: TSESignatureRequest):
+    async def _return_requests(self, conn: Connection, requests: list[TSESignatureRequest]):
         """
-        Returns a request which has been cleanly aborted to the database,
+        Returns requests which have been cleanly aborted to the database,
         to be attempted at a later point by us or somebody else.
         """
-        await conn.execute(
-            """
-            update tse_signature set signature_status='new', tse_id=NULL where id=$1
-            """,
-            request.order_id,
-        )
+        if not requests:
+            return
+        async with self._db_lock:
+            await conn.executemany(
+                """
+                update tse_signature set signature_status='new', tse_id=NULL where id=$1
+                """,
+                [(request.order_id,) for request in requests],
+            )
 
-    async def _fail_request(self, conn: Connection, request: TSESignatureRequest, reason: str):
+    async def _fail_requests(self, conn: Connection, requests: list[tuple[TSESignatureRequest, str]]):
         """
-        Set the request in the database to failed
+        Set the requests in the database to failed
         """
-        await conn.execute(
+        if not requests:
+            return
+        await conn.executemany(
             """
             update tse_signature set signature_status='failure', result_message=$2 where id=$1
             """,
-            request.order_id,
-            reason,
+            [(request.order_id, reason) for request, reason in requests],
         )
 
-    async def _request_done(self, conn: Connection, request: TSESignatureRequest, result: TSESignature):
+    async def _requests_done(self, conn: Connection, requests: list[tuple[TSESignatureRequest, TSESignature]]):
         """
-        Writes the results from the request to the database, marking the signature
+        Writes the results from the requests to the database, marking the signatures
         as done.
         """
-        LOGGER.info(f"duration {result.tse_duration}")
-        await conn.execute(
+        if not requests:
+            return
+        for _, result in requests:
+            LOGGER.info(f"duration {result.tse_duration}")
+        await conn.executemany(
             """
             update
                 tse_signature
@@ -405,38 +621,55 @@ class TSEWrapper:
             where
                 id=$9
             """,
-            request.process_type,
-            request.process_data,
-            str(result.tse_transaction),
-            str(result.tse_signaturenr),
-            result.tse_start,
-            result.tse_end,
-            result.tse_signature,
-            result.tse_duration,
-            request.order_id,
+            [
+                (
+                    request.process_type,
+                    request.process_data,
+                    str(result.tse_transaction),
+                    str(result.tse_signaturenr),
+                    result.tse_start,
+                    result.tse_end,
+                    result.tse_signature,
+                    result.tse_duration,
+                    request.order_id,
+                )
+                for request, result in requests
+            ],
         )
 
-    async def _sign(self, conn: Connection, signing_request: TSESignatureRequest) -> typing.Optional[TSESignature]:
+    async def _sign(self, conn: Connection, signing_request: TSESignatureRequest) -> SignatureResult:
+        """
+        Signs a single request, a timeout is reported as failure. Any other error is raised to the pipeline.
+        """
         assert self._tse_handler is not None
         # must be called when the TSE is connected and operational.
         if signing_request.till_id not in self._tills:
             LOGGER.info(f"registering new ClientID {signing_request.till_id} with TSE {self.name}")
-            await self._till_add(conn, signing_request.till_id)
+            async with self._db_lock:
+                await self._till_add(conn, signing_request.till_id)
         start = time.monotonic()
         try:
             result = await self._tse_handler.sign(signing_request)
         except asyncio.TimeoutError:
             LOGGER.warning("WARNING: TSE request timeout")
-            return None
+            return SignatureFailure("timeout", "TSE operation failed, timeout")
 
         stop = time.monotonic()
-        # TODO handle failures
-        # (return None if the signature was cleanly aborted,
-        #  e.g. because self._tse_handler is no longer valid)
         LOGGER.info(f"{self.name!r}: signature done ({signing_request}) in TIME {stop - start:.3f}s")
+        SIGN_DURATION.observe(stop - start, tse=self.name or self.tse_id)
         result.tse_duration = float(stop - start)  # duratoion
         return result
 
+    async def _deregister_released_tills(self, conn: Connection):
+        """
+        Deregisters all tills from the TSE which are registered but no longer assigned to it in the database.
+        """
+        assigned_tills = {
+            str(row["id"]) for row in await conn.fetch("select id from till where tse_id = $1", self.tse_id)
+        }
+        for till in sorted(self._tills - assigned_tills):
+            await self._till_remove(conn, till)
+
     async def _till_add(self, conn: Connection, till):
         assert self._tse_handler is not None
         LOGGER.info(f"{self.name!r}: adding till {till!r}")
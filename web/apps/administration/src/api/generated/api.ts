@@ -2783,6 +2783,7 @@ export type Tse = {
   ws_url: string;
   ws_timeout: number;
   password: string;
+  max_concurrent_signatures?: number;
   type: TseType;
   serial: string | null;
   node_id: number;
@@ -2805,6 +2806,7 @@ export type NewTse = {
   ws_url: string;
   ws_timeout: number;
   password: string;
+  max_concurrent_signatures?: number;
   type: TseType;
   serial: string | null;
 };
@@ -2813,6 +2815,7 @@ export type UpdateTse = {
   ws_url: string;
   ws_timeout: number;
   password: string;
+  max_concurrent_signatures?: number | null;
 };
 export type PayoutRunWithStats = {
   id: number;
@@ -14,6 +14,7 @@ const initialValues: NewTse = {
   ws_url: "",
   ws_timeout: 5,
   password: "",
+  max_concurrent_signatures: 1,
 };
 
 export const TseCreate: React.FC = () => {
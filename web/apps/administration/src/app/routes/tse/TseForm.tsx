@@ -21,6 +21,7 @@ export function TseForm<T extends NewTse>(props: TseFormProps<T>) {
         formik={props}
       />
       <FormTextField name="password" label={t("tse.password")} formik={props} />
+      <FormNumericInput name="max_concurrent_signatures" label={t("tse.maxConcurrentSignatures")} formik={props} />
     </>
   );
 }
@@ -20,6 +20,7 @@ export function UpdateTseForm<T extends UpdateTse>(props: UpdateTseForm<T>) {
         formik={props}
       />
       <FormTextField name="password" label={t("tse.password")} formik={props} />
+      <FormNumericInput name="max_concurrent_signatures" label={t("tse.maxConcurrentSignatures")} formik={props} />
     </>
   );
 }
@@ -569,6 +569,7 @@ export const translations = {
     create: "Create a new TSE",
     wsUrl: "Websocket URL",
     wsTimeout: "Websocket Timeout in seconds",
+    maxConcurrentSignatures: "Max. concurrent signatures",
     password: "TSE Password",
     hashalgo: "Hash Algorithm",
     timeFormat: "Time Format",